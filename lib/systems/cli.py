@@ -0,0 +1,192 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+"""
+Command line entry point.
+
+A manifest is a Python file defining expand(rg), as FunExpandable
+takes. For example, to realize one Redmine and what it needs::
+
+  python -m systems.cli -s Redmine:name=main manifest.py
+"""
+
+import hashlib
+import logging
+import optparse
+import os
+import sys
+import traceback
+
+from systems.context import Realizer, describe
+from systems.executor import TransitionsFailed
+from systems.journal import Journal
+from systems.locks import LockManager
+from systems.plancache import PlanCache
+from systems.pluginmanager import load_plugin
+from systems.probes import Probes
+from systems.selector import parse_selectors
+from systems.statestore import StateStore
+from systems.typesystem import FunExpandable
+
+__all__ = ('main', )
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_manifest(fname):
+  namespace = {'__file__': fname, '__name__': '__manifest__', }
+  execfile(fname, namespace)
+  try:
+    return FunExpandable(namespace['expand'])
+  except KeyError:
+    raise ValueError('The manifest should define expand(rg)', fname)
+
+
+def manifest_key(fname):
+  """
+  The plan cache key of a manifest: a hash of its path and contents.
+  """
+
+  digest = hashlib.sha1()
+  digest.update(os.path.abspath(fname) + '\0')
+  with open(fname, 'rb') as f:
+    digest.update(f.read())
+  return digest.hexdigest()
+
+
+def make_parser():
+  parser = optparse.OptionParser(usage='%prog [options] MANIFEST')
+  parser.add_option('-s', '--select', action='append', default=[],
+      metavar='SPEC',
+      help='only realize matching resources and what they need, '
+      'SPEC is [Type][:attr=value,...][@tag]; may be repeated')
+  parser.add_option('-j', '--jobs', type='int',
+      help='transitions to realize at once '
+      '(default 1, or 64 with the events engine)')
+  parser.add_option('--engine', choices=('threads', 'events'),
+      default='threads', help='threads or events')
+  parser.add_option('-k', '--keep-going', action='store_true',
+      default=False,
+      help='after a failure, realize what doesn\'t depend on it')
+  parser.add_option('--journal', metavar='PATH',
+      help='record realized transitions in PATH')
+  parser.add_option('--resume', action='store_true', default=False,
+      help='skip what the journal recorded, after an interrupted run')
+  parser.add_option('--lock-dir', metavar='DIR',
+      help='lock resources in DIR while realizing, '
+      'so that runs that don\'t overlap can share the host')
+  parser.add_option('--state-db', metavar='PATH',
+      help='remember converged resources in the database PATH, '
+      'and skip them while they are unchanged')
+  parser.add_option('--force', action='store_true', default=False,
+      help='verify resources the state database knows to be converged')
+  parser.add_option('--plan-cache', metavar='DIR',
+      help='cache the plan in DIR, and reuse it while the manifest, '
+      'the code and the state the plan was built from are unchanged')
+  parser.add_option('--export', metavar='PATH',
+      help='write the plan to PATH, as GraphML if PATH ends '
+      'with .graphml, as DOT otherwise')
+  parser.add_option('--export-by-type', action='store_true', default=False,
+      help='export merging nodes by resource type')
+  parser.add_option('--export-graph', action='store_true', default=False,
+      help='export the frozen graph, resources included, '
+      'instead of the plan')
+  parser.add_option('--export-transitions-only', action='store_true',
+      default=False, help='export the transitions of the frozen graph, '
+      'implies --export-graph')
+  parser.add_option('--export-within', action='append', default=[],
+      metavar='SPEC', help='export what matching resources expanded '
+      'into, SPEC is as in --select; may be repeated, '
+      'implies --export-graph')
+  parser.add_option('--probe-jobs', type='int', default=8, metavar='N',
+      help='probes of system state to run at once while planning')
+  parser.add_option('-n', '--dry-run', action='store_true', default=False,
+      help='list the transitions that would be realized, '
+      'only probing the system')
+  parser.add_option('-v', '--verbose', action='store_true', default=False)
+  return parser
+
+
+def main(argv=None):
+  parser = make_parser()
+  options, args = parser.parse_args(argv)
+  if len(args) != 1:
+    parser.error('Expected a manifest')
+  if options.resume and options.journal is None:
+    parser.error('--resume needs a --journal')
+  if options.force and options.state_db is None:
+    parser.error('--force needs a --state-db')
+  if options.probe_jobs < 1:
+    parser.error('--probe-jobs should be at least 1')
+  if options.export_transitions_only or options.export_within:
+    options.export_graph = True
+  if options.export_graph and options.export is None:
+    parser.error('--export-graph and its filters need --export')
+  if options.export_graph and options.plan_cache is not None:
+    parser.error('--export-graph needs the graph, '
+        'which a cached plan doesn\'t have')
+  logging.basicConfig(
+      level=options.verbose and logging.DEBUG or logging.INFO)
+  try:
+    select = parse_selectors(options.select) or None
+    export_within = parse_selectors(options.export_within) or None
+  except ValueError, e:
+    parser.error('Bad selector: %s' % (e.args, ))
+
+  load_plugin('systems.plugins')
+  journal = None
+  if options.journal is not None:
+    journal = Journal(options.journal)
+  lock_manager = None
+  if options.lock_dir is not None:
+    lock_manager = LockManager(options.lock_dir)
+  state_store = None
+  if options.state_db is not None:
+    state_store = StateStore(options.state_db)
+  plan_cache = None
+  key = None
+  if options.plan_cache is not None:
+    plan_cache = PlanCache(options.plan_cache)
+    key = manifest_key(args[0])
+  r = Realizer(load_manifest(args[0]), select=select,
+      plan_cache=plan_cache, manifest_key=key,
+      journal=journal, resume=options.resume, lock_manager=lock_manager,
+      state_store=state_store, force_verify=options.force,
+      probes=Probes(options.probe_jobs))
+  if options.export is not None:
+    format = 'dot'
+    if options.export.endswith('.graphml'):
+      format = 'graphml'
+    within = None
+    if export_within is not None:
+      within = r.select(export_within)
+    with open(options.export, 'w') as f:
+      if options.export_graph:
+        r.export(f, format, by_type=options.export_by_type,
+            transitions_only=options.export_transitions_only, within=within)
+      else:
+        r.plan.export(f, format, by_type=options.export_by_type)
+  if options.dry_run:
+    todo = r.preview()
+    for t in todo:
+      print describe(t)
+    LOGGER.info('Would realize %d transitions', len(todo))
+    return 0
+  try:
+    count = r.realize(options.jobs, options.engine,
+        keep_going=options.keep_going)
+  except TransitionsFailed, e:
+    for (t, (exc_type, exc_value, exc_tb)) in e.failures:
+      error = traceback.format_exception_only(exc_type, exc_value)
+      LOGGER.error('Failed: %s: %s', describe(t), ''.join(error).strip())
+    for t in e.skipped:
+      LOGGER.error('Skipped: %s', describe(t))
+    return 1
+  LOGGER.info('Realized %d transitions', count)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -12,8 +12,21 @@ class Collector(Named):
   It is the responsibility of the caller to pass transitions
   that are compatible dependency-wise
   (ie don't have dependencies paths linking them).
+
+  The objective attribute tells how parts are split into
+  dependency-compatible collections,
+  see ResourceGraph.antichain_partition. 'calls' gives as few
+  collections as possible, 'critical_path' makes sure collecting
+  doesn't make the longest dependency chain longer.
   """
 
+  objective = 'calls'
+
+  # The CResource subclasses this collector takes, or None for any.
+  # Declaring them lets candidates be found with a lookup;
+  # filter is then only called on instances of those.
+  accepts = None
+
   def partition(self, realizables):
     """
     Break up a sequence of collectible transitions into a partition.
@@ -30,9 +43,13 @@ class Collector(Named):
   def filter(self, realizable):
     """
     Return True for transitions we may collect, False otherwise.
+
+    The default implementation takes everything accepts allows.
     """
 
-    raise NotImplementedError('filter')
+    if self.accepts is None:
+      raise NotImplementedError('filter')
+    return True
 
   def collect(self, transitions):
     """
@@ -2,14 +2,23 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import heapq
+import threading
 from logging import getLogger
 
-import networkx as NX
 import yaml
 
 from systems.collector import Aggregate, CResource
+from systems.executor import Executor
+from systems.graphexport import collapse, write_graph
+from systems.plan import Plan, reduce_depends
+from systems.probes import StateReads
+from systems.reactor import Reactor
 from systems.registry import get_registry
-from systems.typesystem import EResource, Transition, ResourceRef
+from systems.typesystem import EResource, ResourceBase, Transition, ResourceRef
+from systems.util.concurrency import parallel_map
+from systems.util.dag import DAG, NetworkxDAG, to_networkx
+from systems.util.topoorder import CycleError, TopoOrder
 
 __all__ = ('Realizer', )
 
@@ -20,10 +29,27 @@ LOGGER = getLogger(__name__)
 DESC_LIMIT = 64
 
 def describe(thing):
-  return '%s' % str(thing)[:DESC_LIMIT]
+  # Truncated as text, so that UTF-8 sequences aren't cut.
+  desc = str(thing).decode('utf-8', 'replace')
+  return desc[:DESC_LIMIT].encode('utf-8')
 
-class CycleError(Exception):
-  pass
+def owner_name(owner):
+  """
+  Names a resource after its type and identifying attributes,
+  an aggregate after its class.
+  """
+
+  if isinstance(owner, ResourceBase):
+    return '%s(%s)' % (owner.rtype.name, ', '.join('%s=%r' % item
+      for item in sorted(owner.id_attrs.iteritems())))
+  return type(owner).__name__
+
+def is_aggregate_name(name):
+  """
+  Whether name, given by owner_name, is that of an aggregate.
+  """
+
+  return '(' not in name
 
 class Node(object):
   def __init__(self):
@@ -65,6 +91,52 @@ node_types = (CheckPointNode, BeforeExpandableNode, AfterExpandableNode,
     GraphFirstNode, GraphLastNode,
     Transition, Aggregate, CResource, EResource, ResourceRef)
 
+# Nodes that are expanded or collected.
+pending_types = (CResource, EResource, Aggregate)
+
+def synchronized(method):
+  """
+  Run a ResourceGraph method holding the lock shared by its scopes.
+
+  A scope of a concurrent expansion wave first waits for its turn.
+  """
+
+  def locked(self, *args, **kargs):
+    if self._turn is not None:
+      turns, turn = self._turn
+      turns.wait(turn)
+    self._lock.acquire()
+    try:
+      return method(self, *args, **kargs)
+    finally:
+      self._lock.release()
+  locked.__name__ = method.__name__
+  locked.__doc__ = method.__doc__
+  return locked
+
+
+class _Turns(object):
+  # Lets the expansions of a wave modify the graph one after the other,
+  # in the order of the wave, whatever order their threads run in.
+
+  def __init__(self):
+    self.__cond = threading.Condition()
+    self.__current = 0
+    self.__finished = set()
+
+  def wait(self, turn):
+    with self.__cond:
+      while self.__current < turn:
+        self.__cond.wait()
+
+  def finish(self, turn):
+    with self.__cond:
+      self.__finished.add(turn)
+      while self.__current in self.__finished:
+        self.__current += 1
+      self.__cond.notify_all()
+
+
 class ResourceGraph(yaml.YAMLObject):
   """
   A graph of resources and transitions linked by dependencies.
@@ -72,27 +144,94 @@ class ResourceGraph(yaml.YAMLObject):
   Resources are positioned as two sentinels in the transition graph.
 
   Invariant: directed, acyclic.
+  The invariant is checked as edges are added, by maintaining
+  a topological order incrementally.
+
+  Resources are expanded into scopes: views of the top graph
+  in which added nodes are placed between the sentinels
+  of the resource being expanded.
   """
 
-  def __init__(self, top=None):
-    self._graph = NX.DiGraph()
+  def __init__(self, backend='native'):
+    """
+    backend is the graph implementation: 'native' for
+    systems.util.dag, 'networkx' for a networkx DiGraph.
+    """
+
+    self.__top = self
+    if backend == 'native':
+      self._graph = DAG()
+    elif backend == 'networkx':
+      self._graph = NetworkxDAG()
+    else:
+      raise ValueError(backend)
+    # The order works on graph ids.
+    self.__order = TopoOrder(
+        self._graph.successor_ids, self._graph.predecessor_ids)
     self._first = GraphFirstNode()
     self._last = GraphLastNode()
-    self._graph.add_edge(self._first, self._last)
     # Contains CResource and EResource, despite the name.
     # Used to enforce max one resource per id.
+    # In a scope, only those added in the scope.
     self.__expandables = {}
     # Received references, by name.
     self.__received_refs = {}
     # What nodes were processed (meaning expanding or collecting)
     self.__processed = set()
+    # The worklist: nodes that are yet to be processed, by type.
+    self.__pending = {}
+    # What a processed node was replaced with: a (first, last) pair
+    # of nodes, themselves possibly replaced later.
+    self.__replaced = {}
+    # Nodes by the resource whose expansion added them (None for the top),
+    # including nodes that were since processed.
+    self.__owned = {}
+    # Aggregates, with the resources they were collected from.
+    self.__members = {}
+    # Resources put at the top by add_to_top.
+    self.__shared = set()
+    # Tags given to add_resource, by resource identity.
+    self.__tags = {}
+    # What was added since push_layer, None outside of a layer.
+    self.__layer = None
+    # Nearest transitions above each node of the graph outside of
+    # layers, and dependencies of its transitions, by id, while they
+    # are kept valid.
+    self.__base_above = None
+    self.__base_depends = None
+    # Held while modifying the graph; scopes may be filled concurrently.
+    self._lock = threading.RLock()
+    # (turns, turn) while expanding in a concurrent wave, see _Turns.
+    self._turn = None
+    # The resource a scope is expanding, None for the top graph.
+    self.__owner = None
+    self.__add_graph_node(self._first)
+    self.__add_graph_node(self._last)
+    self.__add_graph_edge(self._first, self._last)
+
+  def __scope(self, owner, before, after):
+    # A view where nodes are added between before and after.
     # Pre-bound args pased by ref. Allow putting extra depends on them.
-    if top is not None:
-      if not isinstance(top, ResourceGraph):
-        raise TypeError(top, ResourceGraph)
-      self.__top = top
-    else:
-      self.__top = self
+    top = self.__top
+    scope = object.__new__(type(self))
+    scope.__top = top
+    scope._graph = top._graph
+    scope.__order = top.__order
+    scope._first = before
+    scope._last = after
+    scope.__expandables = {}
+    scope.__received_refs = {}
+    scope.__processed = top.__processed
+    scope.__pending = top.__pending
+    scope.__replaced = top.__replaced
+    scope.__owned = top.__owned
+    scope.__members = top.__members
+    scope.__shared = top.__shared
+    scope.__tags = top.__tags
+    scope._lock = top._lock
+    scope._turn = None
+    scope.__owner = owner
+    return scope
 
   yaml_tag = u'!ResourceGraph'
 
@@ -108,13 +247,58 @@ class ResourceGraph(yaml.YAMLObject):
 
   @classmethod
   def to_yaml(cls, dumper, rg):
-    # This is incomplete.
+    # This is incomplete, see systems.serialization for a complete one.
     pred_rels = [{'node': node, 'depends': list(depends), }
         for (node, depends) in rg._iter_pred_rels()]
     return dumper.represent_mapping(cls.yaml_tag, {
       'nodes': pred_rels,
       })
 
+  def _restore_node(self, node, depends, owner=None):
+    # Add node and edges from depends as they were, with the resource
+    # or aggregate whose expansion added it, for systems.serialization.
+    if node not in self._graph:
+      # Nodes come in order, each goes right before the last one.
+      self.__add_graph_node(node, self._last)
+      if owner is not None:
+        self.__owned[None].discard(node)
+        self.__owned.setdefault(owner, set()).add(node)
+      if isinstance(node, ResourceBase):
+        self.__expandables[node.identity] = node
+    for dep in depends:
+      if not self._graph.has_edge(dep, node):
+        self.__add_graph_edge(dep, node)
+
+  def _restore_processed(self, node, owner, replaced, members=None):
+    # Likewise for a node that was processed, replaced being what
+    # replaced it and members the resources of an aggregate.
+    self.__owned.setdefault(owner, set()).add(node)
+    self.__processed.add(node)
+    self.__replaced[node] = replaced
+    if members is not None:
+      self.__members[node] = members
+    if isinstance(node, ResourceBase):
+      self.__expandables[node.identity] = node
+
+  def _restore_marks(self, res, tags, shared):
+    # The tags of res, and whether it was added by add_to_top.
+    if tags:
+      self.__tags.setdefault(res.identity, set()).update(tags)
+    if shared:
+      self.__shared.add(res)
+
+  def _history(self):
+    # For systems.serialization: the owner of every owned node,
+    # what replaced processed nodes, the members of aggregates,
+    # tags by identity, and the resources added by add_to_top.
+    owners = {}
+    for (owner, nodes) in self.__owned.iteritems():
+      if owner is not None:
+        for node in nodes:
+          owners[node] = owner
+    return (owners, self.__replaced, self.__members,
+        self.__tags, self.__shared)
+
   def _iter_node_preds(self, node0):
     return (node
         for node in self._graph.predecessors_iter(node0)
@@ -126,29 +310,299 @@ class ResourceGraph(yaml.YAMLObject):
       if node not in (self._first, self._last))
 
   def sorted_nodes(self):
-    return NX.topological_sort(self._graph)
+    node = self._graph.node
+    return [node(i) for i in self.__order]
 
   def sorted_transitions(self):
     return [n for n in self.sorted_nodes()
         if isinstance(n, Transition)]
 
-  def iter_uncollected_resources(self):
-    for nod in self._graph.nodes_iter():
-      if isinstance(nod, CResource):
-        if not nod in self.__processed:
-          yield nod
+  def transition_dependencies(self):
+    """
+    The transitions each transition must wait for.
+
+    Returns a map from every transition to the nearest transitions
+    above it, looking through nodes that aren't transitions;
+    none of them comes after another.
+    """
+
+    return self.__transition_dependencies()[1]
+
+  def settled_transitions(self):
+    """
+    The transitions nothing can be put before anymore.
+
+    Pending nodes may be expanded or collected into new ancestors of
+    what comes after them; so may the refs a pending resource will
+    receive. Transitions that come after none of those are settled.
+    Returns them in topological order, and their dependencies
+    as in transition_dependencies.
+    """
+
+    graph = self._graph
+    unsettled = set()
+    for nodes in self.__pending.itervalues():
+      for node in nodes:
+        unsettled.add(graph.node_id(node))
+        if isinstance(node, ResourceBase):
+          for (name, ref) in node.iter_passed_by_ref():
+            unsettled.add(graph.node_id(ref))
+    return self.__transition_dependencies(unsettled)[:2]
+
+  def __transition_dependencies(self, unsettled=None):
+    # Ids in unsettled and their descendants are left out;
+    # unsettled is updated. Also returns the nearest transitions
+    # above nodes that aren't transitions, and the dependencies
+    # of transitions, by id.
+    graph = self._graph
+    nearest = self.__nearest_function()
+    # Transitions that are reached last on the paths leading to a node,
+    # by id.
+    above = {}
+    sorted_transitions = []
+    depends = {}
+    for i in self.__order:
+      if unsettled is not None:
+        if i in unsettled:
+          continue
+        for pred in graph.predecessor_ids(i):
+          if pred in unsettled:
+            unsettled.add(i)
+            break
+        if i in unsettled:
+          continue
+      preds = nearest(i, above.__getitem__, depends.__getitem__)
+      if isinstance(graph.node(i), Transition):
+        sorted_transitions.append(graph.node(i))
+        depends[i] = preds
+      else:
+        above[i] = preds
+    node = graph.node
+    return (sorted_transitions,
+        dict((node(i), [node(j) for j in preds])
+          for (i, preds) in depends.iteritems()),
+        above, depends)
+
+  def __nearest_function(self):
+    # Returns nearest(i, above, depends), the nearest transitions
+    # above the node of id i, reduced; above and depends give those
+    # of the predecessors of i, and of transitions that come before.
+    graph = self._graph
+    position = self.__order.position
+    enclosing = self.__enclosing_function()
+    def nearest(i, above, depends):
+      preds = list(graph.predecessor_ids(i))
+      if len(preds) > 1:
+        # The first node of a scope comes before all the scope holds;
+        # whatever is above it is above those, and needn't be looked at.
+        firsts = set()
+        for pred in preds:
+          for first in enclosing(pred):
+            if first != pred:
+              firsts.add(first)
+        preds = [pred for pred in preds if pred not in firsts]
+      candidates = set()
+      for pred in preds:
+        if isinstance(graph.node(pred), Transition):
+          candidates.add(pred)
+        else:
+          candidates.update(above(pred))
+      return reduce_depends(candidates, position, depends)
+    return nearest
+
+  def __enclosing_function(self):
+    # Returns enclosing(i), the ids of the first nodes of the scopes
+    # the node of id i was added in, from its own to the top graph's.
+    graph = self._graph
+    owner_of = {}
+    for (owner, nodes) in self.__owned.iteritems():
+      for node in nodes:
+        owner_of[id(node)] = owner
+    # By id of the owner of a scope.
+    firsts = {id(None): (graph.node_id(self.__top._first), )}
+    def scope_firsts(owner):
+      outer = []
+      while id(owner) not in firsts:
+        outer.append(owner)
+        owner = owner_of.get(id(owner))
+      result = firsts[id(owner)]
+      for owner in reversed(outer):
+        first = self.__replaced.get(owner, (None, ))[0]
+        if first is not None and first in graph:
+          result = (graph.node_id(first), ) + result
+        firsts[id(owner)] = result
+      return result
+    def enclosing(i):
+      return scope_firsts(owner_of.get(id(graph.node(i))))
+    return enclosing
+
+  def compact(self):
+    """
+    Build the Plan of this graph, which only keeps transitions.
+
+    Dependencies are reduced as the graph is walked, so no more than
+    the reduced plan is built.
+    """
+
+    transitions, depends = self.__transition_dependencies()[:2]
+    return Plan.from_reduced(transitions, depends, self.transition_owners())
+
+  def transition_owners(self):
+    """
+    Names of what expanded into each transition, for those not at the top.
+
+    Resources are named after their type and identifying attributes,
+    aggregates after their class.
+    """
+
+    return self.__transition_owners(self.__owned)
+
+  def __transition_owners(self, owners):
+    # The names of owners, for the transitions they own.
+    names = {}
+    for owner in owners:
+      if owner is None:
+        continue
+      name = owner_name(owner)
+      for node in self.__owned.get(owner, ()):
+        if isinstance(node, Transition) and node in self._graph:
+          names[node] = name
+    return names
+
+  def push_layer(self):
+    """
+    Start a layer: what is added to the graph from now on
+    can be taken away with pop_layer.
+
+    Layers are meant to be added to a frozen graph, which
+    compact_layer compacts by only visiting what the layer changed.
+    Nothing can be removed from the graph while a layer is open.
+    """
+
+    if self.__owner is not None:
+      raise RuntimeError('Only the top graph has layers')
+    if self.__layer is not None:
+      raise RuntimeError('A layer is open already')
+    if self.__base_above is None:
+      self.__base_above, self.__base_depends = \
+          self.__transition_dependencies()[2:]
+    self.__layer = _Layer()
+
+  def pop_layer(self):
+    """
+    Remove what was added since push_layer.
+    """
 
-  def iter_unexpanded_resources(self):
-    for nod in self._graph.nodes_iter():
-      if isinstance(nod, EResource):
-        if not nod in self.__processed:
-          yield nod
+    layer = self.__layer
+    if layer is None:
+      raise RuntimeError('No layer is open')
+    for (node0, node1) in layer.edges:
+      self._graph.delete_edge(node0, node1)
+    doomed = set(layer.nodes)
+    self.__remove(doomed, find_refs=False)
+    for node in doomed:
+      if isinstance(node, ResourceBase) \
+          and node.identity not in self.__expandables:
+        self.__tags.pop(node.identity, None)
+    self.__layer = None
+
+  def compact_layer(self, base):
+    """
+    Compact the graph into a Plan, like compact.
 
-  def iter_unexpanded_aggregates(self):
-    for agg in self._graph.nodes_iter():
-      if isinstance(agg, Aggregate):
-        if not agg in self.__processed:
-          yield agg
+    base is the Plan of the graph when push_layer was called.
+    Only the nodes the layer added, and those that come after them
+    differently, are visited. If the layer puts something new before
+    transitions of base, the whole graph is compacted instead.
+    """
+
+    layer = self.__layer
+    if layer is None:
+      raise RuntimeError('No layer is open')
+    graph = self._graph
+    position = self.__order.position
+    base_above = self.__base_above
+    base_depends = self.__base_depends
+    # Override base_above and base_depends, for nodes that are new
+    # or have new ancestors.
+    above = {}
+    new_depends = {}
+    sentinels = (graph.node_id(self._first), graph.node_id(self._last))
+    def is_transition(i):
+      return isinstance(graph.node(i), Transition)
+    def above_of(i):
+      if i in above:
+        return above[i]
+      return base_above[i]
+    def base_above_of(i):
+      return base_above[i]
+    def depends_of(i):
+      if i in new_depends:
+        return new_depends[i]
+      return base_depends[i]
+    nearest_function = self.__nearest_function()
+    def nearest(i, above):
+      # Nearest transitions above i, looking at its predecessors.
+      return nearest_function(i, above, depends_of)
+
+    new = set(graph.node_id(node) for node in layer.nodes
+        if node in graph)
+    heap = [(position(i), i) for i in new]
+    heap.extend((position(graph.node_id(node1)), graph.node_id(node1))
+        for (node0, node1) in layer.edges)
+    heapq.heapify(heap)
+    seen = set()
+    transitions = []
+    depends = {}
+    while heap:
+      pos, i = heapq.heappop(heap)
+      if i in seen or i in sentinels:
+        continue
+      seen.add(i)
+      preds = nearest(i, above_of)
+      if i in new:
+        if is_transition(i):
+          transitions.append(graph.node(i))
+          new_depends[i] = preds
+          depends[graph.node(i)] = [graph.node(j) for j in preds]
+        else:
+          above[i] = preds
+      elif is_transition(i):
+        if new.intersection(graph.predecessor_ids(i)) \
+            or preds != nearest(i, base_above_of):
+          LOGGER.debug('Layer comes before %s, compacting everything',
+              graph.node(i))
+          return self.compact()
+        continue
+      elif preds == base_above[i]:
+        continue
+      else:
+        above[i] = preds
+      for succ in graph.successor_ids(i):
+        if succ not in new and succ not in seen:
+          heapq.heappush(heap, (position(succ), succ))
+    return base.extend(transitions, depends,
+        self.__transition_owners(layer.nodes))
+
+  def __iter_pending(self, kind, types):
+    # Iterate over unprocessed nodes of kind,
+    # restricted to instances of types if not None.
+    for (cls, nodes) in self.__pending.items():
+      if not issubclass(cls, kind):
+        continue
+      if types is not None and not issubclass(cls, types):
+        continue
+      for nod in list(nodes):
+        yield nod
+
+  def iter_uncollected_resources(self, types=None):
+    return self.__iter_pending(CResource, types)
+
+  def iter_unexpanded_resources(self, types=None):
+    return self.__iter_pending(EResource, types)
+
+  def iter_unexpanded_aggregates(self, types=None):
+    return self.__iter_pending(Aggregate, types)
 
   def iter_unprocessed(self):
     for nod in self.iter_uncollected_resources():
@@ -158,72 +612,174 @@ class ResourceGraph(yaml.YAMLObject):
     for nod in self.iter_unexpanded_aggregates():
       yield nod
 
+  def iter_processed_resources(self, within=None):
+    """
+    The resources that were expanded, collected or skipped.
+
+    If within is a set of nodes (see before), only those that ended
+    in within.
+    """
+
+    for node in list(self.__processed):
+      if isinstance(node, ResourceBase):
+        if within is None or self.__ends(node)[1] in within:
+          yield node
+
   def has_unprocessed(self):
-    l = list(self.iter_unprocessed())
-    return bool(l) # Tests for non-emptiness
+    for nodes in self.__pending.itervalues():
+      if nodes:
+        return True
+    return False
 
   def require_acyclic(self):
-    if not NX.is_directed_acyclic_graph(self._graph):
-      # XXX NX doesn't have a 1-line method for listing those cycles
-      raise CycleError
-
-  def _add_node(self, node, depends=()):
+    # Edges are checked as they are added, this is a full recheck.
+    position = dict((i, pos) for (pos, i) in enumerate(self.__order))
+    node_id = self._graph.node_id
+    for (n0, n1) in self._graph.edges_iter():
+      if position[node_id(n0)] >= position[node_id(n1)]:
+        raise CycleError([n1, n0])
+
+  def __add_graph_node(self, node, before=None):
+    # before is a node of the graph to put node right before in the order.
+    if node not in self._graph:
+      self.__owned.setdefault(self.__owner, set()).add(node)
+      layer = self.__top.__layer
+      if layer is None:
+        self.__top.__base_above = None
+      else:
+        layer.nodes.append(node)
+        layer.members.add(node)
+    if before is not None:
+      before = self._graph.node_id(before)
+    self.__order.add_node(self._graph.add_node(node), before)
+    if isinstance(node, pending_types) and node not in self.__processed:
+      self.__pending.setdefault(type(node), set()).add(node)
+
+  def __add_graph_edge(self, node0, node1):
+    # Raises CycleError before touching the graph.
+    i0 = self._graph.node_id(node0)
+    i1 = self._graph.node_id(node1)
+    try:
+      self.__order.add_edge(i0, i1)
+    except CycleError, e:
+      raise CycleError([self._graph.node(i) for i in e.args[0]])
+    layer = self.__top.__layer
+    if layer is None:
+      self.__top.__base_above = None
+    elif node0 not in layer.members and node1 not in layer.members \
+        and not self._graph.has_edge(node0, node1):
+      layer.edges.append((node0, node1))
+    self._graph.add_id_edge(i0, i1)
+
+  def __delete_graph_node(self, node):
+    if self.__top.__layer is None:
+      self.__top.__base_above = None
+    self.__order.remove_node(self._graph.node_id(node))
+    self._graph.delete_node(node)
+    self.__unpend(node)
+
+  def __unpend(self, node):
+    nodes = self.__pending.get(type(node))
+    if nodes is not None:
+      nodes.discard(node)
+
+  def __mark_processed(self, node):
+    self.__processed.add(node)
+    self.__unpend(node)
+
+  def _add_node(self, node, depends=(), before=None):
     if not isinstance(node, node_types):
       raise TypeError(node, node_types)
-    self._graph.add_node(node)
-    self._graph.add_edge(self._first, node)
-    self._graph.add_edge(node, self._last)
+    # Placed where it belongs, so that the edges below
+    # don't have to reorder the scope.
+    if before is None:
+      before = self._last
+    self.__add_graph_node(node, before)
+    self.__add_graph_edge(self._first, node)
+    self.__add_graph_edge(node, self._last)
     for dep in depends:
       depn = self._intern(dep)
       self._add_node_dep(depn, node)
     return node
 
+  @synchronized
   def add_checkpoint(self, depends=()):
     return self._add_node(CheckPointNode(), depends)
 
+  @synchronized
   def add_transition(self, transition, depends=()):
     if not isinstance(transition, Transition):
       raise TypeError(transition, Transition)
     return self._add_node(transition, depends)
 
-  def _add_aggregate(self, aggregate, depends=()):
+  def _add_aggregate(self, aggregate, depends=(), before=None):
     if not isinstance(aggregate, Aggregate):
       raise TypeError(aggregate, Aggregate)
-    return self._add_node(aggregate, depends)
+    return self._add_node(aggregate, depends, before)
 
-  def add_resource(self, resource, depends=()):
+  @synchronized
+  def add_resource(self, resource, depends=(), tags=()):
     """
     Add a resource.
 
     If an identical resource exists, it is returned.
+    tags are strings that selectors can match (see systems.selector).
     """
 
     if not isinstance(resource, (CResource, EResource)):
       raise TypeError(resource, (CResource, EResource))
 
+    all_expandables = self.__top.__expandables
+    if resource.identity not in self.__expandables \
+        and resource.identity in all_expandables:
+      # Pass by reference if you must use the same resource
+      # in different contexts.
+      raise RuntimeError('ResourceBase collision.', self.__owner, resource)
+    if tags:
+      self.__tags.setdefault(resource.identity, set()).update(tags)
     if resource.identity in self.__expandables:
       # We have this id already.
       # Either it's the exact same resource, or a KeyError is thrown.
-      resource = self._intern(resource)
-      # XXX Need to bypass _intern for already expanded.
-      # XXX When we use add_to_top, we sometimes have to deal
-      # with a resource that's already been expanded.
-      # Those are not in the graph anymore. How do we refer to them?
+      if self.__expandables[resource.identity] != resource:
+        raise KeyError(resource)
+      resource = self.__expandables[resource.identity]
+      if resource in self.__processed:
+        # Already expanded or collected, which happens with add_to_top.
+        # It isn't in the graph anymore; what replaced it is.
+        first, last = self.__ends(resource)
+        for dep in depends:
+          self._add_node_dep(self._intern(dep), first)
+        return self._add_node(ResourceRef(resource), (last, ))
     else:
       self.__expandables[resource.identity] = resource
+      all_expandables[resource.identity] = resource
     # Even if already there, we need to add the depends.
     resource = self._add_node(resource, depends)
     # If already there, notice we aliase it.
     return self.make_ref(resource)
 
+  @synchronized
   def make_ref(self, res, depends=()):
-    res = self._intern(res)
     if not isinstance(res, (CResource, EResource)):
       raise TypeError(res, (CResource, EResource))
     depends = list(depends)
-    depends.append(res)
+    if res in self.__processed:
+      depends.append(self.__ends(res)[1])
+    else:
+      res = self._intern(res)
+      depends.append(res)
     return self._add_node(ResourceRef(res), depends)
 
+  def __ends(self, node):
+    # The nodes standing for the start and the end of a processed node.
+    first = last = node
+    while first not in self._graph:
+      first = self.__replaced[first][0]
+    while last not in self._graph:
+      last = self.__replaced[last][1]
+    return first, last
+
+  @synchronized
   def make_alias_ref(self, ref, depends=()):
     ref = self._intern(ref)
     if not isinstance(ref, ResourceRef):
@@ -232,6 +788,7 @@ class ResourceGraph(yaml.YAMLObject):
     depends.append(ref)
     return self._add_node(ResourceRef(ref.unref), depends)
 
+  @synchronized
   def add_to_top(self, res):
     """
     Add a resource to the top ResourceGraph.
@@ -241,6 +798,7 @@ class ResourceGraph(yaml.YAMLObject):
     """
 
     ref = self.__top.add_resource(res)
+    self.__shared.add(ref.unref)
     return self._add_node(ref)
 
   def _add_node_dep(self, node0, node1):
@@ -258,11 +816,8 @@ class ResourceGraph(yaml.YAMLObject):
       # Disallow self-loops to keep acyclic invariant.
       # Also they don't make sense.
       raise ValueError(node0)
-    # Invariant check
-    rev_path = NX.shortest_path(self._graph, node1, node0)
-    if rev_path is not False:
-      raise CycleError(rev_path)
-    self._graph.add_edge(node0, node1)
+    # Invariant check, raises CycleError with the reverse path.
+    self.__add_graph_edge(node0, node1)
     return True
 
   def _intern(self, thing):
@@ -272,6 +827,7 @@ class ResourceGraph(yaml.YAMLObject):
       raise KeyError(thing)
     return thing
 
+  @synchronized
   def add_dependency(self, elem0, elem1):
     node0 = self._intern(elem0)
     node1 = self._intern(elem1)
@@ -280,8 +836,8 @@ class ResourceGraph(yaml.YAMLObject):
   def _is_direct_rconnect(self, r0, r1):
     s0 = self._intern(r0)
     s1 = self._intern(r1)
-    # shortest_path is also a test for connectedness.
-    return bool(NX.shortest_path(self._graph, s0, s1))
+    return self.__order.has_path(
+        self._graph.node_id(s0), self._graph.node_id(s1))
 
   def resources_connected(self, r0, r1):
     return self._is_direct_rconnect(r0, r1) \
@@ -297,7 +853,10 @@ class ResourceGraph(yaml.YAMLObject):
     # We duplicate the graph, otherwise networkx / pygraphviz
     # would make a lossy conversion (sometimes refusing to convert), by adding
     # nodes as their string representation. Madness, I know.
-    gr2 = NX.create_empty_copy(self._graph, False)
+    import networkx as NX
+    from systems.serialization import dump_graph
+
+    gr2 = NX.DiGraph()
     for node in self._graph.nodes_iter():
       gr2.add_node(id(node))
     for (n0, n1) in self._graph.edges_iter():
@@ -322,23 +881,119 @@ class ResourceGraph(yaml.YAMLObject):
     g.layout(prog='dot')
     g.draw(fname + '.svg')
     with open(fname + '.yaml', 'w') as f:
-      yaml.dump(self, f)
-    # Fails with the expanded graph, due to instancemethod
-    #yaml.load(yaml.dump(self))
+      dump_graph(self, f)
+
+  def export(self, f, format='dot', transitions_only=False, within=None,
+      by_type=False):
+    """
+    Write the graph to the file f as DOT or GraphML, streaming
+    (see systems.graphexport).
+
+    If transitions_only is set, only transitions are written, linked
+    as in transition_dependencies. within is a list of resources;
+    if given, only what they expanded into is written. If by_type
+    is set, nodes are merged by the type of the resource that
+    expanded into them.
+    """
+
+    graph = self._graph
+    keep = None
+    if within is not None:
+      keep = self.__expansion_closure(within)
+    def kept(node):
+      if node is self._first or node is self._last:
+        return False
+      if transitions_only and not isinstance(node, Transition):
+        return False
+      return keep is None or node in keep
+    nodes = ((graph.node_id(node), describe(node))
+        for node in graph.nodes_iter() if kept(node))
+    if transitions_only:
+      depends = self.transition_dependencies()
+      edges = ((graph.node_id(pred), graph.node_id(t))
+          for (t, preds) in depends.iteritems() if kept(t)
+          for pred in preds if kept(pred))
+    else:
+      edges = ((graph.node_id(n0), graph.node_id(n1))
+          for (n0, n1) in graph.edges_iter() if kept(n0) and kept(n1))
+    if by_type:
+      owner_of = {}
+      for (owner, owned) in self.__owned.iteritems():
+        for node in owned:
+          owner_of[node] = owner
+      def group(i):
+        node = graph.node(i)
+        owner = owner_of.get(node)
+        if owner is None:
+          owner = node
+        if isinstance(owner, ResourceBase):
+          return owner.rtype.name
+        if isinstance(owner, Transition):
+          return owner.ttype.name
+        return type(owner).__name__
+      nodes, edges = collapse(nodes, edges, group)
+    write_graph(f, nodes, edges, format)
 
   def draw_matplotlib(self, fname):
     # Pyplot is stateful and awkward to use.
     import matplotlib.pyplot as P
     # Disable hold or it definitely won't work (probably a bug).
     P.hold(False)
-    NX.draw(self._graph)
+    import networkx as NX
+    NX.draw(to_networkx(self._graph))
     P.savefig(fname)
 
+  def antichain_partition(self, nodes, objective='calls'):
+    """
+    Split nodes into parts that can each be collected into one node.
+
+    There are no paths between the nodes of a part,
+    and collecting every part keeps the graph acyclic.
+    Parts are returned in dependency order.
+
+    objective is one of:
+      'calls': as few parts as possible.
+        Parts are topological levels among the nodes;
+        there are as many as there are nodes on the longest chain
+        of nodes linked by paths, which is the minimum.
+      'critical_path': don't make the longest chain of
+        transitions and resources longer.
+        Parts are groups of nodes at the same depth in the graph;
+        collecting them never delays anything.
+    """
+
+    graph = self._graph
+    ids = set(graph.node_id(self._intern(node)) for node in nodes)
+    if objective == 'calls':
+      def weight(i):
+        return i in ids
+    elif objective == 'critical_path':
+      def weight(i):
+        return isinstance(graph.node(i),
+            (Transition, Aggregate, CResource))
+    else:
+      raise ValueError(objective)
+
+    # One pass in topological order.
+    depth = {}
+    parts = {}
+    for i in self.__order:
+      d = 0
+      for pred in graph.predecessor_ids(i):
+        d = max(d, depth[pred])
+      if weight(i):
+        d += 1
+      depth[i] = d
+      if i in ids:
+        parts.setdefault(d, []).append(graph.node(i))
+    return [parts[d] for d in sorted(parts)]
+
   def collect_resources(self, r0s, r1):
     """
     Replace an iterable of resources with one new resource.
 
-    May break the acyclic invariant, caveat emptor.
+    Raises CycleError if that would break the acyclic invariant,
+    in which case the graph is left in an inconsistent state.
     """
 
     # The invariant is kept iff the r0s don't have paths linking them.
@@ -352,13 +1007,21 @@ class ResourceGraph(yaml.YAMLObject):
 
     if r1 in self._graph:
       raise ValueError(r1)
-    r1 = self._add_aggregate(r1)
+    # Put in the order before the first of the r0s.
+    first = None
+    for r0 in r0s:
+      r0 = self._intern(r0)
+      if first is None or self.__order.precedes(
+          self._graph.node_id(r0), self._graph.node_id(first)):
+        first = r0
+    r1 = self._add_aggregate(r1, before=first)
 
+    self.__members[r1] = list(r0s)
     for r0 in r0s:
       r0 = self._intern(r0)
       self._move_edges(r0, r1)
-      self.__processed.add(r0)
-    self.require_acyclic()
+      self.__mark_processed(r0)
+      self.__replaced[r0] = (r1, r1)
 
   def _move_edges(self, n0, n1):
     if n0 == n1:
@@ -369,25 +1032,29 @@ class ResourceGraph(yaml.YAMLObject):
     # add after delete in case of same.
     for pred in list(self._graph.predecessors_iter(n0)):
       self._graph.delete_edge(pred, n0)
-      self._graph.add_edge(pred, n1)
+      self.__add_graph_edge(pred, n1)
     for succ in list(self._graph.successors_iter(n0)):
       self._graph.delete_edge(n0, succ)
-      self._graph.add_edge(n1, succ)
-    self._graph.delete_node(n0)
-    # Can't undo. Invariant will stay broken.
+      self.__add_graph_edge(n1, succ)
+    self.__delete_graph_node(n0)
+    # Can't undo. If a CycleError was raised, the graph stays inconsistent.
 
   def _split_node(self, res):
     res = self._intern(res)
-    before = self._add_node(BeforeExpandableNode(res))
-    after = self._add_node(AfterExpandableNode(res))
-    self._graph.add_edge(before, after)
+    before = self._add_node(BeforeExpandableNode(res), before=res)
+    after = self._add_node(AfterExpandableNode(res), before=res)
+    # The sentinels go away with res.
+    self.__owned[self.__owner].difference_update((before, after))
+    self.__owned.setdefault(res, set()).update((before, after))
+    self.__replaced[res] = (before, after)
+    self.__add_graph_edge(before, after)
     for pred in list(self._graph.predecessors_iter(res)):
       self._graph.delete_edge(pred, res)
-      self._graph.add_edge(pred, before)
+      self.__add_graph_edge(pred, before)
     for succ in list(self._graph.successors_iter(res)):
       self._graph.delete_edge(res, succ)
-      self._graph.add_edge(after, succ)
-    self._graph.delete_node(res)
+      self.__add_graph_edge(after, succ)
+    self.__delete_graph_node(res)
     return before, after
 
   def _receive_by_ref(self, name, ref):
@@ -406,6 +1073,209 @@ class ResourceGraph(yaml.YAMLObject):
 
     subgraph._receive_by_ref(name, ref)
 
+  @synchronized
+  def remove_resource(self, res):
+    """
+    Remove a resource of the top graph, and what it expanded into.
+
+    Resources its expansion put in the top graph with add_to_top stay;
+    so do aggregates that were also collected from other resources.
+    Raises RuntimeError if a resource that stays has an attribute
+    referring to one that goes.
+    Returns the transitions that were removed.
+    """
+
+    if self.__owner is not None:
+      raise RuntimeError('Only the top graph removes resources')
+    if self.__expandables.get(res.identity) != res:
+      raise KeyError(res)
+    res = self.__expandables[res.identity]
+    if res not in self.__owned.get(None, ()):
+      raise ValueError('Not a top resource', res)
+
+    doomed = self.__expansion_closure([res])
+    for other in self.__expandables.itervalues():
+      if other in doomed:
+        continue
+      for (name, ref) in other.iter_passed_by_ref():
+        if ref is not None and ref.unref in doomed:
+          raise RuntimeError('Still referenced', res, other)
+    return self.__remove(doomed)
+
+  @synchronized
+  def restrict_to(self, nodes):
+    """
+    Remove the nodes of the top graph that aren't in nodes,
+    and what they expanded into.
+
+    nodes should be a union of top_components,
+    or a dependency_closure.
+    """
+
+    if self.__owner is not None:
+      raise RuntimeError('Only the top graph removes resources')
+    kept = set(nodes)
+    kept.update((self._first, self._last))
+    roots = [node for node in self.__owned.get(None, ())
+        if node not in kept]
+    return self.__remove(self.__expansion_closure(roots))
+
+  def __expansion_closure(self, roots):
+    # roots, what they expanded into,
+    # and the aggregates collected only from those.
+    doomed = self.__owned_closure(roots)
+    aggregates = [agg for (agg, members) in self.__members.iteritems()
+        if agg not in doomed and doomed.issuperset(members)]
+    doomed.update(self.__owned_closure(aggregates))
+    return doomed
+
+  def __remove(self, doomed, find_refs=True):
+    if self.__layer is not None and find_refs:
+      raise RuntimeError('Can\'t remove resources while a layer is open')
+    if find_refs:
+      # What's left are the references handed out by add_resource.
+      doomed.update(node for node in self._graph.nodes_iter()
+          if isinstance(node, ResourceRef) and node.unref in doomed)
+
+    removed = []
+    for node in doomed:
+      if node in self._graph:
+        if isinstance(node, Transition):
+          removed.append(node)
+        self.__delete_graph_node(node)
+      self.__processed.discard(node)
+      self.__replaced.pop(node, None)
+      self.__owned.pop(node, None)
+      self.__members.pop(node, None)
+      self.__shared.discard(node)
+      if isinstance(node, ResourceBase) \
+          and self.__expandables.get(node.identity) is node:
+        del self.__expandables[node.identity]
+    self.__owned[None].difference_update(doomed)
+    return removed
+
+  def top_components(self):
+    """
+    Split the nodes of the top graph into weakly connected components.
+
+    Resources are also connected to the resources their attributes
+    refer to. Components are sorted by the position of their first node.
+    """
+
+    graph = self._graph
+    top = [node for node in self.sorted_nodes()
+        if node not in (self._first, self._last)]
+    # Union-find
+    parent = dict((node, node) for node in top)
+    def find(node):
+      while parent[node] is not node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+      return node
+    def union(node0, node1):
+      parent[find(node0)] = find(node1)
+    for node in top:
+      for succ in graph.successors_iter(node):
+        if succ in parent:
+          union(node, succ)
+      if isinstance(node, ResourceBase):
+        for (name, ref) in node.iter_passed_by_ref():
+          if ref is not None and ref in parent:
+            union(node, ref)
+
+    components = {}
+    order = []
+    for node in top:
+      root = find(node)
+      if root not in components:
+        components[root] = []
+        order.append(root)
+      components[root].append(node)
+    return [components[root] for root in order]
+
+  def select(self, selectors):
+    """
+    The resources, at any depth, that one of selectors matches.
+    """
+
+    return [res for res in self.__top.__expandables.itervalues()
+        if self.__matches(selectors, res)]
+
+  def __matches(self, selectors, res):
+    tags = self.__tags.get(res.identity, ())
+    for selector in selectors:
+      if selector.matches(res, tags):
+        return True
+    return False
+
+  def dependency_closure(self, nodes):
+    """
+    nodes, what they come after, and what their attributes refer to,
+    recursively. Sentinels are left out.
+
+    With top nodes that weren't processed, it can be given to
+    restrict_to.
+    """
+
+    closure = set()
+    stack = list(nodes)
+    while stack:
+      node = stack.pop()
+      if node in closure or node in (self._first, self._last):
+        continue
+      closure.add(node)
+      stack.extend(self._graph.predecessors_iter(node))
+      if isinstance(node, ResourceBase):
+        for (name, ref) in node.iter_passed_by_ref():
+          if ref is not None:
+            stack.append(ref)
+    return closure
+
+  def before(self, resources):
+    """
+    The nodes that come before the end of one of resources, ends included:
+    what resources expanded or were collected into, what was passed
+    to them, and what they depend on.
+    """
+
+    graph = self._graph
+    ids = set()
+    stack = [graph.node_id(self.__ends(res)[1]) for res in resources]
+    while stack:
+      i = stack.pop()
+      if i in ids:
+        continue
+      ids.add(i)
+      stack.extend(graph.predecessor_ids(i))
+    return set(graph.node(i) for i in ids)
+
+  def shared_resources(self):
+    """
+    The resources that expansions put in the top graph with add_to_top.
+    """
+
+    return list(self.__shared)
+
+  def transitions_of(self, resources):
+    """
+    The transitions resources expanded into,
+    including those of aggregates collected only from them.
+    """
+
+    return [node for node in self.__expansion_closure(resources)
+        if isinstance(node, Transition) and node in self._graph]
+
+  def __owned_closure(self, roots):
+    # roots, and what was added by expanding them, recursively.
+    closure = set(roots)
+    stack = list(roots)
+    while stack:
+      for node in self.__owned.get(stack.pop(), ()):
+        if node not in closure:
+          closure.add(node)
+          stack.append(node)
+    return closure
+
   def expand_resource(self, res):
     """
     Replace res by a small resource graph.
@@ -414,60 +1284,194 @@ class ResourceGraph(yaml.YAMLObject):
     between the sentinels that represent the resource.
     """
 
+    self.expand_resources((res, ))
+
+  def expand_resources(self, resources, jobs=1, memo=None):
+    """
+    Expand several resources, as with expand_resource.
+
+    Each resource expands into a scope that writes directly
+    into this graph. Up to jobs expand_into calls run concurrently;
+    scopes take a shared lock when they modify the graph, and take
+    turns in the order of resources, so that the graph comes out
+    the same as when expanding one resource after the other.
+    Resources of pure types go through memo, a
+    systems.expansionmemo.ExpansionMemo, if given.
+    """
+
+    scopes = [self.__open_scope(res) for res in resources]
+    turns = _Turns()
+    if jobs > 1:
+      for (turn, scope) in enumerate(scopes):
+        scope._turn = (turns, turn)
+    def expand(item):
+      turn, scope = item
+      owner = scope.__owner
+      try:
+        if memo is not None and isinstance(owner, EResource) \
+            and owner.rtype.pure:
+          memo.expand(owner, scope)
+        else:
+          owner.expand_into(scope)
+      finally:
+        scope._turn = None
+        turns.finish(turn)
+    parallel_map(expand, enumerate(scopes), jobs)
+
+  def skip_resource(self, res):
+    """
+    Mark a resource processed, without expanding or collecting it.
+
+    What depends on it still comes after what it depends on.
+    """
+
+    self.__open_scope(res, (EResource, CResource))
+
+  def __open_scope(self, res, types=(EResource, Aggregate)):
     res = self._intern(res)
 
     # We're processing from the outside in.
     if res in self.__processed:
       raise RuntimeError
+    if not isinstance(res, types):
+      raise TypeError(res)
 
-    resource_graph = ResourceGraph(self.__top)
-    if isinstance(res, EResource):
+    before, after = self._split_node(res)
+    self.__mark_processed(res)
+    scope = self.__scope(res, before, after)
+    if isinstance(res, ResourceBase):
       for (name, ref) in res.iter_passed_by_ref():
-        # ref will be present in both graphs.
-        self._pass_by_ref(resource_graph, name, ref)
-    elif isinstance(res, Aggregate):
-      pass
-    else:
-      raise TypeError(res)
-    res.expand_into(resource_graph)
-    # We expand from the outside in
-    if bool(resource_graph.__processed):
-      raise RuntimeError
+        # What may break the invariant, raising CycleError:
+        # Passing a ref to res, and making res depend on ref.
+        # ref ends up on both sides of ref.before.
+        self._pass_by_ref(scope, name, ref)
+    return scope
 
-    # Do not skip sentinels.
-    for n in resource_graph._graph.nodes_iter():
-      self._add_node(n)
-    for (n0, n1) in resource_graph._graph.edges_iter():
-      self._add_node_dep(n0, n1)
-
-    for (id1, res1) in resource_graph.__expandables.iteritems():
-      # We expand from the outside in.
-      assert res1 not in self.__processed
-      if id1 in self.__expandables:
-        # Pass by reference if you must use the same resource
-        # in different contexts.
-        raise RuntimeError('ResourceBase collision.', res, res1)
-      else:
-        self.__expandables[id1] = res1
 
-    before, after = self._split_node(res)
-    self.__processed.add(res)
-    self._move_edges(resource_graph._first, before)
-    self._move_edges(resource_graph._last, after)
-    # What may break the invariant:
-    # Passing a ref to res, and making res depend on ref.
-    # ref ends up on both sides of ref.before.
-    self.require_acyclic()
+class _Layer(object):
+  # What was added since push_layer.
+
+  def __init__(self):
+    # Nodes, in the order they were added, and as a set.
+    self.nodes = []
+    self.members = set()
+    # Edges between nodes that were there before.
+    self.edges = []
+
+
+def deal_components(components, count):
+  """
+  Deal components into count shards of about the same size.
+
+  Returns a list of count lists of nodes. The largest components
+  are dealt first, each to the smallest shard so far.
+  """
+
+  shards = [[] for i in xrange(count)]
+  by_size = sorted(enumerate(components),
+      key=lambda pair: (-len(pair[1]), pair[0]))
+  for (i, comp) in by_size:
+    smallest = min(xrange(count), key=lambda j: (len(shards[j]), j))
+    shards[smallest].extend(comp)
+  return shards
 
 
 class Realizer(object):
   """
   A graph of realizables linked by dependencies.
+
+  Once frozen or realized, top resources may still be added or removed;
+  the graph is then 'thawed' until the next freeze, which only processes
+  what is new. Realizing again only realizes new transitions, and
+  those that come after new ones.
   """
 
-  def __init__(self, expandable):
-    self.__resources = ResourceGraph()
+  def __init__(self, expandable, expand_jobs=1, graph_backend='native',
+      plan_cache=None, manifest_key=None,
+      state_store=None, force_verify=False, shard=None, select=None,
+      journal=None, resume=False, expansion_memo=None, lock_manager=None,
+      probes=None, aggregate_lock=None):
+    """
+    expand_jobs is how many resources of an expansion wave
+    may be expanded concurrently. Expansion reads system state,
+    which is I/O bound; the graph comes out the same whatever
+    the number of jobs.
+
+    graph_backend is passed to ResourceGraph.
+
+    plan_cache is a systems.plancache.PlanCache; if set, manifest_key
+    is a string that changes whenever the manifest might expand
+    differently, and freezing is skipped when a plan is cached for it
+    and the system state expansions read still reads the same.
+
+    state_store is a systems.statestore.StateStore. Resources it knows
+    to be converged are skipped, unless force_verify is set;
+    after realization, converged resources are recorded in it.
+    Plans missing skipped resources aren't put in plan_cache.
+
+    shard is an (index, count) pair: the components of the expanded
+    manifest are dealt into count shards, and only those of shard index
+    are kept. See systems.shards.
+
+    select is a list of systems.selector.Selector. Only the resources
+    they match, and what those depend on, are realized. When some
+    top resources match, the others are dropped before expansion;
+    otherwise everything is expanded, and matched at any depth.
+
+    journal is a systems.journal.Journal, in which realized transitions
+    are recorded; the first realization starts it, later ones append.
+    If resume is set, the first realization skips the transitions
+    the journal recorded instead; the plan frozen again must be
+    the same as the one the journal recorded last.
+
+    expansion_memo is a systems.expansionmemo.ExpansionMemo, through
+    which resources of pure types are expanded; it is saved once
+    frozen.
+
+    lock_manager is a systems.locks.LockManager. While realizing,
+    the resources that own transitions to realize are locked
+    exclusively, the resources those transitions come after shared,
+    so that runs on the same host only wait for each other when they
+    overlap. A plan loaded without its graph only takes the former.
+
+    probes is a systems.probes.Probes, through which expansions read
+    system state while freezing: the probes resource types register
+    are run ahead of each expansion wave, concurrently, and answers
+    are kept until something is realized. See preview.
+
+    aggregate_lock is a lock, systems.locks.HostLock for example,
+    held while realizing each transition of an aggregate; realizers
+    sharing a host (the shards of systems.shards) take turns running
+    the commands of aggregates, which may take a system-wide lock.
+    """
+
+    if plan_cache is not None and manifest_key is None:
+      raise ValueError('A manifest_key is needed to cache plans')
+
+    self.__resources = ResourceGraph(graph_backend)
     self.__expandable = expandable
+    self.__expand_jobs = expand_jobs
+    self.__plan = None
+    self.__plan_cache = plan_cache
+    self.__manifest_key = manifest_key
+    self.__state_store = state_store
+    self.__expansion_memo = expansion_memo
+    self.__lock_manager = lock_manager
+    self.__probes = probes
+    self.__aggregate_lock = aggregate_lock
+    self.__force_verify = force_verify
+    self.__shard = shard
+    self.__select = select
+    # The plan before push_layer, while a layer is open.
+    self.__layer_base = None
+    self.__journal = journal
+    self.__resume = resume and journal is not None
+    # The nodes select keeps, once frozen.
+    self.__selected = None
+    self.__skipped = 0
+    self.__plan_cached = False
+    # Called between freezing steps, see realize.
+    self.__on_step = None
     self.__state = 'init'
 
   def require_state(self, state):
@@ -482,86 +1486,206 @@ class Realizer(object):
     """
     Build the finished dependency graph.
 
-    Merge identical realizables, collect what can be.
+    Merge identical realizables, collect what can be,
+    then compact the graph into a Plan.
     """
 
     if self.__state == 'frozen':
       return
-    # Order is important
-    self.require_state('init')
+    if self.__probes is None:
+      self.__freeze()
+      return
+    probes = self.__probes
+    count0, hits0, elapsed0 = probes.count, probes.hits, probes.elapsed
+    with probes:
+      self.__freeze()
+    if probes.count != count0 or probes.hits != hits0:
+      LOGGER.info('Probed %d times in %.2fs, %d answers reused',
+          probes.count - count0, probes.elapsed - elapsed0,
+          probes.hits - hits0)
+
+  def __freeze(self):
+    if self.__state == 'thawed':
+      # The manifest was expanded already, the worklist has the rest.
+      self.__build_plan()
+    elif self.__plan_cache is None:
+      self.require_state('init')
+      self.__expand_manifest()
+      self.__build_plan()
+    else:
+      self.require_state('init')
+      manifest_key = self.__manifest_key
+      if self.__shard is not None:
+        manifest_key += '\0shard %d/%d' % self.__shard
+      if self.__select:
+        manifest_key += '\0select ' + ' '.join(
+            sorted(str(sel) for sel in self.__select))
+      cache_key = self.__plan_cache.key(manifest_key)
+      self.__plan = self.__plan_cache.load(cache_key)
+      if self.__plan is not None:
+        self.__plan_cached = True
+        self.__state = 'frozen'
+        return
+      # The plan only holds while what expansions read does.
+      reads = StateReads()
+      with reads:
+        self.__expand_manifest()
+        self.__build_plan()
+      if not self.__skipped:
+        self.__plan_cache.store(cache_key, self.__plan, reads)
+    self.__state = 'frozen'
+    #self.__resources.draw('/tmp/frozen')
+
+  def __expand_manifest(self):
     self.__expandable.expand_into(self.__resources)
+    if self.__shard is not None:
+      index, count = self.__shard
+      self.__resources.restrict_to(
+          deal_components(self.__resources.top_components(), count)[index])
+    if self.__select:
+      matched = self.__resources.select(self.__select)
+      if matched:
+        self.__resources.restrict_to(
+            self.__resources.dependency_closure(matched))
+
+  def __build_plan(self):
+    # Order is important
     #self.__resources.draw('/tmp/freezing')
     self._expand()
+    if self.__expansion_memo is not None:
+      self.__expansion_memo.save()
     #self.__resources.draw('/tmp/pre-collect')
     self._collect()
     self._expand_aggregates()
     assert not bool(list(self.__resources.iter_unprocessed()))
+    if self.__skipped:
+      LOGGER.info('Skipped %d converged resources', self.__skipped)
+    if self.__layer_base is not None:
+      self.__plan = self.__resources.compact_layer(self.__layer_base)
+    else:
+      self.__plan = self.__resources.compact()
+    if self.__select:
+      matched = self.__resources.select(self.__select)
+      if not matched:
+        raise ValueError('Nothing matches the selection',
+            [str(sel) for sel in self.__select])
+      self.__selected = self.__resources.before(matched)
+      self.__plan = self.__plan.restricted(self.__selected)
+
+  def __thaw(self):
+    if self.__plan_cached:
+      raise RuntimeError('The plan was loaded from cache, without its graph')
+    if self.__state in ('frozen', 'realized'):
+      self.__state = 'thawed'
+    elif self.__state not in ('init', 'thawed'):
+      raise RuntimeError(self.__state)
+
+  def add_resource(self, res, depends=(), tags=()):
+    """
+    Add a resource to the top graph, return a reference to it.
+    """
+
+    self.__thaw()
+    return self.__resources.add_resource(res, depends, tags)
+
+  def remove_resource(self, res):
+    """
+    Remove a top resource, and what it expanded into.
+
+    See ResourceGraph.remove_resource.
+    """
+
+    self.__thaw()
+    self.__resources.remove_resource(res)
+
+  def push_layer(self, expandable):
+    """
+    Add what expandable expands into on top of what is frozen,
+    so that pop_layer can take it away. The plan is then that of both.
+
+    Freezing the base once, then pushing and popping layers, plans
+    many variants of a system (hosts sharing most of their manifest)
+    at about the cost of what they don't share. Resources that are
+    in the base, added to the top with add_to_top for example,
+    are the base's.
+    """
+
+    self.ensure_frozen()
+    if self.__layer_base is not None:
+      raise RuntimeError('A layer is open already')
+    self.__thaw()
+    self.__resources.push_layer()
+    self.__layer_base = self.__plan
+    expandable.expand_into(self.__resources)
+
+  def pop_layer(self):
+    """
+    Remove what push_layer added, and go back to the plan before it.
+    """
+
+    if self.__layer_base is None:
+      raise RuntimeError('No layer is open')
+    self.__resources.pop_layer()
+    self.__plan = self.__layer_base
+    self.__layer_base = None
     self.__state = 'frozen'
-    #self.__resources.draw('/tmp/frozen')
+
+  def _skip_converged(self, resources):
+    # Skip resources the state store knows are converged,
+    # return the rest.
+    if self.__state_store is None or self.__force_verify:
+      return resources
+    rest = []
+    for res in resources:
+      if self.__state_store.is_converged(res):
+        self.__resources.skip_resource(res)
+        self.__skipped += 1
+      else:
+        rest.append(res)
+    return rest
 
   def _collect(self):
     # Collects compatible nodes into merged nodes.
-
-    def can_merge(part0, part1):
-      for n0 in part0:
-        for n1 in part1:
-          if self.__resources.resources_connected(n0, n1):
-            return False
-      return True
-
-    def possibly_merge(partition):
-      # Merge once if possible. Return true if did merge.
-      e = dict(enumerate(partition))
-      n = len(partition)
-      # Loop over the triangle of unordered pairs
-      for i in xrange(n):
-        for j in xrange(i + 1, n):
-          part0, part1 = e[i], e[j]
-          if can_merge(part0, part1):
-            partition.add(part0.union(part1))
-            partition.remove(part0)
-            partition.remove(part1)
-            return True
-      return False
-
+    self._skip_converged(list(self.__resources.iter_uncollected_resources()))
     reg = get_registry()
     for collector in reg.collectors:
       # Pre-partition is made of parts acceptable for the collector.
       pre_partition = collector.partition(
-          [r for r in self.__resources.iter_uncollected_resources()
+          [r for r in self.__resources.iter_uncollected_resources(
+            collector.accepts)
             if collector.filter(r)])
       for part in pre_partition:
-        # Collector parts are split again, the sub-parts are merged
-        # when dependencies allow.
-        # Not a particularly efficient algorithm, just simple.
-        # Gives one solution among many possibilities.
-        partition = set(frozenset((r, ))
-            for r in part
-            for part in pre_partition)
-        while possibly_merge(partition):
-          pass
+        # Collector parts are split again into antichains,
+        # which dependencies allow to merge.
+        partition = self.__resources.antichain_partition(
+            part, collector.objective)
 
         # Let the collector handle the rest
         for part in partition:
-          if not bool(part):
-            # Test for emptiness.
-            # Aggregate even singletons.
-            continue
+          # Aggregate even singletons.
           merged = collector.collect(part)
           self.__resources.collect_resources(part, merged)
+      self.__step()
     assert not bool(list(self.__resources.iter_uncollected_resources()))
 
   def _expand(self):
     # Poor man's recursion
     while True:
-      fresh = set(r
-          for r in self.__resources.iter_unexpanded_resources())
+      self.__step()
+      fresh = list(self.__resources.iter_unexpanded_resources())
       if bool(fresh) == False: # Test for emptiness
         break
-      for r in fresh:
-        self.__resources.expand_resource(r)
+      fresh = self._skip_converged(fresh)
+      if self.__probes is not None:
+        self.__probes.prefetch(fresh)
+      self.__resources.expand_resources(
+          fresh, self.__expand_jobs, self.__expansion_memo)
     assert not bool(list(self.__resources.iter_unexpanded_resources()))
 
+  def __step(self):
+    if self.__on_step is not None:
+      self.__on_step()
+
   def _expand_aggregates(self):
     for a in list(self.__resources.iter_unexpanded_aggregates()):
       self.__resources.expand_resource(a)
@@ -570,14 +1694,219 @@ class Realizer(object):
     if self.__resources.has_unprocessed():
       raise RuntimeError(list(self.__resources.iter_unprocessed()))
 
-  def realize(self):
+  def shared_resources(self):
+    """
+    The resources that expansions put at the top with add_to_top.
+    """
+
+    self.ensure_frozen()
+    return self.__resources.shared_resources()
+
+  def realize(self, jobs=None, engine='threads', realized_elsewhere=(),
+      pipelined=False, keep_going=False):
     """
     Realize all realizables and transitions in dependency order.
+
+    jobs is the number of transitions that may be realized at once;
+    by default 1 with the threads engine, and the default of
+    systems.reactor.Reactor with the events engine.
+    engine is 'threads', for a thread per running transition,
+    or 'events', to wait for commands on a single event loop
+    (see systems.reactor).
+    realized_elsewhere are resources whose transitions
+    are left alone, because another process realized them.
+    Returns the number of transitions realized.
+
+    If keep_going is set, a failed transition doesn't stop those that
+    don't come after it; systems.executor.TransitionsFailed is raised
+    at the end, with what failed and what was skipped.
+
+    If pipelined is set, transitions are started while the graph is
+    being frozen, as soon as they are settled (see
+    ResourceGraph.settled_transitions). Expansions may then probe
+    the system while transitions change it. Only a Realizer that
+    wasn't frozen yet can be pipelined, with the threads engine,
+    and without select (what is selected is only known once frozen),
+    locks (likewise) nor probes (answers wouldn't hold).
     """
 
+    if jobs is None and engine != 'events':
+      jobs = 1
+    if pipelined:
+      if engine != 'threads' or realized_elsewhere or self.__select \
+          or self.__journal is not None or self.__lock_manager is not None \
+          or self.__aggregate_lock is not None or self.__probes is not None:
+        raise ValueError('Pipelining needs the threads engine, '
+            'and no selection, journal, locks nor probes')
+      return self.__realize_pipelined(jobs, keep_going)
     self.ensure_frozen()
-    for t in self.__resources.sorted_transitions():
-      t.realize()
+    on_done = None
+    guard = None
+    if self.__aggregate_lock is not None:
+      guard = self.__aggregate_guard()
+    if self.__journal is not None:
+      if self.__resume:
+        self.__resume = False
+        self.__journal.resume(self.__plan)
+      else:
+        self.__journal.start(self.__plan)
+      on_done = self.__journal.record
+    if engine == 'threads':
+      executor = Executor(jobs, on_done, keep_going, guard)
+    elif engine == 'events':
+      if jobs is None:
+        executor = Reactor(on_done=on_done, keep_going=keep_going,
+            guard=guard)
+      else:
+        executor = Reactor(jobs, on_done=on_done, keep_going=keep_going,
+            guard=guard)
+    else:
+      raise ValueError(engine)
+    todo, depends = self.__todo(realized_elsewhere)
+    for t in todo:
+      t.invalidate()
+    locks = None
+    if self.__lock_manager is not None:
+      locks = self.__lock_manager.acquire(*self.__lock_names(todo))
+    try:
+      executor.run(todo, depends)
+    finally:
+      if locks is not None:
+        locks.release()
+      if self.__probes is not None:
+        self.__probes.clear()
+      if self.__journal is not None:
+        self.__journal.sync()
     self.__state = 'realized'
+    if self.__state_store is not None:
+      self.__state_store.record(
+          self.__resources.iter_processed_resources(self.__selected))
+    return len(todo)
+
+  def __todo(self, realized_elsewhere):
+    # Transitions not realized yet, and those after them,
+    # in case they read what the new ones change.
+    todo = []
+    stale = set()
+    depends = {}
+    elsewhere = set(self.__resources.transitions_of(realized_elsewhere))
+    for t in self.__plan.transitions:
+      if t in elsewhere:
+        continue
+      preds = [pred for pred in self.__plan.depends[t] if pred in stale]
+      if preds or not t.is_realized:
+        todo.append(t)
+        stale.add(t)
+        depends[t] = preds
+    return todo, depends
+
+  def preview(self, realized_elsewhere=()):
+    """
+    The transitions realize would run, in order, without running them.
+
+    Only probes run; with probes set, their answers are kept
+    for the realize that follows.
+    """
+
+    if self.__state != 'realized':
+      self.ensure_frozen()
+    return self.__todo(realized_elsewhere)[0]
+
+  def __aggregate_guard(self):
+    # Maps the transitions of aggregates to aggregate_lock.
+    owners = self.__plan.owners
+    lock = self.__aggregate_lock
+    def guard(t):
+      if t in owners and is_aggregate_name(owners[t]):
+        return lock
+      return None
+    return guard
+
+  def __lock_names(self, todo):
+    # Names of resources to lock: exclusively those that own
+    # transitions to realize, shared those the transitions come after.
+    owners = self.__plan.owners
+    exclusive = set(owners[t] for t in todo if t in owners)
+    shared = set()
+    if not self.__plan_cached:
+      before = self.__resources.dependency_closure(todo)
+      for res in self.__resources.iter_processed_resources(before):
+        name = owner_name(res)
+        if name not in exclusive:
+          shared.add(name)
+    return exclusive, shared
+
+  def __realize_pipelined(self, jobs, keep_going):
+    self.require_state('init')
+    executor = Executor(jobs, keep_going=keep_going)
+    submitted = set()
+    def submit(transitions, depends):
+      fresh = [t for t in transitions if t not in submitted]
+      submitted.update(fresh)
+      executor.submit(fresh, depends)
+    def on_step():
+      if executor.failed:
+        # Raises the failure, once running transitions are done.
+        executor.wait()
+      submit(*self.__resources.settled_transitions())
+
+    executor.start()
+    try:
+      self.__on_step = on_step
+      try:
+        self.ensure_frozen()
+      finally:
+        self.__on_step = None
+      LOGGER.debug('Frozen, %d transitions were started early',
+          len(submitted))
+      submit(self.__plan.transitions, self.__plan.depends)
+      executor.wait()
+    finally:
+      executor.stop()
+    self.__state = 'realized'
+    if self.__state_store is not None:
+      self.__state_store.record(
+          self.__resources.iter_processed_resources(self.__selected))
+    return len(submitted)
+
+  @property
+  def plan(self):
+    if self.__state != 'realized':
+      self.ensure_frozen()
+    return self.__plan
+
+  def draw(self, fname):
+    """
+    Draw the transitions left after compaction.
+    """
+
+    self.plan.draw(fname)
+
+  def select(self, selectors):
+    """
+    The resources of the frozen graph, at any depth,
+    that one of selectors matches.
+    """
+
+    self.ensure_frozen()
+    if self.__plan_cached:
+      raise RuntimeError('The plan was loaded from cache, without its graph')
+    return self.__resources.select(selectors)
+
+  def export(self, f, format='dot', **filters):
+    """
+    Write the frozen graph, as ResourceGraph.export does.
+
+    Without filters, a plan loaded from cache is written instead.
+    """
+
+    self.ensure_frozen()
+    if self.__plan_cached:
+      if filters:
+        raise RuntimeError(
+            'The plan was loaded from cache, without its graph')
+      self.__plan.export(f, format)
+      return
+    self.__resources.export(f, format, **filters)
 
 
@@ -0,0 +1,245 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import heapq
+import sys
+import threading
+import Queue
+from logging import getLogger
+
+__all__ = ('Executor', 'TransitionsFailed', )
+
+
+LOGGER = getLogger(__name__)
+
+
+class TransitionsFailed(RuntimeError):
+  """
+  Transitions failed, and the others were realized where possible.
+
+  failures is a list of (transition, exc_info) pairs, skipped
+  the transitions that came after a failed one; both in the given order.
+  """
+
+  def __init__(self, failures, skipped):
+    RuntimeError.__init__(self, [t for (t, exc_info) in failures])
+    self.failures = failures
+    self.skipped = skipped
+
+  @classmethod
+  def raise_failures(cls, failures, transitions, finished, keep_going):
+    # failures are (position, exc_info) pairs.
+    failures.sort()
+    if not keep_going:
+      exc_type, exc_value, exc_tb = failures[0][1]
+      raise exc_type, exc_value, exc_tb
+    failed = [(transitions[pos], exc_info) for (pos, exc_info) in failures]
+    bad = set(t for (t, exc_info) in failed)
+    skipped = [t for t in transitions
+        if t not in finished and t not in bad]
+    LOGGER.error('%d transitions failed, %d were skipped',
+        len(failed), len(skipped))
+    raise cls(failed, skipped)
+
+
+def realize_guarded(t, guard):
+  """
+  Realize t, holding the lock guard maps it to, if any.
+  """
+
+  lock = None
+  if guard is not None:
+    lock = guard(t)
+  if lock is None:
+    t.realize()
+  else:
+    with lock:
+      t.realize()
+
+
+class Executor(object):
+  """
+  Realizes transitions in dependency order.
+
+  A transition is started as soon as all the transitions it depends on
+  are done, on a pool of worker threads.
+
+  When a transition fails, no new transition is started,
+  the running ones are waited for, and the failure of the transition
+  that comes first in the given order is raised.
+  With keep_going, only what comes after failed transitions
+  isn't started, and TransitionsFailed is raised once the rest is done.
+
+  Besides run, transitions can be fed while others are realized:
+  start, then submit batches, then wait.
+  """
+
+  def __init__(self, jobs=1, on_done=None, keep_going=False, guard=None):
+    """
+    on_done is called with every transition realized successfully,
+    one at a time.
+    guard maps a transition to a lock (used in a with statement)
+    to hold while realizing it, or None.
+    """
+
+    if jobs < 1:
+      raise ValueError(jobs)
+    self.__jobs = jobs
+    self.__on_done = on_done
+    self.__keep_going = keep_going
+    self.__guard = guard
+
+  def run(self, transitions, depends):
+    """
+    Realize transitions.
+
+    transitions is a sequence in topological order,
+    depends maps a transition to the transitions it must wait for.
+    """
+
+    if self.__jobs == 1:
+      # No threads needed, the order is already right.
+      self.__run_serially(transitions, depends)
+      return
+
+    self.start(min(self.__jobs, len(transitions)))
+    try:
+      self.submit(transitions, depends)
+      self.wait()
+    finally:
+      self.stop()
+
+  def __run_serially(self, transitions, depends):
+    failures = []
+    finished = set()
+    # Failed and skipped transitions.
+    bad = set()
+    for (pos, t) in enumerate(transitions):
+      for pred in depends.get(t, ()):
+        if pred in bad:
+          bad.add(t)
+          break
+      if t in bad:
+        continue
+      try:
+        realize_guarded(t, self.__guard)
+      except:
+        if not self.__keep_going:
+          raise
+        LOGGER.error('Transition failed: %s', t)
+        failures.append((pos, sys.exc_info()))
+        bad.add(t)
+        continue
+      finished.add(t)
+      if self.__on_done is not None:
+        self.__on_done(t)
+    if failures:
+      TransitionsFailed.raise_failures(
+          failures, list(transitions), finished, True)
+
+  def start(self, threads=None):
+    """
+    Start the worker threads, jobs of them by default.
+    """
+
+    if threads is None:
+      threads = self.__jobs
+    # Guards the scheduling state; workers update it as they finish.
+    self.__cond = threading.Condition()
+    self.__position = {}
+    self.__waiting = {}
+    self.__dependents = {}
+    self.__finished = set()
+    self.__ready = []
+    self.__transitions = []
+    self.__failures = []
+    self.__running = 0
+    self.__jobs_queue = Queue.Queue()
+    self.__workers = [threading.Thread(target=self.__work)
+        for i in xrange(threads)]
+    for worker in self.__workers:
+      worker.start()
+
+  def stop(self):
+    for worker in self.__workers:
+      self.__jobs_queue.put(None)
+    for worker in self.__workers:
+      worker.join()
+
+  @property
+  def failed(self):
+    """
+    Whether a transition failed, and nothing new is started.
+    """
+
+    return bool(self.__failures) and not self.__keep_going
+
+  def submit(self, transitions, depends):
+    """
+    Add transitions, in topological order, after those submitted before.
+
+    depends maps a transition to the transitions it must wait for,
+    which are among those submitted, now or before.
+    """
+
+    with self.__cond:
+      for t in transitions:
+        self.__position[t] = len(self.__transitions)
+        self.__transitions.append(t)
+        self.__dependents[t] = []
+        preds = [pred for pred in depends.get(t, ())
+            if pred not in self.__finished]
+        self.__waiting[t] = len(preds)
+        for pred in preds:
+          self.__dependents[pred].append(t)
+        if not preds:
+          heapq.heappush(self.__ready, self.__position[t])
+      self.__dispatch()
+
+  def wait(self):
+    """
+    Wait for all submitted transitions, raise failures as in run.
+    """
+
+    with self.__cond:
+      while self.__running:
+        self.__cond.wait()
+      if self.__failures:
+        TransitionsFailed.raise_failures(self.__failures,
+            self.__transitions, self.__finished, self.__keep_going)
+
+  def __dispatch(self):
+    while self.__ready and self.__running < self.__jobs \
+        and not self.failed:
+      self.__jobs_queue.put(self.__transitions[heapq.heappop(self.__ready)])
+      self.__running += 1
+
+  def __done(self, t, exc_info):
+    with self.__cond:
+      self.__running -= 1
+      if exc_info is not None:
+        LOGGER.error('Transition failed: %s', t)
+        self.__failures.append((self.__position[t], exc_info))
+      else:
+        if self.__on_done is not None:
+          self.__on_done(t)
+        self.__finished.add(t)
+        for succ in self.__dependents[t]:
+          self.__waiting[succ] -= 1
+          if self.__waiting[succ] == 0:
+            heapq.heappush(self.__ready, self.__position[succ])
+      self.__dispatch()
+      self.__cond.notifyAll()
+
+  def __work(self):
+    while True:
+      t = self.__jobs_queue.get()
+      if t is None:
+        return
+      try:
+        realize_guarded(t, self.__guard)
+      except:
+        self.__done(t, sys.exc_info())
+      else:
+        self.__done(t, None)
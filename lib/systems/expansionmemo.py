@@ -0,0 +1,208 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+"""
+Memoizing the expansion of pure resource types.
+
+A resource type declared pure (see ResourceType) expands the same way
+whenever its attributes are the same: its expand_into renders
+templates and adds nodes, but reads no system state.
+The first expansion of such a resource is recorded, as the calls it
+makes on its scope, pickled. Resources of the same type with the same
+attributes then replay the calls instead of running expand_into.
+
+The nodes calls refer to, either references the resource received
+or nodes that earlier calls returned, are pickled as handles;
+replaying substitutes the nodes of the new expansion, so that
+the replayed subgraph is linked the same way.
+
+Saved to a file, the memo is kept until the code changes,
+as with systems.plancache.
+"""
+
+import cPickle as pickle
+import cStringIO
+import hashlib
+import os
+import tempfile
+import threading
+from logging import getLogger
+
+from systems.plancache import code_fingerprint
+
+__all__ = ('ExpansionMemo', )
+
+
+LOGGER = getLogger(__name__)
+
+# Bump when the recorded calls change.
+FORMAT_VERSION = 1
+
+# What an expansion may call on its scope.
+RECORDED_METHODS = ('add_resource', 'add_transition', 'add_checkpoint',
+    'add_to_top', 'make_ref', 'make_alias_ref', 'add_dependency', )
+
+
+def memo_key(res):
+  """
+  The type and attributes of res, hashed.
+
+  References are represented by what they point to.
+  """
+
+  return hashlib.sha1(repr((res.rtype.name,
+    sorted(res.id_attrs.iteritems()),
+    sorted(res.wanted_attrs.iteritems())))).hexdigest()
+
+
+class _Recorder(object):
+  # Stands for a scope; pickles calls as it passes them on.
+
+  def __init__(self, scope, res):
+    self.__scope = scope
+    self.__res = res
+    self.__file = cStringIO.StringIO()
+    self.__pickler = pickle.Pickler(self.__file, pickle.HIGHEST_PROTOCOL)
+    self.__pickler.persistent_id = self.__persistent_id
+    # Handles by id, and the objects, which must stay alive.
+    self.__handles = {}
+    self.__nodes = []
+    for (name, ref) in res.iter_passed_by_ref():
+      self.__add_handle(ref, ('ref', name))
+    self.count = 0
+    self.error = None
+
+  def __add_handle(self, node, handle):
+    self.__handles[id(node)] = handle
+    self.__nodes.append(node)
+
+  def __persistent_id(self, obj):
+    return self.__handles.get(id(obj))
+
+  def __getattr__(self, name):
+    if name not in RECORDED_METHODS:
+      raise AttributeError(
+          'Expansion of pure %s can\'t use %s' % (self.__res.rtype, name))
+    method = getattr(self.__scope, name)
+    def call(*args, **kargs):
+      if self.error is None:
+        try:
+          self.__pickler.dump((name, args, kargs))
+        except (pickle.PicklingError, TypeError), e:
+          # Still expanded, just not memoized.
+          self.error = e
+      node = method(*args, **kargs)
+      self.__add_handle(node, ('result', self.count))
+      self.count += 1
+      return node
+    return call
+
+  @property
+  def data(self):
+    return self.__file.getvalue()
+
+
+class ExpansionMemo(object):
+  """
+  Recorded expansions of pure resources, by type and attributes.
+  """
+
+  def __init__(self, path=None):
+    """
+    path is a file the memo is loaded from, and saved to by save.
+    """
+
+    self.__path = path
+    # (count, data) pairs, by memo_key.
+    self.__expansions = {}
+    self.__code = code_fingerprint()
+    self.__lock = threading.Lock()
+    self.__dirty = False
+    self.hits = 0
+    self.misses = 0
+    if path is not None:
+      self.__load()
+
+  def __load(self):
+    try:
+      f = open(self.__path, 'rb')
+    except IOError:
+      return
+    with f:
+      try:
+        saved = pickle.load(f)
+      except Exception, e:
+        LOGGER.warning('Expansion memo unusable: %s', e)
+        return
+    if saved.get('version') != FORMAT_VERSION \
+        or saved.get('code') != self.__code:
+      LOGGER.debug('Expansion memo is out of date')
+      return
+    self.__expansions = saved['expansions']
+
+  def save(self):
+    """
+    Save the memo to its path, if it has new expansions.
+    """
+
+    if self.__path is None or not self.__dirty:
+      return
+    with self.__lock:
+      data = pickle.dumps({
+        'version': FORMAT_VERSION,
+        'code': self.__code,
+        'expansions': self.__expansions,
+        }, pickle.HIGHEST_PROTOCOL)
+      self.__dirty = False
+    dirname = os.path.dirname(self.__path) or '.'
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    # Written then renamed, so readers never see a partial memo.
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.rename(tmpname, self.__path)
+    except:
+      os.unlink(tmpname)
+      raise
+
+  def expand(self, res, scope):
+    """
+    Expand res into scope, replaying a recorded expansion if there is one.
+    """
+
+    key = memo_key(res)
+    with self.__lock:
+      recorded = self.__expansions.get(key)
+      if recorded is not None:
+        self.hits += 1
+      else:
+        self.misses += 1
+    if recorded is not None:
+      self.__replay(res, scope, *recorded)
+      return
+    recorder = _Recorder(scope, res)
+    res.expand_into(recorder)
+    if recorder.error is not None:
+      LOGGER.info('Expansion of %s not memoized: %s', res, recorder.error)
+      return
+    with self.__lock:
+      self.__expansions[key] = (recorder.count, recorder.data)
+      self.__dirty = True
+
+  @classmethod
+  def __replay(cls, res, scope, count, data):
+    refs = dict(res.iter_passed_by_ref())
+    results = []
+    def persistent_load(handle):
+      kind, arg = handle
+      if kind == 'ref':
+        return refs[arg]
+      return results[arg]
+    unpickler = pickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = persistent_load
+    for i in xrange(count):
+      name, args, kargs = unpickler.load()
+      results.append(getattr(scope, name)(*args, **kargs))
@@ -0,0 +1,90 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Writing graphs as DOT or GraphML, for inspection.
+
+Unlike drawing (ResourceGraph.draw_agraph), nothing is laid out and
+no intermediate graph is built: nodes and edges are written as they
+are iterated, so large graphs and plans export quickly, and without
+graphviz installed. Lay out the result elsewhere, for example with
+C{dot -Tsvg}, or open the GraphML with a graph editor.
+
+Nodes are given as (id, label) pairs, edges as (id, id) pairs of
+nodes given before. collapse merges nodes into groups, given a
+function naming the group of a node id.
+"""
+
+from xml.sax.saxutils import escape
+
+__all__ = ('write_graph', 'collapse', 'FORMATS', )
+
+
+def _dot_quote(s):
+  return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"').replace(
+      '\n', '\\n')
+
+def write_dot(f, nodes, edges):
+  f.write('digraph systems {\n'
+      '  graph [rankdir=TB, nodesep=0.2, ranksep=0.5];\n'
+      '  node [shape=box];\n')
+  for (i, label) in nodes:
+    f.write('  n%s [label=%s];\n' % (i, _dot_quote(label)))
+  for (i0, i1) in edges:
+    f.write('  n%s -> n%s;\n' % (i0, i1))
+  f.write('}\n')
+
+def write_graphml(f, nodes, edges):
+  f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+      '  <key id="label" for="node" attr.name="label" '
+      'attr.type="string"/>\n'
+      '  <graph id="systems" edgedefault="directed">\n')
+  for (i, label) in nodes:
+    f.write('    <node id="n%s"><data key="label">%s</data></node>\n' % (
+      i, escape(label)))
+  for (i0, i1) in edges:
+    f.write('    <edge source="n%s" target="n%s"/>\n' % (i0, i1))
+  f.write('  </graph>\n</graphml>\n')
+
+FORMATS = {
+    'dot': write_dot,
+    'graphml': write_graphml,
+    }
+
+def write_graph(f, nodes, edges, format='dot'):
+  """
+  Write nodes and edges to the file f, in format, 'dot' or 'graphml'.
+  """
+
+  try:
+    writer = FORMATS[format]
+  except KeyError:
+    raise ValueError('Unknown graph format', format)
+  writer(f, nodes, edges)
+
+def collapse(nodes, edges, group):
+  """
+  Merge the nodes of a group into one node, labelled with
+  the name of the group. Returns new nodes and edges.
+
+  Edges within a group go away, edges between groups are merged.
+  """
+
+  groups = {}
+  group_ids = {}
+  def iter_nodes():
+    for (i, label) in nodes:
+      name = group(i)
+      if name not in group_ids:
+        group_ids[name] = len(group_ids)
+        yield (group_ids[name], name)
+      groups[i] = group_ids[name]
+  def iter_edges():
+    seen = set()
+    for (i0, i1) in edges:
+      edge = (groups[i0], groups[i1])
+      if edge[0] != edge[1] and edge not in seen:
+        seen.add(edge)
+        yield edge
+  return iter_nodes(), iter_edges()
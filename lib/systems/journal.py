@@ -0,0 +1,203 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+"""
+A journal of realized transitions, to resume an interrupted run.
+
+The journal is a file of pickles: a header, then for each realization
+the stable ids of the transitions of its plan (see Plan.stable_ids),
+then a record per realized transition, with its stable id and results.
+Transitions themselves aren't pickled; a plan realized in part
+couldn't be. The first realization of a run starts a new journal,
+later ones append to it.
+
+Records are flushed as they are written, which is enough if
+the process dies; they are synced to disk in batches, which is enough
+if the machine does, give or take the last batch.
+
+Resuming checks that the plan frozen again is that of the last
+realization, and gives the transitions recorded since it started their
+results, so that realization continues with those that weren't realized.
+"""
+
+import cPickle as pickle
+import os
+import time
+from logging import getLogger
+
+__all__ = ('Journal', 'JournalMismatch', )
+
+
+LOGGER = getLogger(__name__)
+
+# Bump when the records change.
+FORMAT_VERSION = 2
+
+
+class JournalMismatch(RuntimeError):
+  """
+  The journal was written for another plan.
+  """
+
+  pass
+
+
+class Journal(object):
+  """
+  An append-only file of realized transitions.
+  """
+
+  def __init__(self, path, sync_every=64, sync_interval=1.):
+    """
+    Records are synced every sync_every records, or once
+    sync_interval seconds have passed since the last sync.
+    """
+
+    self.__path = path
+    self.__sync_every = sync_every
+    self.__sync_interval = sync_interval
+    self.__file = None
+    self.__ids = None
+    # Whether this run wrote to the journal yet.
+    self.__started = False
+
+  def for_shard(self, name):
+    """
+    A journal for part of the same run, in a file next to this one.
+    """
+
+    return type(self)('%s.%s' % (self.__path, name),
+        self.__sync_every, self.__sync_interval)
+
+  def __read(self):
+    # The ids of the last plan and the results recorded by id
+    # since it started, None if there is no journal.
+    try:
+      f = open(self.__path, 'rb')
+    except IOError:
+      return None
+    plan_ids = None
+    results = {}
+    with f:
+      try:
+        header = pickle.load(f)
+      except Exception, e:
+        LOGGER.warning('Journal header unusable: %s', e)
+        return None
+      if header.get('version') != FORMAT_VERSION:
+        return None
+      while True:
+        try:
+          record = pickle.load(f)
+        except EOFError:
+          break
+        except Exception, e:
+          # The last record was cut short.
+          LOGGER.info('Journal ends with a partial record: %s', e)
+          break
+        if record[0] == 'plan':
+          # What earlier sections realized may be realized again.
+          plan_ids = record[1]
+          results = {}
+        else:
+          results[record[1]] = record[2]
+    if plan_ids is None:
+      return None
+    return plan_ids, results
+
+  def start(self, plan):
+    """
+    Journal the realization of plan.
+
+    The first realization of a run starts a new journal,
+    later ones append to it.
+    """
+
+    self.__ids = plan.stable_ids()
+    if not self.__started:
+      self.close()
+      dirname = os.path.dirname(self.__path)
+      if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+      self.__file = open(self.__path, 'wb')
+      self.__started = True
+      self.__write({'version': FORMAT_VERSION, })
+    elif self.__file is None:
+      self.__file = open(self.__path, 'ab')
+    self.__write(('plan', self.__plan_ids(plan)))
+    self.__reset_sync()
+    self.sync()
+
+  def resume(self, plan):
+    """
+    Give the transitions of plan the journal recorded their results,
+    and keep journaling after them. Returns how many were recorded.
+
+    Starts a new journal if there is none.
+    """
+
+    journal = self.__read()
+    if journal is None:
+      self.start(plan)
+      return 0
+    plan_ids, results = journal
+    self.close()
+    self.__ids = plan.stable_ids()
+    if plan_ids != self.__plan_ids(plan):
+      raise JournalMismatch(self.__path)
+    count = 0
+    for t in plan.transitions:
+      rec = results.get(self.__ids[t])
+      if rec is not None and not t.is_realized:
+        t._record_results(rec)
+        count += 1
+    self.__file = open(self.__path, 'ab')
+    self.__started = True
+    self.__reset_sync()
+    LOGGER.info('Resuming, %d transitions were realized', count)
+    return count
+
+  def __plan_ids(self, plan):
+    return [self.__ids[t] for t in plan.transitions]
+
+  def __write(self, record):
+    pickle.dump(record, self.__file, pickle.HIGHEST_PROTOCOL)
+
+  def record(self, t):
+    """
+    Record that t was realized.
+    """
+
+    try:
+      data = pickle.dumps(
+          ('done', self.__ids[t], dict(t.results_attrs.iteritems())),
+          pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError), e:
+      # Without its results, it will be realized again.
+      LOGGER.info('Results of %s not journaled: %s', t, e)
+      return
+    self.__file.write(data)
+    self.__file.flush()
+    self.__unsynced += 1
+    if self.__unsynced >= self.__sync_every \
+        or time.time() - self.__synced_at >= self.__sync_interval:
+      self.sync()
+
+  def __reset_sync(self):
+    self.__unsynced = 0
+    self.__synced_at = time.time()
+
+  def sync(self):
+    if self.__file is None:
+      return
+    self.__file.flush()
+    os.fsync(self.__file.fileno())
+    self.__reset_sync()
+
+  def close(self):
+    if self.__file is None:
+      return
+    self.sync()
+    self.__file.close()
+    self.__file = None
@@ -0,0 +1,187 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Locking resources, so that several runs can share a host.
+
+A run locks the resources whose transitions it realizes exclusively,
+and those they come after shared; runs whose locks don't conflict
+proceed in parallel, the others wait for the overlap only.
+A resource maps to a slot by a hash of its name (see
+systems.context.owner_name); slots are byte-range locks (fcntl's)
+on a single file, a byte per slot, so that the slot space is large
+enough for runs touching different resources to rarely share a slot,
+while a run only holds one file open however many it locks.
+Locks are released when the run ends, or when the process dies;
+processes that commands fork don't inherit them.
+
+Record locks belong to a process, not to a file descriptor: the runs
+of a process take turns, a run only locks once the one before
+released.
+
+Transitions added at the top aren't owned by any resource, and run
+unlocked; only the resources they come after are locked, shared.
+Transitions of aggregates are owned by the aggregate, whose name is
+that of its class, so all runs collecting, say, packages to install
+wait for each other, whatever the packages.
+
+Every run takes its locks in the same order, so runs waiting
+for each other can't deadlock.
+
+A HostLock is a single lock file, taken around one transition at a time;
+workers of a sharded run (see systems.shards) realize the transitions
+of their aggregates under one, since those run commands that take
+a system-wide lock of their own (dpkg's).
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import threading
+from logging import getLogger
+
+__all__ = ('HostLock', 'LockManager', )
+
+
+LOGGER = getLogger(__name__)
+
+DEFAULT_DIRECTORY = '/var/lock/systems'
+# Offsets stay within a signed 32 bit off_t.
+DEFAULT_SLOTS = 2 ** 31
+
+# Held by the run of this process that holds record locks.
+_process_lock = threading.Lock()
+
+
+def _open_cloexec(path, mode):
+  # Commands that transitions run, and daemons they start,
+  # mustn't keep the file open.
+  f = open(path, mode)
+  flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+  fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+  return f
+
+def _wait_for(lock, what):
+  # Call lock with LOCK_NB, then without it, waiting for what holds it.
+  try:
+    lock(fcntl.LOCK_NB)
+  except IOError, e:
+    if e.errno not in (errno.EAGAIN, errno.EACCES):
+      raise
+    LOGGER.info('Waiting for %s', what)
+    lock(0)
+
+
+class HostLock(object):
+  """
+  An exclusive lock on a file, held within a with statement.
+
+  The file is opened on every acquisition, so that threads and
+  processes sharing a HostLock exclude each other.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    # The file of each thread holding or waiting for the lock.
+    self.__local = threading.local()
+
+  def __enter__(self):
+    f = _open_cloexec(self.path, 'a')
+    try:
+      _wait_for(lambda flags: fcntl.flock(f.fileno(), fcntl.LOCK_EX | flags),
+          'the lock on ' + self.path)
+    except:
+      f.close()
+      raise
+    self.__local.file = f
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    # Closing the file releases the lock.
+    self.__local.file.close()
+    del self.__local.file
+
+
+class HeldLocks(object):
+  """
+  Locks taken by LockManager.acquire, until released.
+  """
+
+  def __init__(self, f, count):
+    self.__file = f
+    self.__count = count
+
+  def __len__(self):
+    return self.__count
+
+  def release(self):
+    if self.__file is None:
+      return
+    # Closing the file releases the locks of the process.
+    self.__file.close()
+    self.__file = None
+    self.__count = 0
+    _process_lock.release()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    self.release()
+
+
+class LockManager(object):
+  """
+  A file of slots, which resources are locked through.
+  """
+
+  def __init__(self, directory=DEFAULT_DIRECTORY, slots=DEFAULT_SLOTS):
+    """
+    slots is the number of slots; every run on a host
+    must use the same.
+    """
+
+    if not 1 <= slots <= DEFAULT_SLOTS:
+      raise ValueError(slots)
+    self.__directory = directory
+    self.__slots = slots
+    self.path = os.path.join(directory, 'slots.lock')
+
+  def slot(self, name):
+    return int(hashlib.sha1(name).hexdigest()[:8], 16) % self.__slots
+
+  def acquire(self, exclusive, shared=()):
+    """
+    Lock the resources named in exclusive exclusively, those named
+    in shared (and not in exclusive) shared. Waits for the runs that
+    hold conflicting locks, and for the run of this process that
+    holds locks. Returns a HeldLocks.
+    """
+
+    modes = dict((self.slot(name), fcntl.LOCK_SH) for name in shared)
+    modes.update((self.slot(name), fcntl.LOCK_EX) for name in exclusive)
+    _process_lock.acquire()
+    try:
+      if not os.path.isdir(self.__directory):
+        os.makedirs(self.__directory)
+      # Shared locks need the file open for reading.
+      f = _open_cloexec(self.path, 'a+')
+    except:
+      _process_lock.release()
+      raise
+    held = HeldLocks(f, len(modes))
+    try:
+      # In slot order, the order in which every run locks.
+      for slot in sorted(modes):
+        self.__lock(f, slot, modes[slot])
+    except:
+      held.release()
+      raise
+    LOGGER.debug('Locked %d slots', len(held))
+    return held
+
+  def __lock(self, f, slot, mode):
+    def lock(flags):
+      fcntl.lockf(f.fileno(), mode | flags, 1, slot)
+    _wait_for(lock, 'another run to release lock slot %d' % slot)
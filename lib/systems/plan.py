@@ -0,0 +1,226 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+What is left of a frozen graph at realize time.
+
+Once resources are expanded and collected, the nodes that aren't
+transitions (expansion boundaries, checkpoints, references and the
+first/last sentinels) only carry ordering. A plan keeps the transitions
+and the shortest list of dependencies that still implies the same order.
+"""
+
+import hashlib
+
+from systems.graphexport import collapse, write_graph
+
+__all__ = ('Plan', 'reduce_depends', )
+
+
+def reduce_depends(preds, position, depends):
+  """
+  The preds no other pred comes after, sorted by position.
+
+  position gives the position of a transition in a topological order,
+  depends its reduced dependencies; both are functions, and must cover
+  preds and what they come after.
+  """
+
+  preds = sorted(set(preds), key=position, reverse=True)
+  if len(preds) < 2:
+    return preds
+  # A pred can only come after preds positioned before it;
+  # visiting them from the last, it is implied iff a visit from
+  # a kept pred reached it. Visits stop at the first pred.
+  lowest = position(preds[-1])
+  reached = set()
+  kept = []
+  for pred in preds:
+    if pred in reached:
+      continue
+    kept.append(pred)
+    stack = [pred]
+    while stack:
+      for anc in depends(stack.pop()):
+        if anc not in reached and position(anc) >= lowest:
+          reached.add(anc)
+          stack.append(anc)
+  kept.reverse()
+  return kept
+
+
+def instr_fingerprint(t):
+  """
+  The instructions of a transition, as a string.
+  """
+
+  return repr(sorted(t.instr_attrs.iteritems()))
+
+
+class Plan(object):
+  """
+  Transitions in topological order, with their direct dependencies.
+
+  depends maps every transition to the transitions it must wait for;
+  no dependency is implied by the others (transitive reduction).
+  owners maps transitions to a string naming the resource
+  or aggregate they were expanded from, see systems.plandiff.
+  """
+
+  def __init__(self, transitions, depends, owners=None):
+    """
+    transitions is a topological order of the transitions,
+    depends maps a transition to transitions it must come after,
+    possibly with redundant dependencies.
+    Transitions missing from owners were added at the top.
+    """
+
+    self.transitions = list(transitions)
+    self.depends = {}
+    self.owners = dict(owners or {})
+    # Positions of transitions, see extend.
+    self.__index = None
+    self.__reduce(self.transitions, depends, {})
+
+  @classmethod
+  def from_reduced(cls, transitions, depends, owners=None):
+    """
+    A plan whose depends are reduced already, as those of a plan are.
+    """
+
+    plan = object.__new__(cls)
+    plan.transitions = list(transitions)
+    plan.depends = dict(depends)
+    plan.owners = dict(owners or {})
+    plan.__index = None
+    return plan
+
+  def __getstate__(self):
+    # The index can be rebuilt.
+    state = self.__dict__.copy()
+    del state['_Plan__index']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.__index = None
+
+  def extend(self, transitions, depends, owners=None):
+    """
+    A new plan: this one, then transitions, which may depend
+    on the transitions of this one. Only the new transitions are reduced.
+    """
+
+    if self.__index is None:
+      self.__index = dict((t, i) for (i, t) in enumerate(self.transitions))
+    plan = object.__new__(Plan)
+    plan.transitions = self.transitions + list(transitions)
+    plan.depends = dict(self.depends)
+    plan.owners = dict(self.owners)
+    plan.owners.update(owners or {})
+    plan.__index = None
+    plan.__reduce(transitions, depends, dict(self.__index))
+    return plan
+
+  def __reduce(self, transitions, depends, position):
+    # Add the reduced depends of transitions, which come after those
+    # in position.
+    reduced = self.depends
+    for t in transitions:
+      position[t] = len(position)
+      reduced[t] = tuple(reduce_depends(depends.get(t, ()),
+        position.__getitem__, reduced.__getitem__))
+
+  def restricted(self, keep):
+    """
+    The plan of the transitions in keep, a set that must contain
+    what its transitions depend on.
+    """
+
+    # What a kept transition depends on is kept, and stays reduced.
+    transitions = [t for t in self.transitions if t in keep]
+    return Plan.from_reduced(transitions,
+        dict((t, self.depends[t]) for t in transitions), self.owners)
+
+  def stable_ids(self):
+    """
+    Map transitions to ids that a plan frozen again from the same
+    manifest gives its transitions, see systems.journal.
+
+    Ids are made of the owner, type and instructions of transitions,
+    and how many such transitions come before in the plan.
+    """
+
+    ids = {}
+    seen = {}
+    for t in self.transitions:
+      key = '%s\0%s\0%s' % (self.owners.get(t), t.ttype.name,
+          instr_fingerprint(t))
+      count = seen.get(key, 0)
+      seen[key] = count + 1
+      ids[t] = hashlib.sha1('%s\0%d' % (key, count)).hexdigest()
+    return ids
+
+  def __len__(self):
+    return len(self.transitions)
+
+  def __iter__(self):
+    return iter(self.transitions)
+
+  def iter_edges(self):
+    for t in self.transitions:
+      for pred in self.depends[t]:
+        yield (pred, t)
+
+  def export(self, f, format='dot', by_type=False):
+    """
+    Write the plan to the file f as DOT or GraphML, streaming
+    (see systems.graphexport).
+
+    If by_type is set, transitions are merged by the type of
+    the resource that expanded into them.
+    """
+
+    from systems.context import describe
+
+    position = dict((t, i) for (i, t) in enumerate(self.transitions))
+    nodes = ((i, describe(t)) for (i, t) in enumerate(self.transitions))
+    edges = ((position[t0], position[t1]) for (t0, t1) in self.iter_edges())
+    if by_type:
+      def group(i):
+        t = self.transitions[i]
+        owner = self.owners.get(t)
+        if owner is None:
+          return t.ttype.name
+        # Named by systems.context.owner_name.
+        return owner.split('(', 1)[0]
+      nodes, edges = collapse(nodes, edges, group)
+    write_graph(f, nodes, edges, format)
+
+  def draw(self, fname):
+    # Same caveats as ResourceGraph.draw_agraph.
+    import networkx as NX
+    from systems.context import describe
+
+    gr = NX.DiGraph()
+    for t in self.transitions:
+      gr.add_node(id(t))
+    for (t0, t1) in self.iter_edges():
+      gr.add_edge(id(t0), id(t1))
+    names = dict((id(t), { 'label': describe(t)})
+        for t in self.transitions)
+    g = NX.to_agraph(gr, {
+        'graph': {
+          'nodesep': '0.2',
+          'rankdir': 'TB',
+          'ranksep': '0.5',
+          },
+        'node': {
+          'shape': 'box',
+          },
+        },
+        names)
+    g.write(fname + '.dot')
+    g.layout(prog='dot')
+    g.draw(fname + '.svg')
+
@@ -0,0 +1,193 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+"""
+A cache of frozen plans.
+
+Freezing runs every expand_into method and every collector.
+When neither the manifest nor the code changed, the Plan it builds
+is the same; it is pickled to a file named after a hash of both,
+and loaded back (through mmap) instead.
+
+Expansions also read system state (whether a user exists for example),
+so the state attributes read while freezing are pickled ahead of the
+plan (see systems.probes.StateReads); the plan is only loaded back
+if they all read the same.
+
+Resources and transitions pickle as their type name and attribute
+values, and are rebuilt through the registry. Bound methods, which
+PythonCode transitions commonly hold, pickle as their instance and
+name. Plans holding something that can't be pickled (a lambda for
+example) aren't cached.
+"""
+
+import copy_reg
+import cPickle as pickle
+import hashlib
+import mmap
+import os
+import sys
+import tempfile
+import types
+from logging import getLogger
+
+from systems.probes import StateReads
+
+__all__ = ('PlanCache', 'load_plan', )
+
+
+LOGGER = getLogger(__name__)
+
+# Bump when the pickled representation changes.
+FORMAT_VERSION = 3
+
+
+def reduce_method(method):
+  """
+  A method as getattr and its arguments: its instance (or class)
+  and its name, mangled if private.
+  """
+
+  if method.im_self is None:
+    # Unbound, getattr on the class gives it back.
+    owner = method.im_class
+  else:
+    owner = method.im_self
+  name = method.im_func.__name__
+  if name.startswith('__') and not name.endswith('__'):
+    # Private, find the class that mangled it.
+    for cls in method.im_class.__mro__:
+      mangled = '_%s%s' % (cls.__name__.lstrip('_'), name)
+      if cls.__dict__.get(mangled) is method.im_func:
+        name = mangled
+        break
+  return (getattr, (owner, name))
+
+copy_reg.pickle(types.MethodType, reduce_method)
+
+
+def code_fingerprint(prefix='systems'):
+  """
+  A hash of the sources of the loaded modules of a package.
+
+  Plugins are in the systems package, so they are included.
+  """
+
+  digest = hashlib.sha1()
+  for name in sorted(sys.modules):
+    if name != prefix and not name.startswith(prefix + '.'):
+      continue
+    fname = getattr(sys.modules[name], '__file__', None)
+    if fname is None:
+      continue
+    if fname.endswith(('.pyc', '.pyo')):
+      fname = fname[:-1]
+    digest.update(name + '\0')
+    try:
+      with open(fname, 'rb') as f:
+        digest.update(f.read())
+    except IOError:
+      # Only compiled, use the bytecode.
+      with open(fname + 'c', 'rb') as f:
+        digest.update(f.read())
+  return digest.hexdigest()
+
+
+def load_plan(fname):
+  """
+  Load a Plan from a file of the cache.
+  """
+
+  return _load_entry(fname, lambda reads: True)
+
+def _load_entry(fname, accept):
+  # The plan, if accept is true of the state reads ahead of it.
+  with open(fname, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      unpickler = pickle.Unpickler(mm)
+      if not accept(unpickler.load()):
+        return None
+      return unpickler.load()
+    finally:
+      mm.close()
+
+
+class PlanCache(object):
+  """
+  A directory of pickled plans, keyed by their inputs.
+  """
+
+  def __init__(self, directory):
+    self.__directory = directory
+
+  def key(self, manifest_key):
+    """
+    The cache key of a manifest, given as a string.
+
+    manifest_key must change whenever what the manifest expands
+    into may change: the contents of the manifest files for example.
+    """
+
+    digest = hashlib.sha1()
+    digest.update('%d\0' % FORMAT_VERSION)
+    digest.update(code_fingerprint() + '\0')
+    digest.update(manifest_key)
+    return digest.hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.__directory, key + '.plan')
+
+  def load(self, key):
+    """
+    Return the cached Plan, or None.
+
+    Plans whose state reads read differently now are ignored.
+    """
+
+    def accept(reads):
+      changed = reads.changed()
+      if changed is not None:
+        LOGGER.debug('Plan cache entry stale: %s: %s', key, changed)
+      return changed is None
+    try:
+      plan = _load_entry(self.path(key), accept)
+    except IOError:
+      LOGGER.debug('Plan cache miss: %s', key)
+      return None
+    except Exception, e:
+      # Truncated, or refers to something that went away.
+      LOGGER.warning('Plan cache entry unusable: %s: %s', key, e)
+      return None
+    if plan is not None:
+      LOGGER.debug('Plan cache hit: %s', key)
+    return plan
+
+  def store(self, key, plan, reads=None):
+    """
+    Save plan, with the systems.probes.StateReads it was built from
+    (None if nothing was read); return False if it can't be pickled.
+    """
+
+    if reads is None:
+      reads = StateReads()
+    try:
+      data = pickle.dumps(reads, pickle.HIGHEST_PROTOCOL) \
+          + pickle.dumps(plan, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError), e:
+      LOGGER.info('Plan not cached, it can\'t be pickled: %s', e)
+      return False
+    if not os.path.isdir(self.__directory):
+      os.makedirs(self.__directory)
+    # Written then renamed, so readers never see a partial plan.
+    fd, tmpname = tempfile.mkstemp(dir=self.__directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.rename(tmpname, self.path(key))
+    except:
+      os.unlink(tmpname)
+      raise
+    return True
+
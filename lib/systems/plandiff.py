@@ -0,0 +1,154 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+What changes between two frozen plans.
+
+Transitions of the two plans are paired by what expanded into them
+(Plan.owners) and their type. Within such a group, transitions with
+the same instructions are paired first; the rest, unless they were
+added at the top, are paired in plan order, and those whose
+instructions differ are reported as changed.
+Dependency edges are compared between paired transitions.
+
+Plans loaded from the plan cache can be compared without the graphs
+they were compacted from, nor probing the system::
+
+  python -m systems.plandiff OLD.plan NEW.plan
+
+Plans written by systems.serialization.dump_plan, named *.yaml,
+can be compared too.
+"""
+
+import sys
+
+from systems.plan import instr_fingerprint
+
+__all__ = ('PlanDiff', )
+
+def _group_key(plan, t):
+  return (plan.owners.get(t), t.ttype.name)
+
+def _groups(plan):
+  groups = {}
+  for t in plan.transitions:
+    groups.setdefault(_group_key(plan, t), []).append(t)
+  return groups
+
+
+class PlanDiff(object):
+  """
+  The added, removed and changed transitions and edges from old to new.
+
+  changed holds (old, new) pairs of transitions, edges are (pred, succ)
+  pairs of transitions of the plan they are in. Everything is listed
+  in plan order.
+  """
+
+  def __init__(self, old, new):
+    # Transitions of both plans, by their pair's label.
+    old_labels = {}
+    new_labels = {}
+    changed = set()
+    old_groups = _groups(old)
+    new_groups = _groups(new)
+    for (key, olds) in old_groups.iteritems():
+      news = new_groups.get(key, [])
+      by_fingerprint = {}
+      for t in news:
+        by_fingerprint.setdefault(instr_fingerprint(t), []).append(t)
+      paired = {}
+      left = []
+      for t in olds:
+        same = by_fingerprint.get(instr_fingerprint(t))
+        if same:
+          paired[t] = same.pop(0)
+        else:
+          left.append(t)
+      if key[0] is None:
+        # Nothing to tell top transitions apart.
+        left = []
+      taken = set(paired.itervalues())
+      news_left = [t for t in news if t not in taken]
+      for (t0, t1) in zip(left, news_left):
+        paired[t0] = t1
+        if dict(t0.instr_attrs.iteritems()) \
+            != dict(t1.instr_attrs.iteritems()):
+          changed.add(t0)
+      for (t0, t1) in paired.iteritems():
+        old_labels[t0] = new_labels[t1] = (key, t0)
+
+    self.removed = [t for t in old.transitions if t not in old_labels]
+    self.added = [t for t in new.transitions if t not in new_labels]
+    by_label = dict((label, t1) for (t1, label) in new_labels.iteritems())
+    self.changed = [(t, by_label[old_labels[t]]) for t in old.transitions
+        if t in changed]
+
+    def edges(plan, labels):
+      return dict(((labels.get(pred, pred), labels.get(t, t)), (pred, t))
+          for (pred, t) in plan.iter_edges())
+    old_edges = edges(old, old_labels)
+    new_edges = edges(new, new_labels)
+    self.removed_edges = [edge for (key, edge) in old_edges.iteritems()
+        if key not in new_edges]
+    self.added_edges = [edge for (key, edge) in new_edges.iteritems()
+        if key not in old_edges]
+    self.__sort_edges(self.removed_edges, old)
+    self.__sort_edges(self.added_edges, new)
+
+  @classmethod
+  def __sort_edges(cls, edges, plan):
+    position = dict((t, i) for (i, t) in enumerate(plan.transitions))
+    edges.sort(key=lambda edge: (position[edge[1]], position[edge[0]]))
+
+  def __nonzero__(self):
+    return bool(self.added or self.removed or self.changed
+        or self.added_edges or self.removed_edges)
+
+  def iter_lines(self):
+    """
+    A readable report, one line per difference.
+    """
+
+    for t in self.removed:
+      yield '- %r' % t
+    for t in self.added:
+      yield '+ %r' % t
+    for (t0, t1) in self.changed:
+      yield '~ %r' % t0
+      yield '  %r' % t1
+    for (t0, t1) in self.removed_edges:
+      yield '- %r -> %r' % (t0, t1)
+    for (t0, t1) in self.added_edges:
+      yield '+ %r -> %r' % (t0, t1)
+
+
+def _load_plan(fname):
+  from systems import plancache, serialization
+
+  if not fname.endswith('.yaml'):
+    return plancache.load_plan(fname)
+  f = open(fname)
+  try:
+    return serialization.load_plan(f)
+  finally:
+    f.close()
+
+def main(argv=None):
+  from systems.pluginmanager import load_plugin
+
+  if argv is None:
+    argv = sys.argv[1:]
+  if len(argv) != 2:
+    sys.stderr.write('Usage: python -m systems.plandiff OLD NEW\n')
+    return 2
+  # Plans refer to types by name.
+  load_plugin('systems.plugins')
+  diff = PlanDiff(_load_plan(argv[0]), _load_plan(argv[1]))
+  for line in diff.iter_lines():
+    print line
+  return diff and 1 or 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -76,7 +76,8 @@ def register():
         pytype=int),
       'contents': AttrType(
         pytype=str),
-      })
+      },
+    pure=True)
   get_registry().resource_types.register(restype)
 
 
@@ -66,7 +66,8 @@ def register():
         pytype=int),
       'rails_dir': RefAttrType(
         rtype='Directory'),
-      })
+      },
+    pure=True)
   get_registry().resource_types.register(restype)
 
 
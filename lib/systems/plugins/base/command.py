@@ -7,6 +7,7 @@ import os
 import pwd
 import subprocess
 
+from systems.reactor import ChildProcess, run_coroutine
 from systems.registry import get_registry
 from systems.typesystem import AttrType, TransitionType, Transition
 from systems.util.uid import drop_privs_permanently
@@ -123,53 +124,46 @@ class Command(Transition):
     return fn
 
   def realize_impl(self):
+    return run_coroutine(self.realize_coroutine_impl())
+
+  def realize_coroutine_impl(self):
     env = self.env_with(self.instr_attrs['extra_env'])
     preexec_fn = self.dropprivs_fn(self.instr_attrs['username'])
     cwd = self.instr_attrs['cwd']
 
     if self.instr_attrs['unless'] is not None:
-      # Remember, 0 means success
-      if subprocess.call(
+      retcode, stdoutdata = yield ChildProcess(
           self.instr_attrs['unless'],
           preexec_fn=preexec_fn,
           cwd=cwd,
-          env=env) == 0:
-        return {
+          env=env)
+      # Remember, 0 means success
+      if retcode == 0:
+        yield {
             'retcode': 0,
             'stdout': '',
             }
-
-    if self.instr_attrs['cmdline_input'] is None:
-      stdin_flag = None
-    else:
-      stdin_flag = subprocess.PIPE
-
-    if self.instr_attrs['redir_stdout']:
-      stdout_flag = subprocess.PIPE
-    else:
-      stdout_flag = None
+        return
 
     #LOGGER.debug('Running command %r', dict(self.instr_attrs))
-    p = subprocess.Popen(
+    # Writes, waits until completion.
+    retcode, stdoutdata = yield ChildProcess(
         self.instr_attrs['cmdline'],
-        stdin=stdin_flag,
-        stdout=stdout_flag,
+        input=self.instr_attrs['cmdline_input'],
+        capture_stdout=self.instr_attrs['redir_stdout'],
         preexec_fn=preexec_fn,
         cwd=cwd,
         env=env)
 
-    # Writes, waits until completion.
-    stdoutdata, stderrdata = p.communicate(self.instr_attrs['cmdline_input'])
-
     if stdoutdata is None:
       # redir_stdout is False
       stdoutdata = ''
 
-    if p.returncode not in self.instr_attrs['expected_retcodes']:
+    if retcode not in self.instr_attrs['expected_retcodes']:
       raise subprocess.CalledProcessError(
-          p.returncode, self.instr_attrs['cmdline'])
-    return {
-        'retcode': p.returncode,
+          retcode, self.instr_attrs['cmdline'])
+    yield {
+        'retcode': retcode,
         'stdout': stdoutdata,
         }
 
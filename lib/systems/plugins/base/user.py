@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import os
 import pwd
 import re
 
@@ -29,6 +30,14 @@ def read_attrs(id_attrs):
       'shell': shell,
       }
 
+def read_passwd_token(id_attrs):
+  """
+  A validity token; user changes rewrite /etc/passwd.
+  """
+
+  st = os.stat('/etc/passwd')
+  return (st.st_ino, st.st_mtime, st.st_size)
+
 class User(EResource):
   """
   A system user managed on the local system (PAM, /etc/passwd and friends)
@@ -55,6 +64,8 @@ class User(EResource):
             valid_condition=cls.is_valid_shell),
           },
         global_reader=read_attrs,
+        validity_token=read_passwd_token,
+        probes=('present', 'home', 'shell', ),
         )
     get_registry().resource_types.register(cls.__restype)
 
@@ -70,6 +70,18 @@ def read_mode(id_attrs):
   path = id_attrs['path']
   return int_to_oct(stat.S_IMODE(os.lstat(path).st_mode))
 
+def read_stat_token(id_attrs):
+  """
+  A validity token; writes, replacement and chmod/chown change it.
+  """
+
+  path = id_attrs['path']
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return None
+  return (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+
 
 
 class FilePermsMixin(object):
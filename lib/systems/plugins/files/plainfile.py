@@ -85,7 +85,8 @@ def register():
           reader=fileperms.read_group,
           valid_condition=fileperms.is_valid_groupname,
           pytype=str),
-        })
+        },
+      validity_token=fileperms.read_stat_token)
   get_registry().resource_types.register(restype)
 
 
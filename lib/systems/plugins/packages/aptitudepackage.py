@@ -1,6 +1,7 @@
 # vim: set fileencoding=utf-8 sw=2 ts=2 et :
 from __future__ import absolute_import
 
+import os
 import re
 
 from systems.collector import Collector, Aggregate, CResource
@@ -11,6 +12,20 @@ from systems.dsl import transition
 __all__ = ('register', )
 
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+def read_dpkg_token(id_attrs):
+  """
+  A validity token; dpkg rewrites its status file on every change.
+  """
+
+  try:
+    st = os.stat(DPKG_STATUS)
+  except OSError:
+    return None
+  return (st.st_ino, st.st_mtime, st.st_size)
+
+
 class AptitudePackage(CResource):
   """
   A debian package, managed by aptitude.
@@ -36,6 +51,7 @@ class AptitudePackage(CResource):
             pytype=str,
             valid_condition=cls.is_valid_state),
           },
+        validity_token=read_dpkg_token,
         )
     get_registry().resource_types.register(cls.__restype)
 
@@ -105,8 +121,7 @@ class AptitudePackageCollector(Collector):
   Group several aptitude package operations into one.
   """
 
-  def filter(self, collectible):
-    return isinstance(collectible, AptitudePackage)
+  accepts = (AptitudePackage, )
 
   def collect(self, transitions):
     return AptitudePackages(transitions)
@@ -74,7 +74,8 @@ def register():
         default_value=True,
         reader=read_present,
         pytype=bool),
-      })
+      },
+    probes=('present', ))
   get_registry().resource_types.register(restype)
 
 
@@ -54,6 +54,13 @@ class PgCluster(EResource):
         **kwargs)
 
   def check_existence(self, table, column, value):
+    """
+    Whether a row of table has value in column.
+
+    Read-only; the readers that use it are probes (see systems.probes),
+    run ahead of expansion and answered once per freeze.
+    """
+
     # XXX quoting. Jinja2 doesn't have the relevant filters.
     sql = build_and_render("""
       SELECT EXISTS(
@@ -112,7 +112,8 @@ def register():
         'enable_backups': AttrType(
           default_value=True,
           pytype=bool),
-        })
+        },
+      probes=('present', ))
   get_registry().resource_types.register(restype)
 
 
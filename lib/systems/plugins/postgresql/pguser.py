@@ -57,7 +57,8 @@ def register():
           default_value=True,
           pytype=bool,
           reader=read_present),
-        })
+        },
+      probes=('present', ))
   get_registry().resource_types.register(restype)
 
 
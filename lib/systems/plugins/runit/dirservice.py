@@ -47,7 +47,8 @@ def register():
         pytype=bool),
       'target_dir': RefAttrType(
         rtype='Directory'),
-      })
+      },
+    pure=True)
   get_registry().resource_types.register(restype)
 
 
@@ -62,7 +62,8 @@ def register():
         pytype=bool),
       'contents': AttrType(
         pytype=str),
-      })
+      },
+    pure=True)
   get_registry().resource_types.register(restype)
 
 
@@ -0,0 +1,246 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+"""
+Probing system state while planning.
+
+Expansions look at the system to decide what to do: whether a user,
+a gem or a database role exists already. Those reads are probes;
+they change nothing, so they may run in any order, concurrently,
+and what they answer holds until something is realized.
+
+While a Probes is active (see Realizer), probes are answered through
+its cache: each distinct probe runs once, and is counted and timed.
+Resource types register the state attributes their expansions read
+(see ResourceType); before each expansion wave, those are probed
+as a batch, on several threads, so that expansions find the answers
+waiting instead of probing one after the other.
+
+Outside of an active Probes, as when realizing, probes run directly.
+
+While a StateReads is active, the state attributes resources read are
+recorded, so that a plan built from them (see systems.plancache)
+is only reused while they still read the same.
+"""
+
+import sys
+import threading
+import time
+from logging import getLogger
+
+from systems.util.concurrency import parallel_map
+
+__all__ = ('Probes', 'StateReads', 'probe', 'record_read', )
+
+
+LOGGER = getLogger(__name__)
+
+# The active Probes, shared by the threads of an expansion wave.
+_active = None
+_active_lock = threading.Lock()
+# The active StateReads.
+_recording = None
+
+
+def probe(key, fun, *args):
+  """
+  Return fun(*args), which must not change the system.
+
+  key identifies the probe; while a Probes is active, the answer
+  is cached under it, exceptions included.
+  """
+
+  probes = _active
+  if probes is None:
+    return fun(*args)
+  return probes.read(key, fun, *args)
+
+
+def record_read(rtype_name, id_attrs, name, value):
+  """
+  Note that the state attribute name of a resource read value.
+  """
+
+  reads = _recording
+  if reads is not None:
+    reads.add(rtype_name, id_attrs, name, value)
+
+
+class _Answer(object):
+  # What a probe returned or raised, once it has run.
+
+  def __init__(self):
+    self.__done = threading.Event()
+    self.__value = None
+    self.__exc_info = None
+
+  def run(self, fun, args):
+    try:
+      self.__value = fun(*args)
+    except:
+      self.__exc_info = sys.exc_info()
+    self.__done.set()
+
+  def get(self):
+    self.__done.wait()
+    if self.__exc_info is not None:
+      exc_type, exc_value, exc_tb = self.__exc_info
+      raise exc_type, exc_value, exc_tb
+    return self.__value
+
+
+class Probes(object):
+  """
+  Answers of probes, kept until the system changes.
+  """
+
+  def __init__(self, jobs=8):
+    """
+    jobs is how many probes of a batch may run at once.
+    """
+
+    if jobs < 1:
+      raise ValueError(jobs)
+    self.__jobs = jobs
+    self.__answers = {}
+    self.__lock = threading.Lock()
+    self.count = 0
+    self.hits = 0
+    self.elapsed = 0.
+
+  def __enter__(self):
+    global _active
+    with _active_lock:
+      if _active is not None:
+        raise RuntimeError('Another Probes is active')
+      _active = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    global _active
+    with _active_lock:
+      _active = None
+
+  def __len__(self):
+    return len(self.__answers)
+
+  def read(self, key, fun, *args):
+    """
+    The cached answer for key, running fun(*args) the first time.
+
+    Concurrent reads of the same key wait for the same run.
+    """
+
+    with self.__lock:
+      answer = self.__answers.get(key)
+      fresh = answer is None
+      if fresh:
+        answer = self.__answers[key] = _Answer()
+      else:
+        self.hits += 1
+    if fresh:
+      start = time.time()
+      answer.run(fun, args)
+      with self.__lock:
+        self.count += 1
+        self.elapsed += time.time() - start
+    return answer.get()
+
+  def prefetch(self, resources):
+    """
+    Probe what the types of resources registered as read
+    by their expansions, as a batch.
+
+    Failures are kept, and raised when the expansion reads.
+    """
+
+    reads = []
+    for res in resources:
+      for name in res.rtype.probes:
+        reads.append((res.read_attrs(), name))
+    if not reads:
+      return
+    def read(item):
+      read_attrs, name = item
+      try:
+        read_attrs[name]
+      except Exception:
+        pass
+    with self.__lock:
+      count0 = self.count
+    start = time.time()
+    parallel_map(read, reads, self.__jobs)
+    LOGGER.debug('Probed %d attributes in %.2fs',
+        self.count - count0, time.time() - start)
+
+  def clear(self):
+    """
+    Forget the answers, once the system may have changed.
+    """
+
+    with self.__lock:
+      self.__answers.clear()
+
+
+class StateReads(object):
+  """
+  State attributes of resources, as they were read.
+
+  Reads are kept by resource type name, identity attributes
+  and attribute name, as values that pickle.
+  """
+
+  def __init__(self):
+    self.__reads = {}
+    self.__lock = threading.Lock()
+
+  def __enter__(self):
+    global _recording
+    with _active_lock:
+      if _recording is not None:
+        raise RuntimeError('Another StateReads is active')
+      _recording = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    global _recording
+    with _active_lock:
+      _recording = None
+
+  def __len__(self):
+    return len(self.__reads)
+
+  def __getstate__(self):
+    return self.__reads
+
+  def __setstate__(self, reads):
+    self.__reads = reads
+    self.__lock = threading.Lock()
+
+  def add(self, rtype_name, id_attrs, name, value):
+    key = (rtype_name, tuple(sorted(id_attrs.iteritems())), name)
+    with self.__lock:
+      self.__reads[key] = value
+
+  def changed(self):
+    """
+    The first read that reads differently now, as a
+    (resource type name, identity attributes, attribute name) triple,
+    or None if they all read the same.
+    """
+
+    from systems.registry import get_registry
+    from systems.typesystem import Attrs, ReadAttrs
+
+    registry = get_registry()
+    for (key, value) in sorted(self.__reads.iteritems()):
+      rtype_name, id_items, name = key
+      try:
+        rtype = registry.resource_types.lookup(rtype_name)
+        id_attrs = Attrs(rtype.id_type, dict(id_items))
+        if ReadAttrs(id_attrs, rtype)[name] != value:
+          return key
+      except Exception:
+        return key
+    return None
@@ -0,0 +1,418 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Realizing transitions on a single event loop.
+
+Transitions that spend their time waiting for child processes
+implement realize_coroutine_impl as a generator. The generator
+yields ChildProcess objects, and is sent back a (returncode, stdout)
+pair once each process has exited. Its last yield is the results
+dictionary.
+
+The same generator can be driven synchronously with run_coroutine,
+so a transition doesn't need two implementations.
+
+The loop is built on poll(2) rather than on threads,
+so hundreds of short commands can run at once. Child exits wake it
+through SIGCHLD, whose handler writes to a pipe the loop polls;
+signal handlers can only be set on the main thread, elsewhere a thread
+waits for each process that has no open pipe left.
+"""
+
+import errno
+import fcntl
+import heapq
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import Queue
+from logging import getLogger
+
+from systems.executor import TransitionsFailed, realize_guarded
+
+__all__ = ('ChildProcess', 'run_coroutine', 'Reactor', )
+
+
+LOGGER = getLogger(__name__)
+
+CHUNK_SIZE = 65536
+
+
+class ChildProcess(object):
+  """
+  A request to run a command and wait for it.
+  """
+
+  def __init__(self, args, input=None, capture_stdout=False,
+      preexec_fn=None, cwd=None, env=None):
+    self.args = args
+    self.input = input
+    self.capture_stdout = capture_stdout
+    self.preexec_fn = preexec_fn
+    self.cwd = cwd
+    self.env = env
+
+  def popen(self):
+    if self.input is None:
+      stdin_flag = None
+    else:
+      stdin_flag = subprocess.PIPE
+    if self.capture_stdout:
+      stdout_flag = subprocess.PIPE
+    else:
+      stdout_flag = None
+    return subprocess.Popen(
+        self.args,
+        stdin=stdin_flag,
+        stdout=stdout_flag,
+        preexec_fn=self.preexec_fn,
+        cwd=self.cwd,
+        env=self.env)
+
+  def run(self):
+    """
+    Run synchronously, return (returncode, stdout).
+    """
+
+    p = self.popen()
+    # Writes, waits until completion.
+    stdoutdata, stderrdata = p.communicate(self.input)
+    return p.returncode, stdoutdata
+
+
+def run_coroutine(gen):
+  """
+  Drive a realize coroutine synchronously, return its results.
+  """
+
+  value = None
+  while True:
+    req = gen.send(value)
+    if isinstance(req, dict):
+      gen.close()
+      return req
+    value = req.run()
+
+
+def set_nonblocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _on_sigchld(signum, frame):
+  # The wakeup fd is what wakes the loop.
+  pass
+
+
+class _Task(object):
+  # A transition being realized on the loop.
+
+  def __init__(self, transition):
+    self.transition = transition
+    self.gen = transition.realize_coroutine_impl()
+    self.popen = None
+    self.input = None
+    # How much of input was written.
+    self.written = 0
+    self.output = None
+    self.fds = set()
+
+
+class Reactor(object):
+  """
+  Realizes transitions in dependency order, on a single event loop.
+
+  Coroutine transitions (see realize_coroutine_impl) are run on the loop;
+  at most jobs of them run at once. Other transitions, PythonCode for
+  example, are realized on a pool of threads.
+
+  Failures are handled as in the threaded Executor:
+  nothing new is started, the running transitions are waited for,
+  and the failure that comes first in the given order is raised;
+  or, with keep_going, what doesn't come after a failure is realized.
+  """
+
+  def __init__(self, jobs=64, threads=4, on_done=None, keep_going=False,
+      guard=None):
+    """
+    on_done and guard are as in Executor; on_done is called from the loop.
+    Transitions guard maps to a lock are realized on the threads,
+    which can wait for it.
+    """
+
+    if jobs < 1 or threads < 1:
+      raise ValueError(jobs, threads)
+    self.__jobs = jobs
+    self.__threads = threads
+    self.__on_done = on_done
+    self.__keep_going = keep_going
+    self.__guard = guard
+
+  def run(self, transitions, depends):
+    """
+    Realize transitions.
+
+    transitions is a sequence in topological order,
+    depends maps a transition to the transitions it must wait for.
+    """
+
+    self.__position = dict((t, i) for (i, t) in enumerate(transitions))
+    self.__waiting = {}
+    self.__dependents = dict((t, []) for t in transitions)
+    self.__ready = []
+    for t in transitions:
+      preds = depends.get(t, ())
+      self.__waiting[t] = len(preds)
+      for pred in preds:
+        self.__dependents[pred].append(t)
+      if not preds:
+        heapq.heappush(self.__ready, self.__position[t])
+
+    self.__poll = select.poll()
+    # fd -> (task, pipe file)
+    self.__fds = {}
+    # Tasks waiting for a process that has no open pipe left.
+    self.__exiting = set()
+    # Without SIGCHLD, those whose process a waiter saw exit.
+    self.__exited = Queue.Queue()
+    self.__failures = []
+    self.__finished = set()
+    self.__running = 0
+    self.__wake_r, self.__wake_w = os.pipe()
+    set_nonblocking(self.__wake_r)
+    set_nonblocking(self.__wake_w)
+    self.__poll.register(self.__wake_r, select.POLLIN)
+    self.__thread_jobs = Queue.Queue()
+    self.__thread_done = Queue.Queue()
+    workers = [threading.Thread(target=self.__work)
+        for i in xrange(self.__threads)]
+    for worker in workers:
+      worker.start()
+
+    self.__sigchld = self.__catch_sigchld()
+    try:
+      self.__loop(transitions)
+    finally:
+      if self.__sigchld is not None:
+        self.__release_sigchld(*self.__sigchld)
+      for worker in workers:
+        self.__thread_jobs.put(None)
+      for worker in workers:
+        worker.join()
+      os.close(self.__wake_r)
+      os.close(self.__wake_w)
+
+    if self.__failures:
+      TransitionsFailed.raise_failures(self.__failures, list(transitions),
+          self.__finished, self.__keep_going)
+
+  def __catch_sigchld(self):
+    # Have child exits write to the wake pipe.
+    # Returns what to restore, None off the main thread.
+    try:
+      handler = signal.signal(signal.SIGCHLD, _on_sigchld)
+    except ValueError:
+      return None
+    # Threads realizing transitions mustn't see EINTR.
+    signal.siginterrupt(signal.SIGCHLD, False)
+    wakeup_fd = signal.set_wakeup_fd(self.__wake_w)
+    return handler, wakeup_fd
+
+  def __release_sigchld(self, handler, wakeup_fd):
+    signal.set_wakeup_fd(wakeup_fd)
+    if handler is None:
+      # Set outside of Python.
+      handler = signal.SIG_DFL
+    signal.signal(signal.SIGCHLD, handler)
+    # The flag can't be read back; system calls are interrupted,
+    # as they are under any handler set with signal.signal.
+    signal.siginterrupt(signal.SIGCHLD, True)
+
+  def __loop(self, transitions):
+    while True:
+      while self.__ready and self.__running < self.__jobs \
+          and (self.__keep_going or not self.__failures):
+        self.__start(transitions[heapq.heappop(self.__ready)])
+      if self.__running == 0:
+        return
+      try:
+        events = self.__poll.poll()
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for (fd, event) in events:
+        if fd == self.__wake_r:
+          self.__drain_threads()
+        else:
+          self.__pipe_event(fd, event)
+      for task in self.__reap():
+        self.__step(task, (task.popen.returncode, task.output))
+
+  def __wait_exit(self, task):
+    # The process of task has no open pipe left.
+    self.__exiting.add(task)
+    if self.__sigchld is not None:
+      return
+    def wait():
+      task.popen.wait()
+      self.__exited.put(task)
+      self.__wake()
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
+
+  def __reap(self):
+    # Tasks whose process exited.
+    if self.__sigchld is not None:
+      exited = [task for task in self.__exiting
+          if task.popen.poll() is not None]
+    else:
+      exited = []
+      while True:
+        try:
+          exited.append(self.__exited.get_nowait())
+        except Queue.Empty:
+          break
+    self.__exiting.difference_update(exited)
+    return exited
+
+  def __wake(self):
+    try:
+      os.write(self.__wake_w, 'x')
+    except OSError, e:
+      # Full, the loop will wake anyway.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def __start(self, t):
+    self.__running += 1
+    if t.realize_coroutine_impl is None or (self.__guard is not None
+        and self.__guard(t) is not None):
+      self.__thread_jobs.put(t)
+      return
+    try:
+      t._require_unrealized()
+      task = _Task(t)
+    except:
+      self.__done(t, sys.exc_info())
+      return
+    self.__step(task, None)
+
+  def __step(self, task, value):
+    # Run the coroutine up to its next request.
+    try:
+      req = task.gen.send(value)
+      if isinstance(req, dict):
+        task.gen.close()
+        task.transition._record_results(req)
+        self.__done(task.transition, None)
+        return
+      self.__spawn(task, req)
+    except:
+      self.__done(task.transition, sys.exc_info())
+
+  def __spawn(self, task, req):
+    task.popen = req.popen()
+    task.input = req.input
+    task.written = 0
+    if req.capture_stdout:
+      task.output = []
+    else:
+      task.output = None
+    if task.popen.stdin is not None:
+      fd = task.popen.stdin.fileno()
+      set_nonblocking(fd)
+      self.__register(task, fd, task.popen.stdin, select.POLLOUT)
+    if task.popen.stdout is not None:
+      fd = task.popen.stdout.fileno()
+      self.__register(task, fd, task.popen.stdout, select.POLLIN)
+    if not task.fds:
+      self.__wait_exit(task)
+
+  def __register(self, task, fd, pipe, eventmask):
+    task.fds.add(fd)
+    self.__fds[fd] = (task, pipe)
+    self.__poll.register(fd, eventmask)
+
+  def __unregister(self, fd):
+    task, pipe = self.__fds.pop(fd)
+    self.__poll.unregister(fd)
+    pipe.close()
+    task.fds.remove(fd)
+    if not task.fds:
+      if task.output is not None:
+        task.output = ''.join(task.output)
+      self.__wait_exit(task)
+
+  def __pipe_event(self, fd, event):
+    task, pipe = self.__fds[fd]
+    if pipe is task.popen.stdin:
+      if event & (select.POLLERR | select.POLLHUP):
+        # The command doesn't read all its input, like communicate.
+        self.__unregister(fd)
+        return
+      try:
+        # A buffer, so the rest of the input isn't copied.
+        task.written += os.write(fd,
+            buffer(task.input, task.written, CHUNK_SIZE))
+      except OSError, e:
+        if e.errno == errno.EAGAIN:
+          return
+        if e.errno != errno.EPIPE:
+          raise
+        task.written = len(task.input)
+      if task.written == len(task.input):
+        task.input = None
+        self.__unregister(fd)
+    else:
+      data = os.read(fd, CHUNK_SIZE)
+      if data:
+        task.output.append(data)
+      else:
+        self.__unregister(fd)
+
+  def __done(self, t, exc_info):
+    self.__running -= 1
+    if exc_info is not None:
+      LOGGER.error('Transition failed: %s', t)
+      self.__failures.append((self.__position[t], exc_info))
+      return
+    self.__finished.add(t)
+    if self.__on_done is not None:
+      self.__on_done(t)
+    for succ in self.__dependents[t]:
+      self.__waiting[succ] -= 1
+      if self.__waiting[succ] == 0:
+        heapq.heappush(self.__ready, self.__position[succ])
+
+  def __drain_threads(self):
+    try:
+      while os.read(self.__wake_r, CHUNK_SIZE):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+    while True:
+      try:
+        t, exc_info = self.__thread_done.get_nowait()
+      except Queue.Empty:
+        return
+      self.__done(t, exc_info)
+
+  def __work(self):
+    while True:
+      t = self.__thread_jobs.get()
+      if t is None:
+        return
+      try:
+        realize_guarded(t, self.__guard)
+      except:
+        self.__thread_done.put((t, sys.exc_info()))
+      else:
+        self.__thread_done.put((t, None))
+      self.__wake()
@@ -0,0 +1,86 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Selecting the resources a partial run is about.
+
+A selector matches resources by type name, by some of their
+identifying attributes, and by tag (see ResourceGraph.add_resource).
+Its text form, used on the command line, is::
+
+  [Type][:attr=value[,attr=value...]][@tag]
+
+for example C{Redmine:name=main}, C{@billing}, or C{Directory@web}.
+Attribute values given as text match attributes of any type
+with the same text form.
+"""
+
+__all__ = ('Selector', 'parse_selectors', )
+
+
+class Selector(object):
+  """
+  Matches resources by type, identifying attributes and tag.
+  """
+
+  def __init__(self, type_name=None, id_attrs=None, tag=None):
+    if type_name is None and not id_attrs and tag is None:
+      raise ValueError('An empty selector matches everything')
+    self.type_name = type_name
+    self.id_attrs = dict(id_attrs or {})
+    self.tag = tag
+
+  @classmethod
+  def parse(cls, spec):
+    """
+    Build a selector from its text form.
+    """
+
+    rest, sep, tag = spec.partition('@')
+    if not sep:
+      tag = None
+    elif not tag:
+      raise ValueError('Empty tag', spec)
+    type_name, sep, attrs = rest.partition(':')
+    id_attrs = {}
+    if sep:
+      for item in attrs.split(','):
+        name, sep, value = item.partition('=')
+        if not sep or not name:
+          raise ValueError('Expected attr=value', spec, item)
+        id_attrs[name] = value
+    return cls(type_name or None, id_attrs, tag)
+
+  def __str__(self):
+    spec = self.type_name or ''
+    if self.id_attrs:
+      spec += ':' + ','.join('%s=%s' % item
+          for item in sorted(self.id_attrs.iteritems()))
+    if self.tag is not None:
+      spec += '@' + self.tag
+    return spec
+
+  def __repr__(self):
+    return '<Selector %s>' % self
+
+  def matches(self, res, tags=()):
+    """
+    Whether res, which has tags, is selected.
+    """
+
+    if self.type_name is not None and res.rtype.name != self.type_name:
+      return False
+    if self.tag is not None and self.tag not in tags:
+      return False
+    for (name, value) in self.id_attrs.iteritems():
+      if name not in res.rtype.id_type.atypes:
+        return False
+      attr = res.id_attrs[name]
+      if attr != value and not (
+          isinstance(value, basestring) and unicode(attr) == value):
+        return False
+    return True
+
+
+def parse_selectors(specs):
+  return [Selector.parse(spec) for spec in specs]
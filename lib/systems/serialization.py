@@ -0,0 +1,427 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Writing graphs and plans as YAML streams, and reading them back.
+
+A stream is a sequence of small documents: a header, then a record
+per node or transition, in topological order. Resources and references
+to them get a document of their own the first time they are used,
+and are then referred to by id (!res, !ref); each is written once
+however many records use it. Functions are written by module and name,
+methods by their instance and name. Transitions keep their results.
+Graphs also keep their expansion history: what expanded into each node,
+and the resources and aggregates that were processed, with what
+replaced them; aggregates are only known by their class.
+
+  --- !plan {format: 1}
+  --- !resource {id: 0, id_attrs: {path: /srv}, type: Directory,
+    wanted: {mode: '0755'}}
+  --- !transition {depends: [], owner: Directory(path='/srv'), instr:
+    {function: !method {name: _realize, of: !res 0}}, type: PythonCode}
+
+Documents are loaded one at a time as the stream is read, so large
+plans load without building the tree of the whole stream. When PyYAML
+was built with libyaml, its C parser and emitter are used.
+"""
+
+import sys
+import types
+
+import yaml
+
+from systems.collector import Aggregate
+from systems.context import (ResourceGraph, CheckPointNode,
+    BeforeExpandableNode, AfterExpandableNode)
+from systems.plan import Plan
+from systems.plancache import reduce_method
+from systems.registry import get_registry
+from systems.typesystem import ResourceBase, ResourceRef, Transition
+
+__all__ = ('dump_plan', 'load_plan', 'dump_graph', 'load_graph', )
+
+
+# Bump when records change.
+FORMAT_VERSION = 2
+
+_BaseDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+_BaseLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class _Doc(object):
+  # A document of the stream: a tagged mapping.
+
+  def __init__(self, tag, mapping):
+    self.tag = tag
+    self.mapping = mapping
+
+
+class _Dumper(_BaseDumper):
+  # ids maps id() of resources and references to their ids.
+  ids = None
+
+def _represent_doc(dumper, doc):
+  return dumper.represent_mapping(doc.tag, doc.mapping)
+
+def _represent_str(dumper, data):
+  # The safe representer would load non-ascii str back as unicode.
+  try:
+    data.decode('ascii')
+  except UnicodeDecodeError:
+    try:
+      text = data.decode('utf-8')
+    except UnicodeDecodeError:
+      return dumper.represent_scalar(u'tag:yaml.org,2002:binary',
+          data.encode('base64'), style='|')
+    return dumper.represent_scalar(u'tag:yaml.org,2002:python/str', text)
+  return dumper.represent_scalar(u'tag:yaml.org,2002:str', unicode(data))
+
+def _represent_unicode(dumper, data):
+  # Likewise, it would load ascii unicode back as str.
+  return dumper.represent_scalar(u'tag:yaml.org,2002:python/unicode', data)
+
+def _represent_tuple(dumper, data):
+  return dumper.represent_sequence(u'tag:yaml.org,2002:python/tuple', data)
+
+def _represent_resource(dumper, data):
+  return dumper.represent_scalar(u'!res', unicode(dumper.ids[id(data)]))
+
+def _represent_ref(dumper, data):
+  return dumper.represent_scalar(u'!ref', unicode(dumper.ids[id(data)]))
+
+def _represent_aggregate(dumper, data):
+  return dumper.represent_scalar(u'!agg', unicode(dumper.ids[id(data)]))
+
+def _represent_function(dumper, data):
+  module = sys.modules.get(data.__module__)
+  if getattr(module, data.__name__, None) is not data:
+    # Lambdas, nested functions.
+    raise TypeError('Only module level functions can be written', data)
+  return dumper.represent_scalar(u'!function',
+      u'%s:%s' % (data.__module__, data.__name__))
+
+def _represent_method(dumper, data):
+  owner, name = reduce_method(data)[1]
+  return dumper.represent_mapping(u'!method', {'of': owner, 'name': name})
+
+_Dumper.add_representer(_Doc, _represent_doc)
+_Dumper.add_representer(str, _represent_str)
+_Dumper.add_representer(unicode, _represent_unicode)
+_Dumper.add_representer(tuple, _represent_tuple)
+_Dumper.add_multi_representer(ResourceBase, _represent_resource)
+_Dumper.add_representer(ResourceRef, _represent_ref)
+_Dumper.add_multi_representer(Aggregate, _represent_aggregate)
+_Dumper.add_representer(types.FunctionType, _represent_function)
+_Dumper.add_representer(types.BuiltinFunctionType, _represent_function)
+_Dumper.add_representer(types.MethodType, _represent_method)
+
+
+class _Writer(object):
+  # Writes records, after the resources and references they use.
+
+  def __init__(self, f):
+    self.__dumper = _Dumper(f, explicit_start=True, default_flow_style=True)
+    self.__dumper.ids = {}
+    # Keeps what is in ids alive.
+    self.__defined = []
+    self.__dumper.open()
+
+  def __define(self, value):
+    ids = self.__dumper.ids
+    if isinstance(value, (ResourceBase, ResourceRef, Aggregate)):
+      if id(value) in ids:
+        return
+      if isinstance(value, Aggregate):
+        doc = _Doc(u'!aggregate', {'id': len(self.__defined),
+          'class': type(value).__name__})
+      elif isinstance(value, ResourceBase):
+        id_attrs = dict(value.id_attrs.iter_nondefault_attrs())
+        wanted = dict(value.wanted_attrs.iter_nondefault_attrs())
+        self.__define(id_attrs)
+        self.__define(wanted)
+        doc = _Doc(u'!resource', {'id': len(self.__defined),
+          'type': value.rtype.name, 'id_attrs': id_attrs, 'wanted': wanted})
+      else:
+        self.__define(value.unref)
+        doc = _Doc(u'!reference', {'id': len(self.__defined),
+          'target': value.unref})
+      ids[id(value)] = len(self.__defined)
+      self.__defined.append(value)
+      self.__dumper.represent(doc)
+    elif isinstance(value, (list, tuple)):
+      for item in value:
+        self.__define(item)
+    elif isinstance(value, dict):
+      for item in value.itervalues():
+        self.__define(item)
+    elif isinstance(value, types.MethodType):
+      self.__define(value.im_self)
+
+  def write(self, tag, mapping):
+    self.__define(mapping)
+    self.__dumper.represent(_Doc(tag, mapping))
+
+  def close(self):
+    self.__dumper.close()
+    self.__dumper.dispose()
+
+
+class _Loader(_BaseLoader):
+  # objects maps ids to the resources and references they stand for.
+  objects = None
+
+def _construct_by_id(loader, node):
+  return loader.objects[int(loader.construct_scalar(node))]
+
+def _construct_resource(loader, node):
+  mp = loader.construct_mapping(node, deep=True)
+  rtype = get_registry().resource_types.lookup(mp['type'])
+  loader.objects[mp['id']] = rtype.make_instance_sep(
+      mp['id_attrs'], mp['wanted'])
+
+def _construct_reference(loader, node):
+  mp = loader.construct_mapping(node, deep=True)
+  loader.objects[mp['id']] = ResourceRef(mp['target'])
+
+def _construct_aggregate(loader, node):
+  mp = loader.construct_mapping(node)
+  loader.objects[mp['id']] = _aggregate_class(mp['class'])()
+
+def _construct_function(loader, node):
+  module, sep, name = loader.construct_scalar(node).partition(':')
+  __import__(module)
+  return getattr(sys.modules[module], name)
+
+def _construct_method(loader, node):
+  mp = loader.construct_mapping(node, deep=True)
+  return getattr(mp['of'], mp['name'])
+
+def _construct_str(loader, node):
+  return loader.construct_scalar(node).encode('utf-8')
+
+def _construct_unicode(loader, node):
+  return unicode(loader.construct_scalar(node))
+
+def _construct_tuple(loader, node):
+  return tuple(loader.construct_sequence(node, deep=True))
+
+def _construct_record(loader, node):
+  return (node.tag, loader.construct_mapping(node, deep=True))
+
+_Loader.add_constructor(u'!res', _construct_by_id)
+_Loader.add_constructor(u'!ref', _construct_by_id)
+_Loader.add_constructor(u'!agg', _construct_by_id)
+_Loader.add_constructor(u'!resource', _construct_resource)
+_Loader.add_constructor(u'!reference', _construct_reference)
+_Loader.add_constructor(u'!aggregate', _construct_aggregate)
+_Loader.add_constructor(u'!function', _construct_function)
+_Loader.add_constructor(u'!method', _construct_method)
+_Loader.add_constructor(u'tag:yaml.org,2002:python/str', _construct_str)
+_Loader.add_constructor(u'tag:yaml.org,2002:python/unicode',
+    _construct_unicode)
+_Loader.add_constructor(u'tag:yaml.org,2002:python/tuple', _construct_tuple)
+for tag in (u'!plan', u'!graph', u'!transition', u'!node', u'!processed'):
+  _Loader.add_constructor(tag, _construct_record)
+del tag
+
+def _iter_records(f, header_tag):
+  # (tag, mapping) pairs of the records after the header.
+  loader = _Loader(f)
+  loader.objects = {}
+  try:
+    header = None
+    while loader.check_data():
+      record = loader.get_data()
+      if record is None:
+        # A definition.
+        continue
+      if header is None:
+        header = record
+        if header[0] != header_tag \
+            or header[1].get('format') != FORMAT_VERSION:
+          raise ValueError('Not a stream this can read', header)
+        continue
+      yield record
+  finally:
+    loader.dispose()
+
+
+def _transition_record(t):
+  record = {
+      'type': t.ttype.name,
+      'instr': dict(t.instr_attrs.iter_nondefault_attrs()),
+      }
+  if t.is_realized:
+    record['results'] = dict(t.results_attrs.iteritems())
+  return record
+
+def _make_transition(record):
+  ttype = get_registry().transition_types.lookup(record['type'])
+  t = ttype.make_instance(record['instr'])
+  if 'results' in record:
+    t._record_results(record['results'])
+  return t
+
+
+def dump_plan(plan, f):
+  """
+  Write plan to the file f.
+  """
+
+  writer = _Writer(f)
+  writer.write(u'!plan', {'format': FORMAT_VERSION})
+  position = {}
+  for t in plan.transitions:
+    record = _transition_record(t)
+    record['depends'] = [position[pred] for pred in plan.depends[t]]
+    owner = plan.owners.get(t)
+    if owner is not None:
+      record['owner'] = owner
+    writer.write(u'!transition', record)
+    position[t] = len(position)
+  writer.close()
+
+def load_plan(f):
+  """
+  Read a plan written by dump_plan from the file f.
+  """
+
+  transitions = []
+  depends = {}
+  owners = {}
+  for (tag, record) in _iter_records(f, u'!plan'):
+    t = _make_transition(record)
+    depends[t] = tuple(transitions[i] for i in record['depends'])
+    if 'owner' in record:
+      owners[t] = record['owner']
+    transitions.append(t)
+  return Plan.from_reduced(transitions, depends, owners)
+
+
+class _Aggregate(Aggregate):
+  # Stands for an expanded aggregate in a loaded graph,
+  # subclassed under the name of the class of the aggregate.
+
+  def __str__(self):
+    return '<%s>' % type(self).__name__
+
+_aggregate_classes = {}
+
+def _aggregate_class(name):
+  cls = _aggregate_classes.get(name)
+  if cls is None:
+    cls = _aggregate_classes[name] = type(str(name), (_Aggregate, ), {})
+  return cls
+
+
+def _node_record(rg, node):
+  if node is rg._first:
+    return {'first': True}
+  if node is rg._last:
+    return {'last': True}
+  if isinstance(node, Transition):
+    return {'transition': _transition_record(node)}
+  if isinstance(node, ResourceBase):
+    return {'resource': node}
+  if isinstance(node, ResourceRef):
+    return {'ref': node}
+  if isinstance(node, CheckPointNode):
+    return {'checkpoint': True}
+  if isinstance(node, (BeforeExpandableNode, AfterExpandableNode)):
+    return {'after': isinstance(node, AfterExpandableNode),
+        'expanded': node._res}
+  # Unexpanded aggregates only exist while collecting.
+  raise TypeError('Can\'t write node', node)
+
+def _make_node(rg, record):
+  if 'first' in record:
+    return rg._first
+  if 'last' in record:
+    return rg._last
+  if 'transition' in record:
+    return _make_transition(record['transition'])
+  if 'resource' in record:
+    return record['resource']
+  if 'ref' in record:
+    return record['ref']
+  if 'checkpoint' in record:
+    return CheckPointNode()
+  if record['after']:
+    return AfterExpandableNode(record['expanded'])
+  return BeforeExpandableNode(record['expanded'])
+
+def _add_history(record, node, owners, members, tags, shared):
+  # What expanded into node, and what node stands for.
+  owner = owners.get(node)
+  if owner is not None:
+    record['owner'] = owner
+  if node in members:
+    record['members'] = list(members[node])
+  if isinstance(node, ResourceBase):
+    if tags.get(node.identity):
+      record['tags'] = sorted(tags[node.identity])
+    if node in shared:
+      record['shared'] = True
+
+
+def dump_graph(rg, f):
+  """
+  Write the nodes and edges of the ResourceGraph rg to the file f.
+  """
+
+  writer = _Writer(f)
+  writer.write(u'!graph', {'format': FORMAT_VERSION})
+  owners, replaced, members, tags, shared = rg._history()
+  position = {}
+  for node in rg.sorted_nodes():
+    record = _node_record(rg, node)
+    record['depends'] = sorted(position[pred]
+        for pred in rg._graph.predecessors_iter(node))
+    _add_history(record, node, owners, members, tags, shared)
+    writer.write(u'!node', record)
+    position[node] = len(position)
+
+  # Processed nodes, in the order of what stands for them now.
+  def ends(node):
+    first, last = replaced[node]
+    while first not in position:
+      first = replaced[first][0]
+    while last not in position:
+      last = replaced[last][1]
+    return (position[first], position[last])
+  def end(node):
+    return position.get(node, node)
+  for node in sorted(replaced, key=lambda node: (ends(node), repr(node))):
+    first, last = replaced[node]
+    record = {'node': node, 'replaced': [end(first), end(last)]}
+    _add_history(record, node, owners, members, tags, shared)
+    writer.write(u'!processed', record)
+  writer.close()
+
+def load_graph(f):
+  """
+  Read a graph written by dump_graph from the file f.
+
+  The nodes, edges and expansion history are the same,
+  but expanded aggregates are only known by their class.
+  """
+
+  rg = ResourceGraph()
+  nodes = []
+  for (tag, record) in _iter_records(f, u'!graph'):
+    if tag == u'!node':
+      node = _make_node(rg, record)
+      rg._restore_node(node, [nodes[i] for i in record['depends']],
+          record.get('owner'))
+      nodes.append(node)
+    else:
+      node = record['node']
+      replaced = tuple(
+          isinstance(end, int) and nodes[end] or end
+          for end in record['replaced'])
+      rg._restore_processed(node, record.get('owner'), replaced,
+          record.get('members'))
+    if isinstance(node, ResourceBase):
+      rg._restore_marks(node, record.get('tags', ()),
+          record.get('shared', False))
+  return rg
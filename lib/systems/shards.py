@@ -0,0 +1,257 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Freezing and realizing a manifest in several processes.
+
+Once the manifest is expanded at the top, its weakly connected
+components (see ResourceGraph.top_components) have nothing to do with
+each other; they are dealt into shards, each of which is frozen and
+realized by a forked worker with its own Realizer.
+
+What expansions put at the top with add_to_top (a package many
+components need, say) may be wanted by several shards. Workers report
+those shared resources once frozen; a coordinator, in this process,
+realizes them first, then lets the workers realize the rest.
+
+Collected resources are only merged within a shard, and shards run
+concurrently; the commands of aggregates take a system-wide lock
+(dpkg's) and fail when another holds it, so workers realize the
+transitions of aggregates one at a time, under a HostLock
+(see Realizer's aggregate_lock).
+
+Each worker journals to its own file next to the journal it was given,
+and opens its own connection to the state store; the coordinator
+journals to another one.
+"""
+
+import cPickle as pickle
+import os
+import sys
+import tempfile
+import traceback
+from logging import getLogger
+
+from systems.context import Realizer, ResourceGraph
+from systems.locks import HostLock
+from systems.typesystem import FunExpandable
+
+__all__ = ('ShardedRealizer', 'ShardError', )
+
+
+LOGGER = getLogger(__name__)
+
+# The Realizer arguments that apply to the coordinator.
+COORDINATOR_KARGS = ('expand_jobs', 'graph_backend', 'state_store',
+    'force_verify', 'journal', 'resume', 'expansion_memo', 'lock_manager',
+    'probes', )
+
+
+class ShardError(RuntimeError):
+  """
+  Some shards failed; report has the details.
+  """
+
+  def __init__(self, report):
+    RuntimeError.__init__(self, [entry['shard'] for entry in report
+      if entry['error'] is not None])
+    self.report = report
+
+
+class _Worker(object):
+  # A forked process and the pipes to talk to it.
+
+  def __init__(self, index, main):
+    to_child_r, to_child_w = os.pipe()
+    from_child_r, from_child_w = os.pipe()
+    self.index = index
+    self.pid = os.fork()
+    if self.pid == 0:
+      os.close(to_child_w)
+      os.close(from_child_r)
+      status = 0
+      try:
+        main(index, _Channel(to_child_r, from_child_w))
+      except:
+        traceback.print_exc()
+        status = 1
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(status)
+    os.close(to_child_r)
+    os.close(from_child_w)
+    self.channel = _Channel(from_child_r, to_child_w)
+
+  def wait(self):
+    self.channel.close()
+    os.waitpid(self.pid, 0)
+
+
+class _Channel(object):
+  # Pickled messages over a pair of pipes.
+
+  def __init__(self, rfd, wfd):
+    self.__rfile = os.fdopen(rfd, 'rb')
+    self.__wfile = os.fdopen(wfd, 'wb')
+
+  def send(self, msg):
+    pickle.dump(msg, self.__wfile, pickle.HIGHEST_PROTOCOL)
+    self.__wfile.flush()
+
+  def recv(self):
+    try:
+      return pickle.load(self.__rfile)
+    except EOFError:
+      return ('error', 'Worker exited unexpectedly')
+
+  def close(self):
+    self.__rfile.close()
+    self.__wfile.close()
+
+
+class ShardedRealizer(object):
+  """
+  Realizes an expandable, in up to processes worker processes.
+  """
+
+  def __init__(self, expandable, processes=4, **kargs):
+    """
+    kargs are passed to every Realizer, but for shard, which is
+    set for each worker; the coordinator only gets those
+    in COORDINATOR_KARGS. Unless given, workers get an aggregate_lock
+    on a temporary file.
+    """
+
+    if processes < 1:
+      raise ValueError(processes)
+    if 'shard' in kargs:
+      raise TypeError('ShardedRealizer sets the shard of each worker')
+    self.__expandable = expandable
+    self.__processes = processes
+    self.__kargs = kargs
+    self.report = None
+
+  def count_shards(self):
+    # One top expansion to count the components.
+    rg = ResourceGraph()
+    self.__expandable.expand_into(rg)
+    return min(self.__processes, len(rg.top_components())) or 1
+
+  def realize(self, jobs=None, engine='threads'):
+    """
+    Realize everything; jobs and engine are as in Realizer.realize,
+    for each shard.
+
+    Returns a report, a list with an entry per shard;
+    the coordinator is shard None. Raises ShardError
+    if a shard failed, after all shards are done.
+    """
+
+    count = self.count_shards()
+    if count == 1:
+      r = Realizer(self.__expandable, **self.__kargs)
+      self.report = [self.__entry(None, lambda: r.realize(jobs, engine))]
+      self.__check()
+      return self.report
+
+    worker_kargs = dict(self.__kargs)
+    lock_path = None
+    if worker_kargs.get('aggregate_lock') is None:
+      fd, lock_path = tempfile.mkstemp(prefix='systems-', suffix='.lock')
+      os.close(fd)
+      worker_kargs['aggregate_lock'] = HostLock(lock_path)
+
+    def main(index, channel):
+      kargs = self.__shard_kargs(index, worker_kargs)
+      if kargs.get('state_store') is not None:
+        kargs['state_store'] = kargs['state_store'].reopen()
+      r = Realizer(self.__expandable, shard=(index, count), **kargs)
+      try:
+        shared = r.shared_resources()
+      except:
+        channel.send(('error', traceback.format_exc()))
+        return
+      channel.send(('frozen', shared))
+      if channel.recv() != 'go':
+        return
+      channel.send(('done', self.__entry(index,
+        lambda: r.realize(jobs, engine, realized_elsewhere=shared))))
+
+    workers = []
+    try:
+      for index in xrange(count):
+        workers.append(_Worker(index, main))
+      self.report = []
+      shared = {}
+      frozen = []
+      for worker in workers:
+        kind, value = worker.channel.recv()
+        if kind == 'error':
+          self.report.append(self.__failed(worker.index, value))
+          continue
+        frozen.append(worker)
+        for res in value:
+          if shared.setdefault(res.identity, res) != res:
+            raise RuntimeError('ResourceBase collision.', res)
+
+      if len(frozen) == count:
+        entry = self.__realize_shared(shared.values(), jobs, engine)
+      else:
+        entry = self.__failed(None, 'Not realized, some shards failed')
+      self.report.insert(0, entry)
+      if entry['error'] is not None:
+        for worker in frozen:
+          worker.channel.send('abort')
+        frozen = []
+      for worker in frozen:
+        worker.channel.send('go')
+      for worker in frozen:
+        kind, value = worker.channel.recv()
+        if kind == 'done':
+          self.report.append(value)
+        elif kind == 'error':
+          self.report.append(self.__failed(worker.index, value))
+    finally:
+      for worker in workers:
+        worker.wait()
+      if lock_path is not None:
+        os.unlink(lock_path)
+    self.__check()
+    return self.report
+
+  def __realize_shared(self, resources, jobs, engine):
+    def expand(rg):
+      for res in resources:
+        rg.add_resource(res)
+    kargs = dict((key, value) for (key, value) in self.__kargs.iteritems()
+        if key in COORDINATOR_KARGS)
+    r = Realizer(FunExpandable(expand),
+        **self.__shard_kargs('shared', kargs))
+    return self.__entry(None, lambda: r.realize(jobs, engine))
+
+  @classmethod
+  def __shard_kargs(cls, name, kargs):
+    # kargs, with the journal of the shard called name.
+    kargs = dict(kargs)
+    if kargs.get('journal') is not None:
+      kargs['journal'] = kargs['journal'].for_shard(name)
+    return kargs
+
+  @classmethod
+  def __entry(cls, index, realize):
+    try:
+      count = realize()
+    except:
+      LOGGER.error('Shard %s failed', index)
+      return cls.__failed(index, traceback.format_exc())
+    return {'shard': index, 'transitions': count, 'error': None, }
+
+  @classmethod
+  def __failed(cls, index, error):
+    return {'shard': index, 'transitions': None, 'error': error, }
+
+  def __check(self):
+    for entry in self.report:
+      if entry['error'] is not None:
+        raise ShardError(self.report)
+
@@ -0,0 +1,103 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+Remembering what converged, across runs.
+
+After a successful realization, every resource whose type has a
+validity token (see ResourceType) is recorded with a fingerprint of
+its wanted attributes and the current value of the token.
+On the next run, a resource whose fingerprint and token are unchanged
+is known to be in the wanted state already; it is neither expanded
+nor collected, which also saves the probes expansion does.
+"""
+
+import hashlib
+import os
+import sqlite3
+from logging import getLogger
+
+__all__ = ('StateStore', )
+
+
+LOGGER = getLogger(__name__)
+
+DEFAULT_PATH = '/var/lib/systems/state.sqlite'
+
+
+def _attrs_repr(attrs):
+  return repr(sorted(attrs.iteritems()))
+
+def identity_key(res):
+  return '%s:%s' % (res.rtype.name,
+      hashlib.sha1(_attrs_repr(res.id_attrs)).hexdigest())
+
+def fingerprint(res):
+  return hashlib.sha1(_attrs_repr(res.wanted_attrs)).hexdigest()
+
+def read_token(res):
+  return repr(res.rtype.validity_token(res.id_attrs))
+
+
+class StateStore(object):
+  """
+  An sqlite database of converged resources.
+  """
+
+  def __init__(self, path=DEFAULT_PATH):
+    self.__path = path
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    self.__conn = sqlite3.connect(path)
+    self.__conn.execute('''
+        CREATE TABLE IF NOT EXISTS converged (
+          identity TEXT PRIMARY KEY,
+          fingerprint TEXT NOT NULL,
+          token TEXT NOT NULL)''')
+    self.__conn.commit()
+
+  def reopen(self):
+    """
+    Another connection to the same database.
+
+    A connection mustn't be used across fork; a forked process
+    opens its own.
+    """
+
+    return type(self)(self.__path)
+
+  def close(self):
+    self.__conn.close()
+
+  def is_converged(self, res):
+    """
+    Whether res was converged, and nothing changed since.
+    """
+
+    if res.rtype.validity_token is None:
+      return False
+    row = self.__conn.execute(
+        'SELECT fingerprint, token FROM converged WHERE identity = ?',
+        (identity_key(res), )).fetchone()
+    if row is None:
+      return False
+    return row == (fingerprint(res), read_token(res))
+
+  def record(self, resources):
+    """
+    Record resources as converged, reading their tokens now.
+    """
+
+    rows = [(identity_key(res), fingerprint(res), read_token(res))
+        for res in resources
+        if res.rtype.validity_token is not None]
+    self.__conn.executemany(
+        'INSERT OR REPLACE INTO converged VALUES (?, ?, ?)', rows)
+    self.__conn.commit()
+    LOGGER.debug('Recorded %d converged resources', len(rows))
+
+  def clear(self):
+    self.__conn.execute('DELETE FROM converged')
+    self.__conn.commit()
+
@@ -5,6 +5,7 @@ from logging import getLogger
 
 import yaml
 
+from systems.probes import probe, record_read
 from systems.util.contracts import ContractSupportBase, precondition
 from systems.util.datatypes import ImmutableDict, Named
 
@@ -212,7 +213,8 @@ class SimpleType(object):
 
 class ResourceType(Named):
   def __init__(self,
-      name, instance_class, id_type, state_type, global_reader=None):
+      name, instance_class, id_type, state_type, global_reader=None,
+      validity_token=None, pure=False, probes=()):
     """
     Build a ResouceType.
 
@@ -224,6 +226,14 @@ class ResourceType(Named):
     state_type is like id_type for our state type.
     global_reader is a function that reads the current system state,
     if passed identity attributes.
+    validity_token is a cheap function of identity attributes
+    (an mtime, an inode number) whose value changes whenever the state
+    of the resource may have; see systems.statestore.
+    pure declares that expand_into only depends on the attributes,
+    and reads no system state; see systems.expansionmemo.
+    probes names the state attributes expand_into reads; their readers
+    must not change the system, and are run ahead, as a batch
+    (see systems.probes).
     """
 
     if not issubclass(instance_class, ResourceBase):
@@ -234,6 +244,12 @@ class ResourceType(Named):
     self.__id_type = SimpleType(id_type)
     self.__state_type = SimpleType(state_type)
     self.__global_reader = global_reader
+    self.__validity_token = validity_token
+    self.__pure = pure
+    for name in probes:
+      if name not in self.__state_type.atypes:
+        raise KeyError(u'Invalid attribute «%s»' % name)
+    self.__probes = tuple(probes)
 
   def __repr__(self):
     return '<RType %s>' % self.name
@@ -259,6 +275,32 @@ class ResourceType(Named):
     # The only gain is the convenience of being able to write just one method.
     return self.__global_reader
 
+  @property
+  def validity_token(self):
+    """
+    A function to summarize system state, or None.
+
+    Resources of types without one are always verified.
+    """
+
+    return self.__validity_token
+
+  @property
+  def pure(self):
+    """
+    Whether expansions can be memoized.
+    """
+
+    return self.__pure
+
+  @property
+  def probes(self):
+    """
+    The state attributes expansions read.
+    """
+
+    return self.__probes
+
   def _separate_valdict(self, valdict):
     id_valdict = dict((k, v)
         for (k, v) in valdict.iteritems()
@@ -359,22 +401,29 @@ class ReadAttrs(object):
   Attributes read from system state.
   """
 
-  def __init__(self, id_attrs, state_type, global_reader):
+  def __init__(self, id_attrs, rtype):
     self.__id_attrs = id_attrs
-    self.__state_type = state_type
-    self.__global_reader = global_reader
+    self.__rtype_name = rtype.name
+    self.__state_type = rtype.state_type
+    self.__global_reader = rtype.global_reader
 
   def __getitem__(self, key):
+    val = self.__read(key)
+    record_read(self.__rtype_name, self.__id_attrs, key, val)
+    return val
+
+  def __read(self, key):
     attr = self.__state_type.atypes[key]
 
     if self.__global_reader is None:
-      return attr.read_value(self.__id_attrs)
+      return probe((attr, self.__id_attrs), attr.read_value, self.__id_attrs)
 
-    r = self.__global_reader(self.__id_attrs)
+    r = probe((self.__global_reader, self.__id_attrs),
+        self.__global_reader, self.__id_attrs)
     if r == NotImplemented:
       # Try again without a global_reader
       self.__global_reader = None
-      return self[key]
+      return self.__read(key)
 
     val = r[key]
     attr.require_valid_value(val)
@@ -414,8 +463,7 @@ class ResourceBase(ContractSupportBase):
     self.__rtype = rtype
     self.__id_attrs = Attrs(rtype.id_type, id_valdict)
     self.__wanted_attrs = Attrs(rtype.state_type, wanted_valdict)
-    self.__read_attrs = ReadAttrs(
-        self.id_attrs, self.rtype.state_type, self.rtype.global_reader)
+    self.__read_attrs = ReadAttrs(self.id_attrs, rtype)
 
   @property
   def id_attrs(self):
@@ -457,6 +505,12 @@ class ResourceBase(ContractSupportBase):
   def rtype(self):
     return self.__rtype
 
+  def __reduce__(self):
+    # Types hold validation functions, they are looked up by name instead.
+    return (_rebuild_resource, (self.rtype.name,
+      dict(self.id_attrs.iteritems()),
+      dict(self.wanted_attrs.iteritems())))
+
   def iter_passed_by_ref(self):
     for item in self.id_attrs.iter_passed_by_ref():
       yield item
@@ -560,6 +614,10 @@ class Transition(object):
         Attrs(ttype.instr_type, instr_valdict)
     self.__results_attrs = None
 
+  @property
+  def ttype(self):
+    return self.__ttype
+
   @property
   def instr_attrs(self):
     return self.__instructions_attrs
@@ -573,18 +631,46 @@ class Transition(object):
   def realize_impl(self):
     raise NotImplementedError
 
-  def realize(self):
+  # Transitions that only wait on child processes may also be realized
+  # on an event loop. They set this to a generator method, see
+  # systems.reactor for the protocol.
+  realize_coroutine_impl = None
+
+  @property
+  def is_realized(self):
+    return self.__results_attrs is not None
+
+  def invalidate(self):
+    """
+    Forget the results, so that the transition is realized again.
+    """
+
+    self.__results_attrs = None
+
+  def _require_unrealized(self):
     if self.__results_attrs is not None:
       raise RuntimeError('realize cannot be called more than once')
-    results = self.realize_impl()
+
+  def _record_results(self, results):
     self.__results_attrs = Attrs(self.__ttype.results_type, results)
     return self.__results_attrs
 
+  def realize(self):
+    self._require_unrealized()
+    results = self.realize_impl()
+    return self._record_results(results)
+
   def __repr__(self):
     l = list()
     l.extend(', %s=%r' % e for e in self.instr_attrs.iter_nondefault_attrs())
     return 'transition(%r%s)' % (self.__ttype.name, ''.join(l))
 
+  def __reduce__(self):
+    # Only unrealized transitions are pickled, see systems.plancache.
+    self._require_unrealized()
+    return (_rebuild_transition, (self.__ttype.name,
+      dict(self.instr_attrs.iteritems())))
+
   yaml_tag_prefix = u'!Transition:'
 
   @classmethod
@@ -610,3 +696,12 @@ class Transition(object):
 Transition.register_yaml()
 
 
+def _rebuild_resource(rtype_name, id_valdict, wanted_valdict):
+  from systems.registry import get_registry
+  rtype = get_registry().resource_types.lookup(rtype_name)
+  return rtype.make_instance_sep(id_valdict, wanted_valdict)
+
+def _rebuild_transition(ttype_name, instr_valdict):
+  from systems.registry import get_registry
+  ttype = get_registry().transition_types.lookup(ttype_name)
+  return ttype.make_instance(instr_valdict)
@@ -0,0 +1,53 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import sys
+import threading
+import Queue
+
+__all__ = ('parallel_map', )
+
+
+def parallel_map(func, items, jobs=1):
+  """
+  Like map, with at most jobs calls running at once on threads.
+
+  All calls are waited for; if some raised, the exception
+  of the first failed item (in items order) is raised.
+  """
+
+  items = list(items)
+  if jobs < 1:
+    raise ValueError(jobs)
+  if jobs == 1 or len(items) < 2:
+    return map(func, items)
+
+  todo = Queue.Queue()
+  for pair in enumerate(items):
+    todo.put(pair)
+  results = [None] * len(items)
+  failures = []
+
+  def work():
+    while True:
+      try:
+        i, item = todo.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = func(item)
+      except:
+        failures.append((i, sys.exc_info()))
+
+  workers = [threading.Thread(target=work)
+      for j in xrange(min(jobs, len(items)))]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+
+  if failures:
+    failures.sort()
+    exc_type, exc_value, exc_tb = failures[0][1]
+    raise exc_type, exc_value, exc_tb
+  return results
@@ -0,0 +1,206 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+A directed graph on integer ids.
+
+Nodes are hashed once, when they are looked up; adjacency is stored
+as sets of small integers in lists indexed by node id. Resources
+and transitions have expensive hashes, and this keeps graph edits
+and traversals from recomputing them.
+
+Besides the subset of networkx's DiGraph that ResourceGraph uses,
+the graph can be read and extended by id; TopoOrder runs on ids.
+NetworkxDAG gives a networkx DiGraph the same interface, nodes being
+their own ids.
+"""
+
+__all__ = ('DAG', 'NetworkxDAG', 'to_networkx', )
+
+
+class DAG(object):
+  """
+  A directed graph, with the DiGraph methods used by ResourceGraph.
+
+  Acyclicity isn't checked here, see TopoOrder.
+  """
+
+  def __init__(self):
+    # node -> id
+    self.__ids = {}
+    # id -> node, None for deleted nodes.
+    self.__nodes = []
+    # id -> set of ids
+    self.__succ = []
+    self.__pred = []
+    # Ids of deleted nodes, reused by added ones so that a graph
+    # that keeps changing doesn't keep growing.
+    # Don't hold on to ids across deletions.
+    self.__free = []
+
+  def __len__(self):
+    return len(self.__ids)
+
+  def __contains__(self, node):
+    return node in self.__ids
+
+  def __iter__(self):
+    return self.nodes_iter()
+
+  def has_node(self, node):
+    return node in self.__ids
+
+  def number_of_nodes(self):
+    return len(self.__ids)
+
+  def node_id(self, node):
+    return self.__ids[node]
+
+  def node(self, i):
+    return self.__nodes[i]
+
+  def successor_ids(self, i):
+    return self.__succ[i]
+
+  def predecessor_ids(self, i):
+    return self.__pred[i]
+
+  def add_id_edge(self, i0, i1):
+    self.__succ[i0].add(i1)
+    self.__pred[i1].add(i0)
+
+  def add_node(self, node):
+    """
+    Add node if it isn't there, return its id.
+    """
+
+    try:
+      return self.__ids[node]
+    except KeyError:
+      pass
+    if self.__free:
+      i = self.__free.pop()
+      self.__nodes[i] = node
+      self.__succ[i] = set()
+      self.__pred[i] = set()
+    else:
+      i = len(self.__nodes)
+      self.__nodes.append(node)
+      self.__succ.append(set())
+      self.__pred.append(set())
+    self.__ids[node] = i
+    return i
+
+  def delete_node(self, node):
+    i = self.__ids.pop(node)
+    for j in self.__succ[i]:
+      self.__pred[j].discard(i)
+    for j in self.__pred[i]:
+      self.__succ[j].discard(i)
+    self.__nodes[i] = None
+    self.__succ[i] = None
+    self.__pred[i] = None
+    self.__free.append(i)
+
+  def add_edge(self, node0, node1):
+    # Like networkx, missing nodes are added.
+    self.add_id_edge(self.add_node(node0), self.add_node(node1))
+
+  def delete_edge(self, node0, node1):
+    i0 = self.__ids[node0]
+    i1 = self.__ids[node1]
+    self.__succ[i0].remove(i1)
+    self.__pred[i1].remove(i0)
+
+  def has_edge(self, node0, node1):
+    try:
+      i0 = self.__ids[node0]
+      i1 = self.__ids[node1]
+    except KeyError:
+      return False
+    return i1 in self.__succ[i0]
+
+  def successors_iter(self, node):
+    nodes = self.__nodes
+    return (nodes[j] for j in self.__succ[self.__ids[node]])
+
+  def predecessors_iter(self, node):
+    nodes = self.__nodes
+    return (nodes[j] for j in self.__pred[self.__ids[node]])
+
+  def nodes_iter(self):
+    return self.__ids.iterkeys()
+
+  def edges_iter(self):
+    nodes = self.__nodes
+    for (i, succ) in enumerate(self.__succ):
+      if succ is None:
+        continue
+      for j in succ:
+        yield (nodes[i], nodes[j])
+
+
+class NetworkxDAG(object):
+  """
+  A networkx DiGraph with the interface of DAG.
+
+  Nodes are their own ids.
+  """
+
+  def __init__(self):
+    import networkx as NX
+
+    self.graph = NX.DiGraph()
+    gr = self.graph
+    self.has_node = gr.has_node
+    self.has_edge = gr.has_edge
+    self.number_of_nodes = gr.number_of_nodes
+    self.add_edge = gr.add_edge
+    self.add_id_edge = gr.add_edge
+    self.delete_node = gr.delete_node
+    self.delete_edge = gr.delete_edge
+    self.successors_iter = gr.successors_iter
+    self.predecessors_iter = gr.predecessors_iter
+    self.successor_ids = gr.successors_iter
+    self.predecessor_ids = gr.predecessors_iter
+    self.nodes_iter = gr.nodes_iter
+    self.edges_iter = gr.edges_iter
+
+  def __len__(self):
+    return self.graph.number_of_nodes()
+
+  def __contains__(self, node):
+    return self.graph.has_node(node)
+
+  def __iter__(self):
+    return self.graph.nodes_iter()
+
+  def node_id(self, node):
+    if not self.graph.has_node(node):
+      raise KeyError(node)
+    return node
+
+  def node(self, i):
+    return i
+
+  def add_node(self, node):
+    self.graph.add_node(node)
+    return node
+
+
+def to_networkx(graph):
+  """
+  Copy graph to a networkx DiGraph, for drawing and other exports.
+  """
+
+  import networkx as NX
+
+  if isinstance(graph, NetworkxDAG):
+    return graph.graph
+  gr = NX.DiGraph()
+  for node in graph.nodes_iter():
+    gr.add_node(node)
+  for (n0, n1) in graph.edges_iter():
+    gr.add_edge(n0, n1)
+  return gr
+
@@ -0,0 +1,265 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+An online topological order.
+
+This is the dynamic algorithm of Pearce and Kelly,
+"A dynamic topological sort algorithm for directed acyclic graphs".
+Adding an edge that agrees with the current order costs nothing;
+otherwise only the nodes whose position lies between the two ends
+of the edge are visited and reordered.
+
+Positions are integer labels with gaps, kept along a linked list
+of the nodes, so that a node can be inserted before another one
+where it belongs (add_node's before) instead of at the end,
+where an edge to what comes after it would reorder everything
+in between. When two labels leave no room, the labels around
+are spread again.
+"""
+
+__all__ = ('CycleError', 'TopoOrder', )
+
+
+# Labels between nodes added at the end.
+GAP = 1 << 20
+
+
+class CycleError(Exception):
+  pass
+
+
+class TopoOrder(object):
+  """
+  Maintains a topological order of a graph as edges are added.
+
+  The graph itself isn't stored here; successors and predecessors
+  are functions that read the adjacency of the graph being ordered.
+  Edges must be checked with add_edge _before_ they are added to
+  the graph.
+  """
+
+  def __init__(self, successors, predecessors):
+    self.__successors = successors
+    self.__predecessors = predecessors
+    # Position of every node.
+    self.__ord = {}
+    # The nodes in order, as a doubly linked list ending with None.
+    self.__next = {}
+    self.__prev = {}
+    self.__first = None
+    self.__last = None
+
+  def __len__(self):
+    return len(self.__ord)
+
+  def __contains__(self, node):
+    return node in self.__ord
+
+  def __iter__(self):
+    nxt = self.__next
+    node = self.__first
+    while node is not None:
+      yield node
+      node = nxt[node]
+
+  def add_node(self, node, before=None):
+    """
+    Add node at the end, or right before the node before.
+    """
+
+    if node in self.__ord:
+      return
+    if before is None:
+      prev, nxt = self.__last, None
+    else:
+      prev, nxt = self.__prev[before], before
+    self.__link(node, prev, nxt)
+    ords = self.__ord
+    if nxt is None:
+      if prev is None:
+        ords[node] = 0
+      else:
+        ords[node] = ords[prev] + GAP
+    elif prev is None:
+      ords[node] = ords[nxt] - GAP
+    elif ords[nxt] - ords[prev] > 1:
+      ords[node] = (ords[prev] + ords[nxt]) // 2
+    else:
+      self.__relabel(node)
+
+  def __link(self, node, prev, nxt):
+    self.__prev[node] = prev
+    self.__next[node] = nxt
+    if prev is None:
+      self.__first = node
+    else:
+      self.__next[prev] = node
+    if nxt is None:
+      self.__last = node
+    else:
+      self.__prev[nxt] = node
+
+  def __relabel(self, node):
+    # Give node a label, spreading the labels of a window of nodes
+    # around it; the window doubles until its labels leave room.
+    ords = self.__ord
+    nxt = self.__next
+    prev = self.__prev
+    first = last = node
+    count = 1
+    while True:
+      for i in xrange(count):
+        if prev[first] is not None:
+          first = prev[first]
+          count += 1
+        if nxt[last] is not None:
+          last = nxt[last]
+          count += 1
+      lower = prev[first]
+      upper = nxt[last]
+      if lower is None or upper is None:
+        break
+      if (ords[upper] - ords[lower]) // (count + 1) >= count:
+        break
+    if lower is None and upper is None:
+      start, step = 0, GAP
+    elif lower is None:
+      start, step = ords[upper] - GAP * count, GAP
+    elif upper is None:
+      start, step = ords[lower] + GAP, GAP
+    else:
+      step = (ords[upper] - ords[lower]) // (count + 1)
+      start = ords[lower] + step
+    window = first
+    for i in xrange(count):
+      ords[window] = start + i * step
+      window = nxt[window]
+
+  def remove_node(self, node):
+    del self.__ord[node]
+    prev = self.__prev.pop(node)
+    nxt = self.__next.pop(node)
+    if prev is None:
+      self.__first = nxt
+    else:
+      self.__next[prev] = nxt
+    if nxt is None:
+      self.__last = prev
+    else:
+      self.__prev[nxt] = prev
+
+  def position(self, node):
+    return self.__ord[node]
+
+  def precedes(self, node0, node1):
+    return self.__ord[node0] < self.__ord[node1]
+
+  def has_path(self, node0, node1):
+    """
+    Whether there is a path from node0 to node1.
+
+    Only the nodes positioned between them are visited.
+    """
+
+    if node0 == node1:
+      return True
+    ords = self.__ord
+    upper = ords[node1]
+    if ords[node0] > upper:
+      return False
+    seen = set([node0])
+    stack = [node0]
+    while stack:
+      node = stack.pop()
+      for succ in self.__successors(node):
+        if succ == node1:
+          return True
+        if succ in seen or ords[succ] > upper:
+          continue
+        seen.add(succ)
+        stack.append(succ)
+    return False
+
+  def add_edge(self, node0, node1):
+    """
+    Update the order so that node0 comes before node1.
+
+    Raise CycleError, with a path from node1 to node0,
+    if the edge would close a cycle. The order is unchanged in that case.
+    """
+
+    lower = self.__ord[node1]
+    upper = self.__ord[node0]
+    if upper < lower:
+      # Already in order.
+      return
+    if upper == lower:
+      raise CycleError([node0])
+    fwd = self.__visit_forward(node1, node0, upper)
+    bwd = self.__visit_backward(node0, lower)
+    self.__reorder(bwd, fwd)
+
+  def __visit_forward(self, start, target, upper):
+    # Nodes reachable from start, positioned no further than upper.
+    ords = self.__ord
+    parents = {start: None}
+    stack = [start]
+    while stack:
+      node = stack.pop()
+      for succ in self.__successors(node):
+        if succ in parents:
+          continue
+        pos = ords.get(succ)
+        if pos is None or pos > upper:
+          continue
+        parents[succ] = node
+        if succ == target:
+          path = [succ]
+          while node is not None:
+            path.append(node)
+            node = parents[node]
+          path.reverse()
+          raise CycleError(path)
+        stack.append(succ)
+    return parents.keys()
+
+  def __visit_backward(self, start, lower):
+    # Nodes that reach start, positioned after lower.
+    ords = self.__ord
+    seen = set([start])
+    stack = [start]
+    while stack:
+      node = stack.pop()
+      for pred in self.__predecessors(node):
+        if pred in seen:
+          continue
+        pos = ords.get(pred)
+        if pos is None or pos < lower:
+          continue
+        seen.add(pred)
+        stack.append(pred)
+    return list(seen)
+
+  def __reorder(self, bwd, fwd):
+    # The backward set goes first, the forward set after,
+    # both keeping their relative order, using the same pool of positions.
+    ords = self.__ord
+    key = ords.__getitem__
+    bwd.sort(key=key)
+    fwd.sort(key=key)
+    nodes = bwd + fwd
+    # Each node takes the place of the one at that position before.
+    places = sorted(nodes, key=key)
+    positions = [ords[node] for node in places]
+    moved = dict(zip(places, nodes))
+    prev = self.__prev
+    nxt = self.__next
+    # Neighbours of the new occupants, read before anything changes.
+    links = [(node, moved.get(prev[place], prev[place]),
+      moved.get(nxt[place], nxt[place]))
+      for (place, node) in zip(places, nodes)]
+    for (node, p, n) in links:
+      self.__link(node, p, n)
+    for (pos, node) in zip(positions, nodes):
+      ords[node] = pos
@@ -0,0 +1,22 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+"""
+What the test modules share.
+"""
+
+from systems.pluginmanager import load_plugin
+from systems.registry import get_registry
+
+__all__ = ('load_plugins', )
+
+
+def load_plugins():
+  """
+  Register the bundled plugins, unless another test module did.
+  """
+
+  try:
+    get_registry().transition_types.lookup('PythonCode')
+  except KeyError:
+    load_plugin('systems.plugins')
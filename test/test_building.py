@@ -9,16 +9,14 @@ import yaml
 
 LOGGER = logging.getLogger(__name__)
 
-# Set up a default handler that writes to stderr.
-logging.basicConfig(level=logging.DEBUG)
-
 from systems.context import Realizer
 from systems.dsl import resource, transition
-from systems.pluginmanager import load_plugin
 from systems.typesystem import FunExpandable
 from systems.util.templates import build_and_render
 
-load_plugin('systems.plugins')
+from support import load_plugins
+
+load_plugins()
 
 def expand(rg):
   cluster = rg.add_resource(resource('PgCluster'))
@@ -95,5 +93,7 @@ def run_test():
   r.realize()
 
 if __name__ == '__main__':
+  # Set up a default handler that writes to stderr.
+  logging.basicConfig(level=logging.DEBUG)
   run_test()
 
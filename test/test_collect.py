@@ -0,0 +1,67 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.context import Realizer, ResourceGraph
+from systems.dsl import resource, transition
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def package(name):
+  return resource('AptitudePackage', name=name)
+
+def packages(part):
+  return sorted(res.id_attrs['name'] for res in part)
+
+def cmdlines(plan):
+  return [t.instr_attrs['cmdline'][4:] for t in plan]
+
+
+class AntichainPartitionTest(unittest.TestCase):
+  def setUp(self):
+    # pa and pb are independent, pc comes after pa,
+    # pd after a command.
+    rg = self.rg = ResourceGraph()
+    self.pa = rg.add_resource(package('pa'))
+    self.pb = rg.add_resource(package('pb'))
+    self.pc = rg.add_resource(package('pc'), depends=[self.pa])
+    t = rg.add_transition(transition('Command', cmdline=['/bin/true']))
+    self.pd = rg.add_resource(package('pd'), depends=[t])
+    self.nodes = [self.pa, self.pb, self.pc, self.pd]
+
+  def test_calls(self):
+    parts = self.rg.antichain_partition(self.nodes)
+    self.assertEqual(map(packages, parts), [['pa', 'pb', 'pd'], ['pc']])
+
+  def test_critical_path(self):
+    parts = self.rg.antichain_partition(self.nodes, 'critical_path')
+    self.assertEqual(map(packages, parts), [['pa', 'pb'], ['pc', 'pd']])
+
+  def test_subset(self):
+    parts = self.rg.antichain_partition([self.pc, self.pb])
+    self.assertEqual(map(packages, parts), [['pb', 'pc']])
+
+  def test_objective(self):
+    self.assertRaises(ValueError,
+        self.rg.antichain_partition, self.nodes, 'fastest')
+
+
+class CollectTest(unittest.TestCase):
+  def test_collected(self):
+    def expand(rg):
+      pa = rg.add_resource(package('pa'))
+      rg.add_resource(package('pb'))
+      rg.add_resource(package('pc'), depends=[pa])
+    plan = Realizer(FunExpandable(expand)).plan
+    self.assertEqual(cmdlines(plan), [['pa+', 'pb+'], ['pc+']])
+    self.assertEqual(list(plan.depends[plan.transitions[1]]),
+        [plan.transitions[0]])
+
+
+if __name__ == '__main__':
+  unittest.main()
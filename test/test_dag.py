@@ -0,0 +1,84 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.context import Realizer, ResourceGraph
+from systems.dsl import resource, transition
+from systems.typesystem import FunExpandable
+from systems.util.dag import DAG, NetworkxDAG
+
+from support import load_plugins
+
+load_plugins()
+
+try:
+  import networkx
+except ImportError:
+  networkx = None
+
+
+class DAGTest(unittest.TestCase):
+  dag_type = DAG
+
+  def test_edges(self):
+    dag = self.dag_type()
+    dag.add_edge('a', 'b')
+    dag.add_edge('a', 'c')
+    self.assertEqual(set(dag.successors_iter('a')), set(['b', 'c']))
+    self.assertEqual(list(dag.predecessors_iter('b')), ['a'])
+    dag.delete_edge('a', 'b')
+    self.assertFalse(dag.has_edge('a', 'b'))
+    self.assertTrue(dag.has_edge('a', 'c'))
+    self.assertFalse(dag.has_edge('a', 'x'))
+
+  def test_id_reuse(self):
+    dag = DAG()
+    dag.add_edge('a', 'b')
+    i = dag.node_id('b')
+    dag.delete_node('b')
+    self.assertFalse('b' in dag)
+    self.assertEqual(list(dag.successors_iter('a')), [])
+    self.assertEqual(dag.add_node('c'), i)
+    self.assertEqual(dag.node(i), 'c')
+    self.assertEqual(list(dag.predecessors_iter('c')), [])
+    self.assertEqual(len(dag), 2)
+
+
+if networkx is not None:
+  class NetworkxDAGTest(DAGTest):
+    dag_type = NetworkxDAG
+
+    def test_id_reuse(self):
+      # Nodes are their own ids.
+      dag = self.dag_type()
+      dag.add_edge('a', 'b')
+      self.assertEqual(dag.node_id('b'), 'b')
+      dag.delete_node('b')
+      self.assertRaises(KeyError, dag.node_id, 'b')
+
+
+class BackendTest(unittest.TestCase):
+  def plan(self, backend):
+    def expand(rg):
+      first = rg.add_transition(
+          transition('Command', cmdline=['/bin/echo', 'first']))
+      d = rg.add_resource(resource('Directory',
+          path='/nonexistent/backend', mode='0755'), depends=[first])
+      rg.add_resource(resource('PlainFile',
+          path='/nonexistent/backend/f'), depends=[d])
+      rg.add_resource(resource('AptitudePackage', name='pa'), depends=[d])
+      rg.add_resource(resource('AptitudePackage', name='pb'))
+    return [repr(t) for t in
+        Realizer(FunExpandable(expand), graph_backend=backend).plan]
+
+  if networkx is not None:
+    def test_same_plan(self):
+      self.assertEqual(self.plan('networkx'), self.plan('native'))
+
+  def test_unknown(self):
+    self.assertRaises(ValueError, ResourceGraph, 'pygraph')
+
+
+if __name__ == '__main__':
+  unittest.main()
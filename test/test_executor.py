@@ -0,0 +1,249 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource, transition
+from systems.journal import Journal
+from systems.executor import Executor, TransitionsFailed
+from systems.plugins.files.directory import Directory
+from systems.reactor import Reactor
+from systems.selector import parse_selectors
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class Failed(Exception):
+  pass
+
+
+def code(function, *args):
+  return transition('PythonCode', function=function, args=list(args))
+
+
+class Guard(object):
+  # A lock that knows which thread holds it.
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.holder = None
+    self.entered = 0
+
+  def __enter__(self):
+    self.lock.acquire()
+    self.holder = threading.currentThread()
+    self.entered += 1
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    self.holder = None
+    self.lock.release()
+
+  def is_held(self):
+    return self.holder is threading.currentThread()
+
+
+class ExecutorTest(unittest.TestCase):
+  def setUp(self):
+    self.ran = []
+    self.lock = threading.Lock()
+
+  def record(self, name):
+    def run():
+      with self.lock:
+        self.ran.append(name)
+    return code(run)
+
+  def chain(self, names):
+    ts = [self.record(name) for name in names]
+    return ts, dict((t, ts[i - 1:i]) for (i, t) in enumerate(ts))
+
+  def test_order(self):
+    for jobs in (1, 4):
+      self.ran = []
+      ts, depends = self.chain('abcdef')
+      done = []
+      Executor(jobs, on_done=done.append).run(ts, depends)
+      self.assertEqual(self.ran, list('abcdef'))
+      self.assertEqual(done, ts)
+
+  def test_parallel(self):
+    # Each waits for the other to start, which only works
+    # if they run at once.
+    events = [threading.Event(), threading.Event()]
+    def meet(i):
+      events[i].set()
+      if not events[1 - i].wait(10):
+        raise Failed(i)
+    ts = [code(meet, 0), code(meet, 1)]
+    Executor(2).run(ts, {})
+    self.assertTrue(ts[0].is_realized and ts[1].is_realized)
+
+  def test_failure(self):
+    def fail():
+      raise Failed()
+    for jobs in (1, 4):
+      self.ran = []
+      t0 = code(fail)
+      t1 = self.record('after')
+      self.assertRaises(Failed, Executor(jobs).run, [t0, t1], {t1: [t0]})
+      self.assertEqual(self.ran, [])
+      self.assertFalse(t1.is_realized)
+
+  def test_guard(self):
+    # Guarded transitions are realized holding their lock,
+    # commands too with the events engine.
+    guard = Guard()
+    held = []
+    def run():
+      held.append(guard.is_held())
+    for make in (Executor, Reactor):
+      for jobs in (1, 4):
+        del held[:]
+        guarded = [code(run), transition('Command', cmdline=['/bin/true'])]
+        ts = guarded + [code(run)]
+        make(jobs, guard=dict((t, guard) for t in guarded).get).run(ts, {})
+        self.assertEqual(sorted(held), [False, True])
+        self.assertEqual(guard.entered, 2)
+        guard.entered = 0
+
+  def test_keep_going(self):
+    # What doesn't come after a failure is realized; failures
+    # and what was skipped are reported in order.
+    def fail():
+      raise Failed()
+    for (make, jobs) in ((Executor, 1), (Executor, 4), (Reactor, 4)):
+      self.ran = []
+      f0 = code(fail)
+      after0 = self.record('after0')
+      after1 = self.record('after1')
+      f1 = code(fail)
+      other = self.record('other')
+      ts = [f0, after0, after1, f1, other]
+      depends = {after0: [f0], after1: [after0], }
+      try:
+        make(jobs, keep_going=True).run(ts, depends)
+      except TransitionsFailed, e:
+        self.assertEqual([t for (t, exc_info) in e.failures], [f0, f1])
+        self.assertTrue(e.failures[0][1][0] is Failed)
+        self.assertEqual(e.skipped, [after0, after1])
+      else:
+        self.fail('Expected TransitionsFailed')
+      self.assertEqual(self.ran, ['other'])
+
+  def test_realizer_keep_going(self):
+    def fail():
+      raise Failed()
+    def expand(rg):
+      failed = rg.add_transition(code(fail))
+      rg.add_transition(self.record('after'), depends=[failed])
+      rg.add_transition(self.record('other'))
+    r = Realizer(FunExpandable(expand))
+    self.assertRaises(TransitionsFailed, r.realize, 2, keep_going=True)
+    self.assertEqual(self.ran, ['other'])
+
+  def test_jobs(self):
+    self.assertRaises(ValueError, Executor, 0)
+
+  def test_realizer(self):
+    def expand(rg):
+      previous = []
+      for name in 'abcd':
+        previous = [rg.add_transition(self.record(name), depends=previous)]
+        rg.add_transition(self.record(name.upper()))
+    Realizer(FunExpandable(expand)).realize(jobs=4)
+    lower = [name for name in self.ran if name.islower()]
+    self.assertEqual(lower, list('abcd'))
+    self.assertEqual(sorted(self.ran), sorted('abcdABCD'))
+
+
+class PipelineTest(unittest.TestCase):
+  def setUp(self):
+    self.ran = []
+    self.expand_into = Directory.__dict__['expand_into']
+
+  def tearDown(self):
+    Directory.expand_into = self.expand_into
+
+  def record(self, name):
+    def run():
+      self.ran.append(name)
+    return code(run)
+
+  def test_submit(self):
+    # Batches may depend on what was submitted before,
+    # running or done.
+    executor = Executor(2)
+    executor.start()
+    try:
+      a = self.record('a')
+      executor.submit([a], {})
+      executor.wait()
+      b = self.record('b')
+      c = self.record('c')
+      executor.submit([b], {b: [a]})
+      executor.submit([c], {c: [a, b]})
+      executor.wait()
+    finally:
+      executor.stop()
+    self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+  def test_submit_failed(self):
+    def fail():
+      raise Failed()
+    executor = Executor(2)
+    executor.start()
+    try:
+      executor.submit([code(fail)], {})
+      self.assertRaises(Failed, executor.wait)
+      self.assertTrue(executor.failed)
+    finally:
+      executor.stop()
+
+  def test_pipelined(self):
+    # A transition settled at the top runs while the directory
+    # is expanded, which waits for it.
+    started = threading.Event()
+    def expand_into(res, rg):
+      if not started.wait(10):
+        raise Failed()
+      self.ran.append('expanded')
+      self.expand_into(res, rg)
+    Directory.expand_into = expand_into
+    def early():
+      started.set()
+      self.ran.append('early')
+    directory = tempfile.mkdtemp()
+    def expand(rg):
+      rg.add_transition(code(early))
+      d = rg.add_resource(resource('Directory',
+          path=os.path.join(directory, 'd'), mode='0755'))
+      rg.add_transition(self.record('late'), depends=[d])
+    try:
+      count = Realizer(FunExpandable(expand)).realize(2, pipelined=True)
+      self.assertTrue(os.path.isdir(os.path.join(directory, 'd')))
+    finally:
+      shutil.rmtree(directory)
+    self.assertEqual(count, 3)
+    self.assertEqual(self.ran, ['early', 'expanded', 'late'])
+
+  def test_not_pipelined(self):
+    journal = Journal('/nonexistent/journal')
+    for kargs in ({'journal': journal},
+        {'select': parse_selectors(['Directory'])}):
+      r = Realizer(FunExpandable(lambda rg: None), **kargs)
+      self.assertRaises(ValueError, r.realize, pipelined=True)
+    r = Realizer(FunExpandable(lambda rg: None))
+    self.assertRaises(ValueError, r.realize, engine='events', pipelined=True)
+
+
+if __name__ == '__main__':
+  unittest.main()
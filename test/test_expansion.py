@@ -0,0 +1,79 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import random
+import threading
+import time
+import unittest
+
+from systems.context import Realizer, _Turns
+from systems.dsl import resource
+from systems.plugins.files.directory import Directory
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class TurnsTest(unittest.TestCase):
+  def test_order(self):
+    turns = _Turns()
+    order = []
+    def take(turn):
+      turns.wait(turn)
+      order.append(turn)
+      turns.finish(turn)
+    threads = [threading.Thread(target=take, args=(turn, ))
+        for turn in xrange(10)]
+    # Started last to first, they still go first to last.
+    for thread in reversed(threads):
+      thread.start()
+      time.sleep(.001)
+    for thread in threads:
+      thread.join(10)
+    self.assertEqual(order, range(10))
+
+  def test_finished_early(self):
+    # Turns finished ahead are skipped when the current one finishes.
+    turns = _Turns()
+    turns.finish(1)
+    turns.finish(2)
+    turns.finish(0)
+    turns.wait(3)
+
+
+class ConcurrentExpansionTest(unittest.TestCase):
+  def setUp(self):
+    # Directories expand slowly, at random, and add a package
+    # to the top, so that threads finish in any order.
+    self.expand_into = Directory.__dict__['expand_into']
+    rand = random.Random(0)
+    def expand_into(res, rg):
+      time.sleep(rand.random() * .005)
+      name = 'p%d' % (int(res.id_attrs['path'][len('/nonexistent/d'):]) % 3)
+      rg.add_to_top(resource('AptitudePackage', name=name))
+      time.sleep(rand.random() * .005)
+      self.expand_into(res, rg)
+    Directory.expand_into = expand_into
+
+  def tearDown(self):
+    Directory.expand_into = self.expand_into
+
+  def plan(self, jobs):
+    def expand(rg):
+      for i in xrange(30):
+        rg.add_resource(resource('Directory',
+            path='/nonexistent/d%d' % i, mode='0755'))
+    return [repr(t) for t in
+        Realizer(FunExpandable(expand), expand_jobs=jobs).plan]
+
+  def test_same_plan(self):
+    plan = self.plan(1)
+    self.assertEqual(len(plan), 31)
+    for i in xrange(3):
+      self.assertEqual(self.plan(8), plan)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource, transition
+from systems.expansionmemo import ExpansionMemo, memo_key
+from systems.plugins.apache2.a2site import A2Site
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def expand(rg):
+  for name in ('a', 'b'):
+    rg.add_resource(resource('A2Site', name=name, contents='x'))
+
+
+class ExpansionMemoTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'memo')
+    self.expand_into = A2Site.__dict__['expand_into']
+
+  def tearDown(self):
+    A2Site.expand_into = self.expand_into
+    shutil.rmtree(self.directory)
+
+  def plan(self, memo):
+    return [repr(t) for t in
+        Realizer(FunExpandable(expand), expansion_memo=memo).plan]
+
+  def test_replay(self):
+    # Saved once frozen, the expansions replay as they ran.
+    memo = ExpansionMemo(self.path)
+    plan = self.plan(memo)
+    self.assertEqual((memo.hits, memo.misses), (0, 2))
+    self.assertTrue(os.path.exists(self.path))
+    memo = ExpansionMemo(self.path)
+    self.assertEqual(self.plan(memo), plan)
+    self.assertEqual((memo.hits, memo.misses), (2, 0))
+    self.assertEqual(self.plan(None), plan)
+
+  def test_in_memory(self):
+    memo = ExpansionMemo()
+    plan = self.plan(memo)
+    self.assertEqual(self.plan(memo), plan)
+    self.assertEqual((memo.hits, memo.misses), (2, 2))
+    self.assertFalse(os.path.exists(self.path))
+
+  def test_unpicklable(self):
+    # Expansions whose calls can't be pickled run every time.
+    def expand_into(res, rg):
+      rg.add_transition(transition('PythonCode', function=lambda: None))
+    A2Site.expand_into = expand_into
+    memo = ExpansionMemo(self.path)
+    self.plan(memo)
+    self.plan(memo)
+    self.assertEqual((memo.hits, memo.misses), (0, 4))
+
+  def test_key(self):
+    a = resource('A2Site', name='a', contents='x')
+    self.assertEqual(memo_key(a),
+        memo_key(resource('A2Site', name='a', contents='x')))
+    self.assertNotEqual(memo_key(a),
+        memo_key(resource('A2Site', name='a', contents='y')))
+    self.assertNotEqual(memo_key(a),
+        memo_key(resource('A2Site', name='b', contents='x')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+from xml.dom import minidom
+
+import systems
+from systems.context import DESC_LIMIT, Realizer, describe
+from systems.dsl import resource, transition
+from systems.graphexport import write_graph
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def add_files(rg):
+  d = rg.add_resource(resource('Directory',
+      path='/nonexistent/export', mode='0755'))
+  f = rg.add_resource(resource('PlainFile',
+      path='/nonexistent/export/f'), depends=[d])
+  rg.add_transition(transition('Command',
+      cmdline=['/bin/echo', '<&>', '"q"']), depends=[f])
+
+
+class ExportTest(unittest.TestCase):
+  def setUp(self):
+    self.realizer = Realizer(FunExpandable(add_files))
+
+  def test_dot(self):
+    f = StringIO()
+    self.realizer.plan.export(f, 'dot')
+    text = f.getvalue()
+    self.assertTrue(text.startswith('digraph systems {\n'))
+    self.assertTrue(text.endswith('}\n'))
+    self.assertEqual(text.count(' -> '),
+        len(list(self.realizer.plan.iter_edges())))
+    # Quotes in labels are escaped.
+    self.assertTrue(r'\"q\"' in text)
+
+  def test_graphml(self):
+    f = StringIO()
+    self.realizer.export(f, 'graphml', transitions_only=True)
+    doc = minidom.parseString(f.getvalue())
+    nodes = doc.getElementsByTagName('node')
+    self.assertEqual(len(nodes), len(self.realizer.plan))
+    ids = set(node.getAttribute('id') for node in nodes)
+    for edge in doc.getElementsByTagName('edge'):
+      self.assertTrue(edge.getAttribute('source') in ids)
+      self.assertTrue(edge.getAttribute('target') in ids)
+    labels = [node.firstChild.firstChild.data for node in nodes]
+    self.assertTrue([label for label in labels if '<&>' in label])
+
+  def test_by_type(self):
+    f = StringIO()
+    self.realizer.plan.export(f, 'dot', by_type=True)
+    text = f.getvalue()
+    self.assertTrue('"Directory"' in text)
+    self.assertTrue('"PlainFile"' in text)
+
+  def test_unknown(self):
+    self.assertRaises(ValueError, self.realizer.plan.export, StringIO(), 'svg')
+
+  def test_within(self):
+    f = StringIO()
+    r = self.realizer
+    r.export(f, 'dot',
+        within=[resource('PlainFile', path='/nonexistent/export/f')])
+    text = f.getvalue()
+    self.assertTrue('/nonexistent/export/f' in text)
+    self.assertFalse("path='/nonexistent/export'," in text)
+    self.assertFalse('/bin/echo' in text)
+
+
+class Text(object):
+  def __init__(self, text):
+    self.text = text
+
+  def __str__(self):
+    return self.text.encode('utf-8')
+
+
+class LabelTest(unittest.TestCase):
+  def test_truncate(self):
+    # Truncated by character, not by byte.
+    label = describe(Text(u'\xe9' * (DESC_LIMIT + 1)))
+    self.assertEqual(label.decode('utf-8'), u'\xe9' * DESC_LIMIT)
+    self.assertEqual(describe(Text(u'short')), 'short')
+
+  def test_graphml(self):
+    f = StringIO()
+    label = describe(Text(u'\u2192' * DESC_LIMIT * 2))
+    write_graph(f, [(0, label)], [], 'graphml')
+    doc = minidom.parseString(f.getvalue())
+    data = doc.getElementsByTagName('data')[0].firstChild.data
+    self.assertEqual(data, u'\u2192' * DESC_LIMIT)
+
+
+MANIFEST = """
+from systems.dsl import resource, transition
+
+def expand(rg):
+  d = rg.add_resource(resource('Directory',
+      path='/nonexistent/export', mode='0755'))
+  f = rg.add_resource(resource('PlainFile',
+      path='/nonexistent/export/f'), depends=[d])
+"""
+
+
+class CliTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.manifest = os.path.join(self.directory, 'manifest.py')
+    self.export = os.path.join(self.directory, 'export.dot')
+    f = open(self.manifest, 'w')
+    f.write(MANIFEST)
+    f.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_cli(self, *args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(systems.__file__))
+    proc = subprocess.Popen([sys.executable, '-m', 'systems.cli', '-n',
+      '--export', self.export] + list(args) + [self.manifest],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    proc.communicate()
+    return proc.returncode
+
+  def exported(self):
+    f = open(self.export)
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def test_plan(self):
+    self.assertEqual(self.run_cli(), 0)
+    self.assertFalse('resource(' in self.exported())
+
+  def test_graph(self):
+    self.assertEqual(self.run_cli('--export-graph'), 0)
+    self.assertTrue('resource(' in self.exported())
+
+  def test_within(self):
+    self.assertEqual(self.run_cli('--export-within', 'PlainFile'), 0)
+    text = self.exported()
+    self.assertTrue('/nonexistent/export/f' in text)
+    self.assertFalse("path='/nonexistent/export'," in text)
+
+  def test_plan_cache(self):
+    self.assertEqual(self.run_cli('--export-transitions-only',
+      '--plan-cache', self.directory), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
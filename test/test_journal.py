@@ -0,0 +1,126 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from systems.dsl import transition
+from systems.journal import Journal, JournalMismatch
+from systems.plan import Plan
+
+from support import load_plugins
+
+load_plugins()
+
+
+def make_plan(words):
+  ts = [transition('Command', cmdline=['/bin/echo', word], redir_stdout=True)
+      for word in words]
+  return Plan(ts, dict((t, ts[i - 1:i]) for (i, t) in enumerate(ts)))
+
+def realize(journal, plan, count):
+  for t in plan.transitions[:count]:
+    if not t.is_realized:
+      t.realize()
+      journal.record(t)
+
+
+class JournalTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_resume(self):
+    journal = Journal(self.path)
+    plan = make_plan('abc')
+    journal.start(plan)
+    realize(journal, plan, 2)
+    journal.close()
+
+    plan = make_plan('abc')
+    journal = Journal(self.path)
+    self.assertEqual(journal.resume(plan), 2)
+    self.assertEqual([t.is_realized for t in plan], [True, True, False])
+    self.assertEqual(plan.transitions[1].results_attrs['stdout'], 'b\n')
+    # Journaling goes on after the recorded transitions.
+    realize(journal, plan, 3)
+    journal.close()
+    self.assertEqual(Journal(self.path).resume(make_plan('abc')), 3)
+
+  def test_mismatch(self):
+    journal = Journal(self.path)
+    plan = make_plan('abc')
+    journal.start(plan)
+    realize(journal, plan, 1)
+    journal.close()
+    self.assertRaises(JournalMismatch,
+        Journal(self.path).resume, make_plan('abd'))
+
+  def test_no_journal(self):
+    path = os.path.join(self.directory, 'sub', 'journal')
+    journal = Journal(path)
+    self.assertEqual(journal.resume(make_plan('ab')), 0)
+    journal.close()
+    self.assertEqual(Journal(path).resume(make_plan('ab')), 0)
+
+  def test_append(self):
+    # Later realizations of a run append; resuming follows the last.
+    journal = Journal(self.path)
+    plan = make_plan('ab')
+    journal.start(plan)
+    realize(journal, plan, 2)
+    plan = make_plan('cd')
+    journal.start(plan)
+    realize(journal, plan, 1)
+    journal.close()
+    self.assertRaises(JournalMismatch,
+        Journal(self.path).resume, make_plan('ab'))
+    self.assertEqual(Journal(self.path).resume(make_plan('cd')), 1)
+    # A new run starts over.
+    journal = Journal(self.path)
+    journal.start(make_plan('ef'))
+    journal.close()
+    self.assertEqual(Journal(self.path).resume(make_plan('ef')), 0)
+
+  def test_append_same(self):
+    # Resuming only skips what the last section recorded,
+    # even for transitions an earlier one recorded too.
+    journal = Journal(self.path)
+    plan = make_plan('abc')
+    journal.start(plan)
+    realize(journal, plan, 3)
+    plan = make_plan('abc')
+    journal.start(plan)
+    realize(journal, plan, 1)
+    journal.close()
+    plan = make_plan('abc')
+    self.assertEqual(Journal(self.path).resume(plan), 1)
+    self.assertEqual([t.is_realized for t in plan], [True, False, False])
+
+  def test_partial_record(self):
+    journal = Journal(self.path)
+    plan = make_plan('abc')
+    journal.start(plan)
+    realize(journal, plan, 2)
+    journal.close()
+    size = os.path.getsize(self.path)
+    f = open(self.path, 'r+b')
+    f.truncate(size - 5)
+    f.close()
+    self.assertEqual(Journal(self.path).resume(make_plan('abc')), 1)
+
+  def test_for_shard(self):
+    journal = Journal(self.path).for_shard('1')
+    journal.start(make_plan('a'))
+    journal.close()
+    self.assertTrue(os.path.exists(self.path + '.1'))
+    self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource, transition
+from systems.plandiff import PlanDiff
+from systems.plugins.files.directory import Directory
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def directory(name):
+  return resource('Directory', path='/nonexistent/' + name, mode='0755')
+
+def echo(word):
+  return transition('Command', cmdline=['/bin/echo', word])
+
+def expand_base(rg):
+  d = rg.add_resource(directory('base'))
+  rg.add_transition(echo('base'), depends=[d])
+
+def layer(host):
+  def expand(rg):
+    first = rg.add_transition(echo(host))
+    rg.add_resource(directory(host), depends=[first])
+  return expand
+
+def whole(host):
+  def expand(rg):
+    expand_base(rg)
+    layer(host)(rg)
+  return expand
+
+
+class LayersTest(unittest.TestCase):
+  def setUp(self):
+    self.expand_into = Directory.__dict__['expand_into']
+    self.expanded = []
+    def expand_into(res, rg):
+      self.expanded.append(res.id_attrs['path'])
+      self.expand_into(res, rg)
+    Directory.expand_into = expand_into
+
+  def tearDown(self):
+    Directory.expand_into = self.expand_into
+
+  def test_layers(self):
+    # Each layer is planned as if it had been part of the manifest,
+    # without expanding the base again.
+    r = Realizer(FunExpandable(expand_base))
+    base = r.plan
+    for host in ('h1', 'h2'):
+      self.expanded = []
+      r.push_layer(FunExpandable(layer(host)))
+      layered = r.plan
+      self.assertEqual(self.expanded, ['/nonexistent/' + host])
+      self.assertFalse(PlanDiff(layered,
+        Realizer(FunExpandable(whole(host))).plan))
+      r.pop_layer()
+      self.assertTrue(r.plan is base)
+
+  def test_packages(self):
+    # Packages of the layer are installed by a call of their own.
+    def expand(rg):
+      rg.add_resource(resource('AptitudePackage', name='pa'))
+    r = Realizer(FunExpandable(expand))
+    r.plan
+    r.push_layer(FunExpandable(lambda rg: rg.add_resource(
+      resource('AptitudePackage', name='pb'))))
+    self.assertEqual([t.instr_attrs['cmdline'][4:] for t in r.plan],
+        [['pa+'], ['pb+']])
+
+  def test_errors(self):
+    r = Realizer(FunExpandable(expand_base))
+    self.assertRaises(RuntimeError, r.pop_layer)
+    r.push_layer(FunExpandable(layer('h1')))
+    self.assertRaises(RuntimeError,
+        r.push_layer, FunExpandable(layer('h2')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,199 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from systems.context import Realizer, owner_name
+from systems.dsl import resource, transition
+from systems.locks import HostLock, LockManager
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+# Exits 0 if the slot could be locked at once, 1 otherwise.
+TRY_LOCK = '''
+import fcntl, sys
+f = open(sys.argv[1], 'a+')
+mode = {'ex': fcntl.LOCK_EX, 'sh': fcntl.LOCK_SH}[sys.argv[3]]
+try:
+  fcntl.lockf(f.fileno(), mode | fcntl.LOCK_NB, 1, int(sys.argv[2]))
+except IOError:
+  sys.exit(1)
+'''
+
+# Exits 0 if the file could be locked at once, 1 otherwise.
+TRY_FLOCK = '''
+import fcntl, sys
+f = open(sys.argv[1], 'a')
+try:
+  fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+except IOError:
+  sys.exit(1)
+'''
+
+
+class LockManagerTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.locks = LockManager(os.path.join(self.directory, 'locks'), 8)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def can_lock(self, name, mode, locks=None):
+    locks = locks or self.locks
+    return subprocess.call([sys.executable, '-c', TRY_LOCK,
+      locks.path, str(locks.slot(name)), mode]) == 0
+
+  def test_slots(self):
+    names = ['res%d' % i for i in xrange(100)]
+    slots = set(self.locks.slot(name) for name in names)
+    self.assertTrue(slots <= set(range(8)))
+    self.assertEqual(self.locks.slot('res0'),
+        LockManager(self.directory, 8).slot('res0'))
+    with self.locks.acquire(names) as held:
+      self.assertEqual(len(held), len(slots))
+    self.assertEqual(len(held), 0)
+    # One file, whatever the slots.
+    self.assertEqual(os.listdir(os.path.join(self.directory, 'locks')),
+        ['slots.lock'])
+
+  def test_default_slots(self):
+    # Few enough names to share a slot by chance.
+    locks = LockManager(self.directory)
+    names = ['res%d' % i for i in xrange(1000)]
+    self.assertEqual(len(set(locks.slot(name) for name in names)), 1000)
+    with locks.acquire(names[:500], names[500:]):
+      self.assertFalse(self.can_lock('res0', 'sh', locks))
+      self.assertTrue(self.can_lock('res500', 'sh', locks))
+      self.assertTrue(self.can_lock('other', 'ex', locks))
+
+  def test_exclusive(self):
+    with self.locks.acquire(['a']):
+      self.assertFalse(self.can_lock('a', 'sh'))
+      self.assertFalse(self.can_lock('a', 'ex'))
+    self.assertTrue(self.can_lock('a', 'ex'))
+
+  def test_shared(self):
+    with self.locks.acquire([], ['a']):
+      self.assertTrue(self.can_lock('a', 'sh'))
+      self.assertFalse(self.can_lock('a', 'ex'))
+
+  def test_exclusive_wins(self):
+    # A slot locked both ways is locked once, exclusively.
+    with self.locks.acquire(['a'], ['a']) as held:
+      self.assertEqual(len(held), 1)
+      self.assertFalse(self.can_lock('a', 'sh'))
+
+  def test_same_process(self):
+    # Runs of a process take turns.
+    order = []
+    def run():
+      with self.locks.acquire(['b']):
+        order.append('second')
+    with self.locks.acquire(['a']):
+      thread = threading.Thread(target=run)
+      thread.start()
+      thread.join(.1)
+      order.append('first')
+    thread.join(10)
+    self.assertEqual(order, ['first', 'second'])
+
+  def test_slots_count(self):
+    self.assertRaises(ValueError, LockManager, self.directory, 0)
+    self.assertRaises(ValueError, LockManager, self.directory, 2 ** 32)
+
+
+class HostLockTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'host.lock')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def can_lock(self):
+    return subprocess.call([sys.executable, '-c', TRY_FLOCK, self.path]) == 0
+
+  def test_lock(self):
+    lock = HostLock(self.path)
+    with lock:
+      self.assertFalse(self.can_lock())
+    self.assertTrue(self.can_lock())
+
+  def test_threads(self):
+    # Threads of a process exclude each other too.
+    lock = HostLock(self.path)
+    order = []
+    def run():
+      with lock:
+        order.append('second')
+    with lock:
+      thread = threading.Thread(target=run)
+      thread.start()
+      thread.join(.1)
+      order.append('first')
+    thread.join(10)
+    self.assertEqual(order, ['first', 'second'])
+
+
+class RealizerLocksTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.locks = LockManager(os.path.join(self.directory, 'locks'))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def can_lock(self, res, mode):
+    return subprocess.call([sys.executable, '-c', TRY_LOCK, self.locks.path,
+      str(self.locks.slot(owner_name(res))), mode]) == 0
+
+  def test_closure(self):
+    # Only what the transitions to realize come after is locked shared;
+    # top transitions aren't locked.
+    a = resource('Directory', path=os.path.join(self.directory, 'a'),
+        mode='0755')
+    b = resource('Directory', path=os.path.join(self.directory, 'b'),
+        mode='0755')
+    seen = []
+    def check():
+      seen.append((self.can_lock(a, 'sh'), self.can_lock(a, 'ex'),
+        self.can_lock(b, 'ex')))
+    def expand(rg):
+      ra = rg.add_resource(a)
+      rg.add_resource(b)
+      rg.add_transition(transition('PythonCode', function=check),
+          depends=[ra])
+    r = Realizer(FunExpandable(expand), lock_manager=self.locks)
+    for t in r.plan:
+      if t.instr_attrs['function'] != check:
+        t.realize()
+    self.assertEqual(r.realize(), 1)
+    self.assertEqual(seen, [(True, False, True)])
+
+  def test_owned(self):
+    a = resource('Directory', path=os.path.join(self.directory, 'a'),
+        mode='0755')
+    seen = []
+    def check():
+      seen.append(self.can_lock(a, 'sh'))
+    def expand(rg):
+      ra = rg.add_resource(a)
+      rg.add_transition(transition('PythonCode', function=check),
+          depends=[ra])
+    Realizer(FunExpandable(expand), lock_manager=self.locks).realize()
+    self.assertEqual(seen, [False])
+
+
+if __name__ == '__main__':
+  unittest.main()
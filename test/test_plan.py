@@ -0,0 +1,89 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import transition
+from systems.plan import Plan, reduce_depends
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def echo(word):
+  return transition('Command', cmdline=['/bin/echo', word])
+
+def chain(words):
+  # Transitions each depending on all those before.
+  ts = [echo(word) for word in words]
+  depends = dict((t, ts[:i]) for (i, t) in enumerate(ts))
+  return ts, depends
+
+
+class ReduceDependsTest(unittest.TestCase):
+  def test_reduce(self):
+    order = 'abcd'
+    depends = {'a': (), 'b': ('a', ), 'c': ('b', ), 'd': ()}
+    self.assertEqual(reduce_depends('abcd', order.index, depends.get),
+        ['c', 'd'])
+    self.assertEqual(reduce_depends('ab', order.index, depends.get), ['b'])
+    self.assertEqual(reduce_depends('aa', order.index, depends.get), ['a'])
+    self.assertEqual(reduce_depends('', order.index, depends.get), [])
+
+
+class PlanTest(unittest.TestCase):
+  def test_reduced(self):
+    ts, depends = chain('abc')
+    plan = Plan(ts, depends)
+    self.assertEqual(list(plan), ts)
+    self.assertEqual(plan.depends[ts[2]], (ts[1], ))
+    self.assertEqual(list(plan.iter_edges()),
+        [(ts[0], ts[1]), (ts[1], ts[2])])
+
+  def test_extend(self):
+    ts, depends = chain('abcde')
+    plan = Plan(ts, depends)
+    base = Plan(ts[:3], depends)
+    extended = base.extend(ts[3:], depends, {ts[4]: 'owner'})
+    self.assertEqual(extended.transitions, plan.transitions)
+    self.assertEqual(extended.depends, plan.depends)
+    self.assertEqual(extended.owners, {ts[4]: 'owner'})
+    # The plan extended is unchanged.
+    self.assertEqual(len(base), 3)
+    self.assertFalse(ts[3] in base.depends)
+
+  def test_restricted(self):
+    ts, depends = chain('abcd')
+    plan = Plan(ts, depends)
+    restricted = plan.restricted(set(ts[:2]))
+    self.assertEqual(restricted.transitions, ts[:2])
+    self.assertEqual(restricted.depends,
+        {ts[0]: (), ts[1]: (ts[0], )})
+
+  def test_stable_ids(self):
+    ts, depends = chain(['a', 'b', 'a'])
+    ids = Plan(ts, depends).stable_ids()
+    self.assertEqual(len(set(ids.itervalues())), 3)
+    ts2, depends2 = chain(['a', 'b', 'a'])
+    ids2 = Plan(ts2, depends2).stable_ids()
+    self.assertEqual([ids[t] for t in ts], [ids2[t] for t in ts2])
+
+
+class CompactTest(unittest.TestCase):
+  def test_compact(self):
+    # Dependencies implied by others are dropped from the plan.
+    def expand(rg):
+      a = rg.add_transition(echo('a'))
+      b = rg.add_transition(echo('b'), depends=[a])
+      rg.add_transition(echo('c'), depends=[a, b])
+    plan = Realizer(FunExpandable(expand)).plan
+    a, b, c = plan.transitions
+    self.assertEqual(list(plan.depends[b]), [a])
+    self.assertEqual(list(plan.depends[c]), [b])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,184 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import systems
+from systems.cli import manifest_key
+from systems.context import Realizer
+from systems.dsl import resource, transition
+from systems.plancache import PlanCache, load_plan
+from systems.plandiff import PlanDiff
+from systems.probes import StateReads
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class PlanCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = PlanCache(os.path.join(self.directory, 'cache'))
+    self.path = os.path.join(self.directory, 'f')
+    self.expanded = 0
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def expand(self, rg):
+    # What is planned depends on what the file holds.
+    self.expanded += 1
+    f = rg.add_resource(resource('PlainFile', path=self.path, contents='x'))
+    contents = f.read_attrs()['contents']
+    rg.add_transition(transition('Command',
+        cmdline=['/bin/echo', contents]), depends=[f])
+
+  def plan(self):
+    return Realizer(FunExpandable(self.expand),
+        plan_cache=self.cache, manifest_key='manifest').plan
+
+  def write(self, contents):
+    f = open(self.path, 'w')
+    f.write(contents)
+    f.close()
+
+  def test_hit(self):
+    self.write('a')
+    plan = self.plan()
+    self.assertEqual(self.expanded, 1)
+    cached = self.plan()
+    self.assertEqual(self.expanded, 1)
+    self.assertFalse(PlanDiff(plan, cached))
+    self.assertEqual([repr(t) for t in plan], [repr(t) for t in cached])
+
+  def test_stale(self):
+    self.write('a')
+    self.plan()
+    self.write('b')
+    plan = self.plan()
+    self.assertEqual(self.expanded, 2)
+    self.assertEqual(plan.transitions[-1].instr_attrs['cmdline'],
+        ['/bin/echo', 'b'])
+    # Stored again, for the new state.
+    self.plan()
+    self.assertEqual(self.expanded, 2)
+
+  def test_store_load(self):
+    self.write('a')
+    plan = self.plan()
+    key = self.cache.key('other')
+    self.assertEqual(self.cache.load(key), None)
+    self.assertTrue(self.cache.store(key, plan))
+    self.assertFalse(PlanDiff(plan, self.cache.load(key)))
+    self.assertFalse(PlanDiff(plan, load_plan(self.cache.path(key))))
+
+  def test_unusable(self):
+    self.write('a')
+    key = self.cache.key('manifest')
+    self.plan()
+    f = open(self.cache.path(key), 'r+b')
+    f.truncate(os.path.getsize(self.cache.path(key)) // 2)
+    f.close()
+    self.assertEqual(self.cache.load(key), None)
+    self.plan()
+    self.assertEqual(self.expanded, 2)
+
+  def test_unpicklable(self):
+    self.write('a')
+    plan = self.plan()
+    t = transition('PythonCode', function=lambda: None)
+    plan = plan.extend([t], {})
+    self.assertFalse(self.cache.store(self.cache.key('lambda'), plan))
+
+  def test_key(self):
+    self.assertEqual(self.cache.key('a'), self.cache.key('a'))
+    self.assertNotEqual(self.cache.key('a'), self.cache.key('b'))
+
+
+MANIFEST = """
+from systems.dsl import transition
+
+def expand(rg):
+  rg.add_transition(transition('Command', cmdline=['/bin/echo', %r]))
+"""
+
+
+class CliTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = os.path.join(self.directory, 'cache')
+    self.manifest = os.path.join(self.directory, 'manifest.py')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, word):
+    f = open(self.manifest, 'w')
+    f.write(MANIFEST % word)
+    f.close()
+
+  def dry_run(self):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(systems.__file__))
+    proc = subprocess.Popen([sys.executable, '-m', 'systems.cli', '-n',
+      '--plan-cache', self.cache, self.manifest],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    self.assertEqual(proc.returncode, 0, err)
+    return sorted(os.listdir(self.cache))
+
+  def test_manifest_key(self):
+    self.write('a')
+    key = manifest_key(self.manifest)
+    self.assertEqual(manifest_key(self.manifest), key)
+    self.write('b')
+    self.assertNotEqual(manifest_key(self.manifest), key)
+
+  def test_cached(self):
+    # A plan per manifest contents.
+    self.write('a')
+    entries = self.dry_run()
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(self.dry_run(), entries)
+    self.write('b')
+    self.assertEqual(len(self.dry_run()), 2)
+
+
+class StateReadsTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'f')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_changed(self):
+    res = resource('PlainFile', path=self.path)
+    with StateReads() as reads:
+      self.assertFalse(res.read_attrs()['present'])
+    self.assertEqual(len(reads), 1)
+    self.assertEqual(reads.changed(), None)
+    open(self.path, 'w').close()
+    self.assertEqual(reads.changed(),
+        ('PlainFile', (('path', self.path), ), 'present'))
+
+  def test_not_recording(self):
+    reads = StateReads()
+    resource('PlainFile', path=self.path).read_attrs()['present']
+    self.assertEqual(len(reads), 0)
+
+  def test_nested(self):
+    with StateReads():
+      self.assertRaises(RuntimeError, StateReads().__enter__)
+
+
+if __name__ == '__main__':
+  unittest.main()
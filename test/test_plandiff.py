@@ -0,0 +1,65 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource, transition
+from systems.plandiff import PlanDiff
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def expand_in(path, words, contents='x'):
+  def expand(rg):
+    d = rg.add_resource(resource('Directory', path=path, mode='0755'))
+    f = rg.add_resource(resource('PlainFile',
+        path=path + '/f', contents=contents), depends=[d])
+    for word in words:
+      rg.add_transition(transition('Command', cmdline=['/bin/echo', word]),
+          depends=[f])
+  return FunExpandable(expand)
+
+
+class PlanDiffTest(unittest.TestCase):
+  def test_same(self):
+    plan0 = Realizer(expand_in('/nonexistent/plan', ['a', 'b'])).plan
+    plan1 = Realizer(expand_in('/nonexistent/plan', ['a', 'b'])).plan
+    diff = PlanDiff(plan0, plan1)
+    self.assertFalse(diff)
+    self.assertEqual(list(diff.iter_lines()), [])
+
+  def test_changes(self):
+    plan0 = Realizer(expand_in('/nonexistent/plan', ['a', 'b'])).plan
+    plan1 = Realizer(expand_in('/nonexistent/plan', ['a', 'c'])).plan
+    diff = PlanDiff(plan0, plan1)
+    self.assertTrue(diff)
+    # Top transitions aren't paired unless they are the same.
+    self.assertEqual([t.instr_attrs['cmdline'] for t in diff.removed],
+        [['/bin/echo', 'b']])
+    self.assertEqual([t.instr_attrs['cmdline'] for t in diff.added],
+        [['/bin/echo', 'c']])
+    self.assertEqual(diff.changed, [])
+    self.assertEqual(len(diff.removed_edges), 1)
+    self.assertEqual(len(diff.added_edges), 1)
+    self.assertEqual(len(list(diff.iter_lines())), 4)
+
+  def test_changed(self):
+    plan0 = Realizer(expand_in('/nonexistent/plan', [], 'x')).plan
+    plan1 = Realizer(expand_in('/nonexistent/plan', [], 'y')).plan
+    diff = PlanDiff(plan0, plan1)
+    self.assertTrue(diff)
+    self.assertEqual(diff.added, [])
+    self.assertEqual(diff.removed, [])
+    self.assertEqual(len(diff.changed), 1)
+    t0, t1 = diff.changed[0]
+    self.assertEqual(plan0.owners[t0], plan1.owners[t1])
+    self.assertEqual(diff.added_edges, [])
+    self.assertEqual(diff.removed_edges, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,141 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource
+from systems.probes import Probes, probe
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class Failed(Exception):
+  pass
+
+
+class ProbesTest(unittest.TestCase):
+  def setUp(self):
+    self.runs = 0
+
+  def answer(self, value):
+    self.runs += 1
+    return value
+
+  def test_direct(self):
+    # Without an active Probes, every probe runs.
+    self.assertEqual(probe('k', self.answer, 1), 1)
+    self.assertEqual(probe('k', self.answer, 2), 2)
+    self.assertEqual(self.runs, 2)
+
+  def test_cached(self):
+    with Probes() as probes:
+      self.assertEqual(probe('k', self.answer, 1), 1)
+      self.assertEqual(probe('k', self.answer, 2), 1)
+      self.assertEqual(probe('l', self.answer, 3), 3)
+    self.assertEqual(self.runs, 2)
+    self.assertEqual((probes.count, probes.hits, len(probes)), (2, 1, 2))
+    probes.clear()
+    with probes:
+      self.assertEqual(probe('k', self.answer, 2), 2)
+    self.assertEqual(self.runs, 3)
+
+  def test_failure(self):
+    # Failures are answers too.
+    def fail():
+      self.runs += 1
+      raise Failed()
+    with Probes():
+      self.assertRaises(Failed, probe, 'k', fail)
+      self.assertRaises(Failed, probe, 'k', fail)
+    self.assertEqual(self.runs, 1)
+
+  def test_concurrent(self):
+    # Concurrent reads of a key wait for one run.
+    def slow():
+      time.sleep(.05)
+      return self.answer('x')
+    results = []
+    def read():
+      results.append(probe('k', slow))
+    with Probes():
+      threads = [threading.Thread(target=read) for i in xrange(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join(10)
+    self.assertEqual(results, ['x'] * 4)
+    self.assertEqual(self.runs, 1)
+
+  def test_nested(self):
+    with Probes():
+      self.assertRaises(RuntimeError, Probes().__enter__)
+
+  def test_jobs(self):
+    self.assertRaises(ValueError, Probes, 0)
+
+  def test_prefetch(self):
+    # What the type registered is read ahead, and then hit.
+    res = resource('User', name='nonexistent-probes-user')
+    with Probes() as probes:
+      probes.prefetch([res])
+      count = probes.count
+      self.assertTrue(count > 0)
+      self.assertFalse(res.read_attrs()['present'])
+      self.assertEqual(probes.count, count)
+      self.assertTrue(probes.hits > 0)
+
+  def test_prefetch_nothing(self):
+    with Probes() as probes:
+      probes.prefetch([resource('Directory',
+        path='/nonexistent/probes', mode='0755')])
+    self.assertEqual(probes.count, 0)
+
+
+class PreviewTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def expand(self, rg):
+    for name in 'ab':
+      rg.add_resource(resource('Directory',
+          path=os.path.join(self.directory, name), mode='0755'))
+    rg.add_resource(resource('User', name='nonexistent-probes-user'))
+
+  def test_preview(self):
+    # Nothing is realized; what is probed is kept for realize.
+    probes = Probes()
+    r = Realizer(FunExpandable(self.expand), probes=probes)
+    todo = r.preview()
+    self.assertEqual(len(todo), len(r.plan))
+    self.assertTrue(probes.count > 0)
+    self.assertTrue(len(probes) > 0)
+    self.assertEqual(os.listdir(self.directory), [])
+    self.assertEqual(r.preview(), todo)
+
+  def test_after_realize(self):
+    def expand(rg):
+      rg.add_resource(resource('Directory',
+          path=os.path.join(self.directory, 'a'), mode='0755'))
+    probes = Probes()
+    r = Realizer(FunExpandable(expand), probes=probes)
+    self.assertEqual(r.realize(), 1)
+    # Answers don't survive realization.
+    self.assertEqual(len(probes), 0)
+    self.assertEqual(r.preview(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,144 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import signal
+import subprocess
+import threading
+import unittest
+
+from systems.dsl import transition
+from systems.executor import TransitionsFailed
+from systems.reactor import ChildProcess, Reactor, run_coroutine
+
+from support import load_plugins
+
+load_plugins()
+
+
+def command(*cmdline, **kargs):
+  return transition('Command', cmdline=list(cmdline), **kargs)
+
+def echo(word):
+  return command('/bin/echo', word, redir_stdout=True)
+
+
+class RunCoroutineTest(unittest.TestCase):
+  def test_child_process(self):
+    self.assertEqual(
+        ChildProcess(['/bin/cat'], input='abc', capture_stdout=True).run(),
+        (0, 'abc'))
+
+  def test_command(self):
+    t = command('/bin/cat', cmdline_input='abc', redir_stdout=True)
+    self.assertEqual(run_coroutine(t.realize_coroutine_impl()),
+        {'retcode': 0, 'stdout': 'abc'})
+
+  def test_unless(self):
+    t = command('/bin/false', unless=['/bin/true'])
+    self.assertEqual(run_coroutine(t.realize_coroutine_impl())['retcode'], 0)
+
+
+class ReactorTest(unittest.TestCase):
+  def run_reactor(self, transitions, depends, **kargs):
+    done = []
+    Reactor(on_done=done.append, **kargs).run(transitions, depends)
+    return done
+
+  def test_order(self):
+    ts = [echo(str(i)) for i in xrange(20)]
+    # Each one waits for the one before.
+    depends = dict((t, ts[i - 1:i]) for (i, t) in enumerate(ts))
+    self.assertEqual(self.run_reactor(ts, depends, jobs=4), ts)
+    self.assertEqual([t.results_attrs['stdout'] for t in ts],
+        ['%d\n' % i for i in xrange(20)])
+
+  def test_concurrent(self):
+    ts = [echo(str(i)) for i in xrange(100)]
+    done = self.run_reactor(ts, {})
+    self.assertEqual(set(done), set(ts))
+    for t in ts:
+      self.assertTrue(t.is_realized)
+
+  def test_threads(self):
+    # Transitions without a coroutine run on threads.
+    ran = []
+    def append(value):
+      ran.append(value)
+    t0 = echo('a')
+    t1 = transition('PythonCode', function=append, args=[1])
+    t2 = echo('b')
+    done = self.run_reactor([t0, t1, t2], {t1: [t0], t2: [t1]})
+    self.assertEqual(done, [t0, t1, t2])
+    self.assertEqual(ran, [1])
+
+  def test_input(self):
+    # Much more than a pipe holds, written as the command reads.
+    data = ''.join(chr(i % 251) for i in xrange(1 << 16)) * 128
+    t = command('/bin/cat', cmdline_input=data, redir_stdout=True)
+    self.run_reactor([t], {})
+    self.assertEqual(t.results_attrs['stdout'], data)
+
+  def test_empty_input(self):
+    t = command('/bin/cat', cmdline_input='', redir_stdout=True)
+    self.run_reactor([t], {})
+    self.assertEqual(t.results_attrs['stdout'], '')
+
+  def test_failure(self):
+    t0 = command('/bin/false')
+    t1 = echo('after')
+    self.assertRaises(subprocess.CalledProcessError,
+        self.run_reactor, [t0, t1], {t1: [t0]})
+    self.assertFalse(t1.is_realized)
+
+  def test_keep_going(self):
+    t0 = command('/bin/false')
+    t1 = echo('after')
+    t2 = echo('unrelated')
+    try:
+      self.run_reactor([t0, t1, t2], {t1: [t0]}, keep_going=True)
+    except TransitionsFailed, e:
+      self.assertEqual([t for (t, exc_info) in e.failures], [t0])
+      self.assertEqual(e.skipped, [t1])
+    else:
+      self.fail('No failure')
+    self.assertTrue(t2.is_realized)
+
+  def test_off_main_thread(self):
+    # Without SIGCHLD, processes are waited for on threads.
+    ts = [echo(str(i)) for i in xrange(20)]
+    errors = []
+    def run():
+      try:
+        self.run_reactor(ts, {})
+      except Exception, e:
+        errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(30)
+    self.assertFalse(thread.isAlive())
+    self.assertEqual(errors, [])
+    for t in ts:
+      self.assertTrue(t.is_realized)
+
+  def test_sigchld_restored(self):
+    handler = signal.getsignal(signal.SIGCHLD)
+    flags = []
+    siginterrupt = signal.siginterrupt
+    def record(signum, flag):
+      flags.append((signum, flag))
+      siginterrupt(signum, flag)
+    signal.siginterrupt = record
+    try:
+      self.run_reactor([echo('a')], {})
+    finally:
+      signal.siginterrupt = siginterrupt
+    self.assertEqual(signal.getsignal(signal.SIGCHLD), handler)
+    # Interrupting system calls again, as Python handlers do.
+    self.assertEqual(flags, [(signal.SIGCHLD, False), (signal.SIGCHLD, True)])
+
+  def test_jobs(self):
+    self.assertRaises(ValueError, Reactor, jobs=0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource
+from systems.plugins.files.directory import Directory
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class RefreezeTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.expand_into = Directory.__dict__['expand_into']
+    self.expanded = []
+    def expand_into(res, rg):
+      self.expanded.append(os.path.basename(res.id_attrs['path']))
+      self.expand_into(res, rg)
+    Directory.expand_into = expand_into
+
+  def tearDown(self):
+    Directory.expand_into = self.expand_into
+    shutil.rmtree(self.directory)
+
+  def dir(self, name):
+    return resource('Directory',
+        path=os.path.join(self.directory, name), mode='0755')
+
+  def realizer(self, names):
+    def expand(rg):
+      for name in names:
+        rg.add_resource(self.dir(name))
+    return Realizer(FunExpandable(expand))
+
+  def plan(self, r):
+    return [repr(t) for t in r.plan]
+
+  def test_add(self):
+    # Only what is new is expanded, the plan is as if it had been
+    # there all along.
+    r = self.realizer('ab')
+    r.plan
+    r.add_resource(self.dir('c'))
+    self.expanded = []
+    plan = self.plan(r)
+    self.assertEqual(self.expanded, ['c'])
+    self.assertEqual(plan, self.plan(self.realizer('abc')))
+
+  def test_realize_again(self):
+    r = self.realizer('ab')
+    self.assertEqual(r.realize(), 2)
+    r.add_resource(self.dir('c'))
+    self.assertEqual(r.realize(), 1)
+    self.assertTrue(os.path.isdir(os.path.join(self.directory, 'c')))
+
+  def test_remove(self):
+    r = self.realizer('')
+    a = r.add_resource(self.dir('a'))
+    r.add_resource(self.dir('b'))
+    r.plan
+    r.remove_resource(a.unref)
+    self.expanded = []
+    plan = self.plan(r)
+    self.assertEqual(self.expanded, [])
+    self.assertEqual(plan, self.plan(self.realizer('b')))
+
+  def test_remove_unknown(self):
+    r = self.realizer('a')
+    r.plan
+    self.assertRaises(KeyError, r.remove_resource, self.dir('b'))
+
+
+if __name__ == '__main__':
+  unittest.main()
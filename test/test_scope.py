@@ -0,0 +1,116 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.context import Realizer, ResourceGraph
+from systems.dsl import resource, transition
+from systems.plugins.files.directory import Directory
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def echo(word):
+  return transition('Command', cmdline=['/bin/echo', word])
+
+def words(plan):
+  return [t.instr_attrs['cmdline'][1] for t in plan
+      if t.instr_attrs['cmdline'][0] == '/bin/echo']
+
+
+class ScopeTest(unittest.TestCase):
+  def setUp(self):
+    self.expand_into = Directory.__dict__['expand_into']
+
+  def tearDown(self):
+    Directory.expand_into = self.expand_into
+
+  def expand_directories(self, expand_into):
+    Directory.expand_into = expand_into
+
+  def test_in_place(self):
+    # What a resource expands into, at any depth, comes after
+    # what it depends on and before what depends on it.
+    def expand_into(res, rg):
+      path = res.id_attrs['path']
+      if path.count('/') < 4:
+        before = rg.add_transition(echo(path + ':before'))
+        sub = rg.add_resource(resource('Directory',
+            path=path + '/sub', mode='0755'), depends=[before])
+        rg.add_transition(echo(path + ':after'), depends=[sub])
+    self.expand_directories(expand_into)
+    def expand(rg):
+      first = rg.add_transition(echo('first'))
+      d = rg.add_resource(resource('Directory',
+          path='/nonexistent/d', mode='0755'), depends=[first])
+      rg.add_transition(echo('last'), depends=[d])
+    plan = Realizer(FunExpandable(expand)).plan
+    self.assertEqual(words(plan), ['first',
+      '/nonexistent/d:before',
+      '/nonexistent/d/sub:before',
+      '/nonexistent/d/sub:after',
+      '/nonexistent/d:after',
+      'last'])
+
+  def test_add_to_top(self):
+    # Expansions sharing a resource through the top share one node,
+    # which doesn't come after what either expansion depends on.
+    def expand_into(res, rg):
+      pkg = rg.add_to_top(resource('AptitudePackage', name='shared'))
+      rg.add_transition(echo(res.id_attrs['path']), depends=[pkg])
+    self.expand_directories(expand_into)
+    def expand(rg):
+      d0 = rg.add_resource(resource('Directory',
+          path='/nonexistent/d0', mode='0755'))
+      rg.add_resource(resource('Directory',
+          path='/nonexistent/d1', mode='0755'), depends=[d0])
+    plan = Realizer(FunExpandable(expand)).plan
+    self.assertEqual(len(plan), 3)
+    self.assertEqual(plan.transitions[0].instr_attrs['cmdline'][-1],
+        'shared+')
+    self.assertEqual(words(plan), ['/nonexistent/d0', '/nonexistent/d1'])
+
+  def test_add_to_top_processed(self):
+    # A top resource that was expanded already is depended on
+    # through what it expanded into.
+    def expand_into(res, rg):
+      if res.id_attrs['path'] == '/nonexistent/late':
+        rg.add_transition(echo('late'), depends=[rg.add_to_top(
+          resource('Directory', path='/nonexistent/early', mode='0755'))])
+      else:
+        rg.add_transition(echo('early'))
+    self.expand_directories(expand_into)
+    rg = ResourceGraph()
+    early = rg.add_resource(resource('Directory',
+        path='/nonexistent/early', mode='0755'))
+    rg.expand_resource(early.unref)
+    late = rg.add_resource(resource('Directory',
+        path='/nonexistent/late', mode='0755'))
+    rg.expand_resource(late.unref)
+    early_t, late_t = rg.sorted_transitions()
+    self.assertEqual(list(rg.transition_dependencies()[late_t]), [early_t])
+
+  def test_collision(self):
+    # A resource of another scope can't be added again, only passed
+    # by reference or shared through the top.
+    def expand_into(res, rg):
+      rg.add_resource(resource('AptitudePackage', name='pa'))
+    self.expand_directories(expand_into)
+    rg = ResourceGraph()
+    rg.add_resource(resource('AptitudePackage', name='pa'))
+    d = rg.add_resource(resource('Directory',
+        path='/nonexistent/d', mode='0755'))
+    self.assertRaises(RuntimeError, rg.expand_resource, d.unref)
+
+  def test_conflict(self):
+    rg = ResourceGraph()
+    rg.add_resource(resource('Directory', path='/nonexistent/d', mode='0755'))
+    self.assertRaises(KeyError, rg.add_resource,
+        resource('Directory', path='/nonexistent/d', mode='0700'))
+
+
+if __name__ == '__main__':
+  unittest.main()
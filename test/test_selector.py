@@ -0,0 +1,145 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import systems
+from systems.context import Realizer
+from systems.dsl import resource
+from systems.plugins.files.directory import Directory
+from systems.selector import Selector, parse_selectors
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def paths(plan):
+  return [t.instr_attrs['function'].im_self.id_attrs['path'] for t in plan]
+
+
+class SelectorTest(unittest.TestCase):
+  def test_parse(self):
+    sel = Selector.parse('Redmine:name=main,port=80@web')
+    self.assertEqual(sel.type_name, 'Redmine')
+    self.assertEqual(sel.id_attrs, {'name': 'main', 'port': '80'})
+    self.assertEqual(sel.tag, 'web')
+    self.assertEqual(str(sel), 'Redmine:name=main,port=80@web')
+    self.assertEqual(str(Selector.parse('@web')), '@web')
+    self.assertEqual(Selector.parse('Directory').id_attrs, {})
+
+  def test_parse_errors(self):
+    for spec in ('', 'Directory@', ':path', 'Directory:=x'):
+      self.assertRaises(ValueError, Selector.parse, spec)
+
+  def test_matches(self):
+    d = resource('Directory', path='/nonexistent/d', mode='0755')
+    self.assertTrue(Selector.parse('Directory').matches(d))
+    self.assertTrue(Selector.parse(':path=/nonexistent/d').matches(d))
+    self.assertFalse(Selector.parse(':path=/nonexistent/e').matches(d))
+    self.assertFalse(Selector.parse(':name=d').matches(d))
+    self.assertFalse(Selector.parse('PlainFile').matches(d))
+    self.assertFalse(Selector.parse('@web').matches(d))
+    self.assertTrue(Selector.parse('Directory@web').matches(d, ['web']))
+    # Values that aren't text match by their text form.
+    self.assertTrue(Selector('Directory', {'path': u'/nonexistent/d'})
+        .matches(d))
+
+
+class SelectTest(unittest.TestCase):
+  def setUp(self):
+    self.expand_into = Directory.__dict__['expand_into']
+
+  def tearDown(self):
+    Directory.expand_into = self.expand_into
+
+  def plan(self, specs):
+    # a and b don't depend on each other, c comes after a.
+    def expand(rg):
+      a = rg.add_resource(resource('Directory',
+          path='/nonexistent/a', mode='0755'), tags=['web'])
+      rg.add_resource(resource('Directory',
+          path='/nonexistent/b', mode='0755'), tags=['db'])
+      rg.add_resource(resource('Directory',
+          path='/nonexistent/c', mode='0755'), depends=[a])
+    return Realizer(FunExpandable(expand),
+        select=parse_selectors(specs)).plan
+
+  def test_before(self):
+    self.assertEqual(paths(self.plan([':path=/nonexistent/c'])),
+        ['/nonexistent/a', '/nonexistent/c'])
+
+  def test_tag(self):
+    self.assertEqual(paths(self.plan(['@db'])), ['/nonexistent/b'])
+    self.assertEqual(paths(self.plan(['@db', '@web'])),
+        ['/nonexistent/a', '/nonexistent/b'])
+
+  def test_nothing(self):
+    self.assertRaises(ValueError, self.plan, ['@mail'])
+
+  def test_expanded(self):
+    # No top resource matches, what they expand into does.
+    def expand_into(res, rg):
+      if not res.id_attrs['path'].endswith('/sub'):
+        rg.add_resource(resource('Directory',
+            path=res.id_attrs['path'] + '/sub', mode='0755'))
+      self.expand_into(res, rg)
+    Directory.expand_into = expand_into
+    self.assertEqual(paths(self.plan([':path=/nonexistent/b/sub'])),
+        ['/nonexistent/b/sub'])
+
+
+MANIFEST = """
+from systems.dsl import resource
+
+def expand(rg):
+  for name in ('a', 'b'):
+    rg.add_resource(resource('Directory', path=%r + name, mode='0755'))
+"""
+
+
+class CliTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.manifest = os.path.join(self.directory, 'manifest.py')
+    f = open(self.manifest, 'w')
+    f.write(MANIFEST % (self.directory + '/', ))
+    f.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_cli(self, *args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(systems.__file__))
+    proc = subprocess.Popen([sys.executable, '-m', 'systems.cli']
+        + list(args) + [self.manifest],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    return proc.returncode, out
+
+  def test_select(self):
+    status, out = self.run_cli('-n', '-s', ':path=%s/b' % self.directory)
+    self.assertEqual(status, 0)
+    # One transition, described but not realized.
+    self.assertEqual(len(out.splitlines()), 1)
+    self.assertFalse(os.path.exists(os.path.join(self.directory, 'b')))
+
+  def test_realize(self):
+    status, out = self.run_cli('-s', 'Directory:path=%s/a' % self.directory)
+    self.assertEqual(status, 0)
+    self.assertTrue(os.path.isdir(os.path.join(self.directory, 'a')))
+    self.assertFalse(os.path.exists(os.path.join(self.directory, 'b')))
+
+  def test_bad_selector(self):
+    self.assertEqual(self.run_cli('-s', 'Directory@')[0], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+from cStringIO import StringIO
+
+from systems.context import Realizer, ResourceGraph
+from systems.dsl import resource, transition
+from systems.plandiff import PlanDiff
+from systems.serialization import dump_graph, dump_plan, load_graph, load_plan
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+def add_files(rg):
+  d = rg.add_resource(resource('Directory',
+      path='/nonexistent/ser', mode='0755'))
+  f = rg.add_resource(resource('PlainFile',
+      path='/nonexistent/ser/f', contents='a\nline'), depends=[d])
+  rg.add_transition(transition('Command',
+      cmdline=['/bin/echo', '<&>', '"q"']), depends=[f])
+
+def expanded_graph():
+  rg = ResourceGraph()
+  add_files(rg)
+  while True:
+    resources = list(rg.iter_unexpanded_resources())
+    if not resources:
+      return rg
+    rg.expand_resources(resources)
+
+def dumped(dump, obj):
+  f = StringIO()
+  dump(obj, f)
+  return f.getvalue()
+
+def shape(rg):
+  nodes = rg.sorted_nodes()
+  position = dict((node, i) for (i, node) in enumerate(nodes))
+  return ([repr(node) for node in nodes],
+      sorted((position[n0], position[n1])
+        for (n0, n1) in rg._graph.edges_iter()))
+
+
+class PlanRoundTripTest(unittest.TestCase):
+  def test_plan(self):
+    plan = Realizer(FunExpandable(add_files)).plan
+    data = dumped(dump_plan, plan)
+    loaded = load_plan(StringIO(data))
+    self.assertFalse(PlanDiff(plan, loaded))
+    self.assertEqual([repr(t) for t in plan], [repr(t) for t in loaded])
+    self.assertEqual([plan.owners.get(t) for t in plan],
+        [loaded.owners.get(t) for t in loaded])
+    self.assertEqual(sorted(plan.stable_ids().values()),
+        sorted(loaded.stable_ids().values()))
+    self.assertEqual(dumped(dump_plan, loaded), data)
+
+
+class GraphRoundTripTest(unittest.TestCase):
+  def test_graph(self):
+    rg = expanded_graph()
+    data = dumped(dump_graph, rg)
+    loaded = load_graph(StringIO(data))
+    self.assertEqual(shape(loaded), shape(rg))
+    self.assertEqual(sorted(map(repr, loaded.iter_processed_resources())),
+        sorted(map(repr, rg.iter_processed_resources())))
+    self.assertFalse(PlanDiff(rg.compact(), loaded.compact()))
+    self.assertEqual(dumped(dump_graph, loaded), data)
+
+  def test_reuse(self):
+    # Loaded resources are known as expanded.
+    loaded = load_graph(StringIO(dumped(dump_graph, expanded_graph())))
+    loaded.add_resource(resource('Directory',
+        path='/nonexistent/ser', mode='0755'))
+    self.assertEqual(list(loaded.iter_unexpanded_resources()), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
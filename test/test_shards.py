@@ -0,0 +1,98 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from systems.dsl import resource, transition
+from systems.plugins.packages.aptitudepackage import AptitudePackages
+from systems.shards import ShardedRealizer, ShardError
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class ShardsTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.log = os.path.join(self.directory, 'log')
+    self.expand_into = AptitudePackages.__dict__['expand_into']
+
+  def tearDown(self):
+    AptitudePackages.expand_into = self.expand_into
+    shutil.rmtree(self.directory)
+
+  def path(self, name):
+    return os.path.join(self.directory, name)
+
+  def record(self, line):
+    # Appends are atomic, whatever process writes.
+    fd = os.open(self.log, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+      os.write(fd, line + '\n')
+    finally:
+      os.close(fd)
+
+  def lines(self):
+    f = open(self.log)
+    try:
+      return f.read().split()
+    finally:
+      f.close()
+
+  def test_realize(self):
+    # Directories that don't depend on each other, and one
+    # both depend on, realized by the coordinator.
+    def expand(rg):
+      for name in 'abcd':
+        d = rg.add_resource(resource('Directory',
+            path=self.path(name), mode='0755'))
+        rg.add_to_top(resource('Directory',
+            path=self.path('shared'), mode='0755'))
+        rg.add_resource(resource('PlainFile',
+            path=self.path(name + '/f'), contents='x'), depends=[d])
+    report = ShardedRealizer(FunExpandable(expand), 2).realize()
+    self.assertEqual([entry['shard'] for entry in report], [None, 0, 1])
+    for name in 'abcd':
+      self.assertTrue(os.path.exists(self.path(name + '/f')))
+
+  def test_failure(self):
+    def fail():
+      raise ValueError()
+    def expand(rg):
+      rg.add_transition(transition('PythonCode', function=fail))
+      rg.add_resource(resource('Directory',
+          path=self.path('a'), mode='0755'))
+    realizer = ShardedRealizer(FunExpandable(expand), 2)
+    self.assertRaises(ShardError, realizer.realize)
+    errors = [entry['shard'] for entry in realizer.report
+        if entry['error'] is not None]
+    self.assertEqual(len(errors), 1)
+    self.assertTrue(os.path.isdir(self.path('a')))
+
+  def test_aggregates(self):
+    # Each shard collects its own packages; the commands
+    # installing them don't overlap.
+    def install():
+      self.record('start')
+      time.sleep(.2)
+      self.record('end')
+    def expand_into(aggregate, rg):
+      rg.add_transition(transition('PythonCode', function=install))
+    AptitudePackages.expand_into = expand_into
+    def expand(rg):
+      for name in ('pa', 'pb', 'pc'):
+        rg.add_resource(resource('AptitudePackage', name=name))
+    lock_files = set(os.listdir(tempfile.gettempdir()))
+    ShardedRealizer(FunExpandable(expand), 3).realize(engine='events')
+    self.assertEqual(self.lines(), ['start', 'end'] * 3)
+    self.assertEqual(set(os.listdir(tempfile.gettempdir())), lock_files)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from systems.context import Realizer
+from systems.dsl import resource
+from systems.statestore import StateStore
+from systems.typesystem import FunExpandable
+
+from support import load_plugins
+
+load_plugins()
+
+
+class StateStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.store = StateStore(os.path.join(self.directory, 'db', 'state'))
+    self.path = os.path.join(self.directory, 'f')
+
+  def tearDown(self):
+    self.store.close()
+    shutil.rmtree(self.directory)
+
+  def write(self, contents):
+    f = open(self.path, 'w')
+    f.write(contents)
+    f.close()
+
+  def plain_file(self, contents='x'):
+    return resource('PlainFile', path=self.path, contents=contents)
+
+  def test_record(self):
+    self.write('x')
+    self.assertFalse(self.store.is_converged(self.plain_file()))
+    self.store.record([self.plain_file()])
+    self.assertTrue(self.store.is_converged(self.plain_file()))
+    # Other wanted attributes.
+    self.assertFalse(self.store.is_converged(self.plain_file('y')))
+    store = self.store.reopen()
+    self.assertTrue(store.is_converged(self.plain_file()))
+    store.close()
+    self.store.clear()
+    self.assertFalse(self.store.is_converged(self.plain_file()))
+
+  def test_token(self):
+    self.write('x')
+    self.store.record([self.plain_file()])
+    # Written, the token changes.
+    self.write('changed')
+    self.assertFalse(self.store.is_converged(self.plain_file()))
+
+  def test_no_token(self):
+    res = resource('RubyGem', name='rake', version='0.8.7')
+    self.store.record([res])
+    self.assertFalse(self.store.is_converged(res))
+
+  def test_realizer(self):
+    def expand(rg):
+      rg.add_resource(self.plain_file())
+    Realizer(FunExpandable(expand), state_store=self.store).realize()
+    self.assertEqual(open(self.path).read(), 'x')
+    self.assertTrue(self.store.is_converged(self.plain_file()))
+    # Converged, it is skipped.
+    self.assertEqual(len(Realizer(FunExpandable(expand),
+      state_store=self.store).plan), 0)
+    self.assertEqual(len(Realizer(FunExpandable(expand),
+      state_store=self.store, force_verify=True).plan), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import random
+import unittest
+
+from systems.util.dag import DAG
+from systems.util.topoorder import CycleError, TopoOrder
+
+
+class Graph(object):
+  # A DAG and its order, edges checked before they are added.
+
+  def __init__(self):
+    self.dag = DAG()
+    self.order = TopoOrder(self.dag.successors_iter,
+        self.dag.predecessors_iter)
+
+  def add_node(self, node, before=None):
+    self.dag.add_node(node)
+    self.order.add_node(node, before)
+
+  def add_edge(self, node0, node1):
+    self.order.add_edge(node0, node1)
+    self.dag.add_edge(node0, node1)
+
+  def check(self, test):
+    nodes = list(self.order)
+    test.assertEqual(len(nodes), len(self.order))
+    test.assertEqual(set(nodes), set(self.dag))
+    positions = [self.order.position(node) for node in nodes]
+    test.assertEqual(positions, sorted(set(positions)))
+    for (node0, node1) in self.dag.edges_iter():
+      test.assertTrue(self.order.precedes(node0, node1))
+
+
+class TopoOrderTest(unittest.TestCase):
+  def test_in_order(self):
+    g = Graph()
+    for node in 'abc':
+      g.add_node(node)
+    g.add_edge('a', 'b')
+    g.add_edge('b', 'c')
+    self.assertEqual(list(g.order), ['a', 'b', 'c'])
+    g.check(self)
+
+  def test_reorder(self):
+    g = Graph()
+    for node in 'abcde':
+      g.add_node(node)
+    g.add_edge('d', 'e')
+    g.add_edge('a', 'b')
+    # c isn't connected to b nor e, and stays where it was.
+    g.add_edge('e', 'b')
+    self.assertEqual(list(g.order), ['a', 'd', 'c', 'e', 'b'])
+    g.check(self)
+
+  def test_cycle(self):
+    g = Graph()
+    for node in 'abc':
+      g.add_node(node)
+    g.add_edge('a', 'b')
+    g.add_edge('b', 'c')
+    before = list(g.order)
+    try:
+      g.add_edge('c', 'a')
+    except CycleError, e:
+      self.assertEqual(e.args[0], ['a', 'b', 'c'])
+    else:
+      self.fail('No cycle found')
+    self.assertEqual(list(g.order), before)
+    self.assertRaises(CycleError, g.add_edge, 'a', 'a')
+    g.check(self)
+
+  def test_has_path(self):
+    g = Graph()
+    for node in 'abcd':
+      g.add_node(node)
+    g.add_edge('a', 'c')
+    g.add_edge('c', 'd')
+    self.assertTrue(g.order.has_path('a', 'd'))
+    self.assertFalse(g.order.has_path('a', 'b'))
+    self.assertFalse(g.order.has_path('d', 'a'))
+
+  def test_before(self):
+    g = Graph()
+    g.add_node('a')
+    g.add_node('z')
+    g.add_node('m', before='z')
+    g.add_node('0', before='a')
+    self.assertEqual(list(g.order), ['0', 'a', 'm', 'z'])
+    g.check(self)
+
+  def test_relabel(self):
+    # Inserting before the same node exhausts the gaps.
+    g = Graph()
+    g.add_node('a')
+    g.add_node('z')
+    for i in xrange(100):
+      g.add_node(i, before='z')
+    self.assertEqual(list(g.order), ['a'] + range(100) + ['z'])
+    g.check(self)
+
+  def test_remove(self):
+    g = Graph()
+    for node in 'abc':
+      g.add_node(node)
+    g.order.remove_node('b')
+    g.dag.delete_node('b')
+    g.add_node('d', before='c')
+    self.assertEqual(list(g.order), ['a', 'd', 'c'])
+    g.order.remove_node('a')
+    g.dag.delete_node('a')
+    g.order.remove_node('c')
+    g.dag.delete_node('c')
+    self.assertEqual(list(g.order), ['d'])
+    g.check(self)
+
+  def test_random(self):
+    rand = random.Random(0)
+    g = Graph()
+    nodes = range(200)
+    for node in nodes:
+      if node and rand.random() < .5:
+        g.add_node(node, before=rand.choice(nodes[:node]))
+      else:
+        g.add_node(node)
+    for i in xrange(1000):
+      node0, node1 = rand.sample(nodes, 2)
+      if g.dag.has_edge(node0, node1):
+        continue
+      try:
+        g.add_edge(node0, node1)
+      except CycleError, e:
+        path = e.args[0]
+        self.assertEqual((path[0], path[-1]), (node1, node0))
+        for (p0, p1) in zip(path, path[1:]):
+          self.assertTrue(g.dag.has_edge(p0, p1))
+    g.check(self)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+# vim: set fileencoding=utf-8 sw=2 ts=2 et :
+from __future__ import absolute_import
+
+import unittest
+
+from systems.collector import Collector
+from systems.context import ResourceGraph
+from systems.dsl import resource
+from systems.plugins.files.directory import Directory
+from systems.plugins.packages.aptitudepackage import (AptitudePackage,
+    AptitudePackageCollector, AptitudePackages)
+
+from support import load_plugins
+
+load_plugins()
+
+
+class WorklistTest(unittest.TestCase):
+  def setUp(self):
+    rg = self.rg = ResourceGraph()
+    self.d = rg.add_resource(resource('Directory',
+        path='/nonexistent/w', mode='0755')).unref
+    self.f = rg.add_resource(resource('PlainFile',
+        path='/nonexistent/w/f'), depends=[self.d]).unref
+    self.p = rg.add_resource(resource('AptitudePackage', name='pa')).unref
+
+  def test_pending(self):
+    rg = self.rg
+    self.assertTrue(rg.has_unprocessed())
+    self.assertEqual(set(rg.iter_unexpanded_resources()),
+        set([self.d, self.f]))
+    self.assertEqual(list(rg.iter_unexpanded_resources(Directory)), [self.d])
+    self.assertEqual(list(rg.iter_uncollected_resources()), [self.p])
+    self.assertEqual(list(rg.iter_uncollected_resources(AptitudePackage)),
+        [self.p])
+    self.assertEqual(list(rg.iter_uncollected_resources(Directory)), [])
+    self.assertEqual(len(list(rg.iter_unprocessed())), 3)
+
+  def test_processed(self):
+    rg = self.rg
+    rg.expand_resources([self.d, self.f])
+    self.assertEqual(list(rg.iter_unexpanded_resources()), [])
+    rg.collect_resources([self.p], AptitudePackages([self.p]))
+    self.assertEqual(list(rg.iter_uncollected_resources()), [])
+    aggregates = list(rg.iter_unexpanded_aggregates())
+    self.assertEqual(len(aggregates), 1)
+    self.assertTrue(rg.has_unprocessed())
+    rg.expand_resource(aggregates[0])
+    self.assertFalse(rg.has_unprocessed())
+    self.assertEqual(list(rg.iter_unprocessed()), [])
+
+  def test_added_during_expansion(self):
+    # What expansions add goes on the worklist.
+    def expand_into(res, scope):
+      scope.add_resource(resource('AptitudePackage', name='pb'))
+    expand = Directory.__dict__['expand_into']
+    Directory.expand_into = expand_into
+    try:
+      self.rg.expand_resource(self.d)
+    finally:
+      Directory.expand_into = expand
+    self.assertEqual(len(list(self.rg.iter_uncollected_resources())), 2)
+
+
+class AcceptsTest(unittest.TestCase):
+  def test_filter(self):
+    collector = AptitudePackageCollector('c')
+    self.assertTrue(collector.filter(resource('AptitudePackage', name='pa')))
+    self.assertRaises(NotImplementedError,
+        Collector('c').filter, resource('AptitudePackage', name='pa'))
+
+
+if __name__ == '__main__':
+  unittest.main()